@@ -0,0 +1,216 @@
+"""Benchmarks of the hot paths of loading, decoding, rendering and dumping
+
+    python benchmark.py [-o RESULTS.json] [--baseline BASELINE.json]
+                        [--threshold 0.2] [--repeat 5] [--filter TEXT]
+
+The fixtures are generated from a fixed random seed in a temporary
+directory, so every run measures the same data: CHR files of 8 KB,
+256 KB and 1 MB and a nametable using the tiles of the 8 KB bank.
+
+Every benchmark is run in a loop lasting at least 50 ms, which is timed
+a number of times. The best time is kept, as it is the least disturbed
+by other processes. The results are written as JSON. Given the JSON of
+an earlier run as baseline, every benchmark that is slower than the
+baseline by more than the threshold (a fraction, 0.2 for 20 %) is
+reported as a regression, and the exit status is 1."""
+from plotter import TileGroup, Palette
+from nametable import Nametable
+from compositor import Compositor
+import profiling
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+import unittest
+
+FIXTURE_SIZES = [("8k", 8*1024), ("256k", 256*1024), ("1m", 1024*1024)]
+SEED = 1234
+
+class Fixtures:
+    """The generated data used by the benchmarks"""
+    def __init__(self, directory):
+        """Init"""
+        self.directory = directory
+        rng = random.Random(SEED)
+        self.chrFiles = {}
+        for name, size in FIXTURE_SIZES:
+            filename = os.path.join(directory, "bank_%s.chr" %(name))
+            with open(filename, "wb") as f:
+                f.write(bytearray([rng.randint(0, 255) for i in range(size)]))
+            self.chrFiles[name] = filename
+        self.nametableData = bytearray([rng.randint(0, 255) for i in range(1024)])
+        self.palettes = []
+        for i in range(4):
+            palette = Palette()
+            palette.setColors([0x0F, 0x16+i, 0x27+i, 0x30+i])
+            self.palettes.append(palette)
+
+    def loadTileGroup(self, name):
+        """Return a tile group with the tiles of a CHR file"""
+        tileGroup = TileGroup()
+        tileGroup.loadFromFile(self.chrFiles[name])
+        return tileGroup
+
+def getBenchmarks(fixtures):
+    """Return a list of (name, function) with the benchmarks"""
+    benchmarks = []
+    for name, size in FIXTURE_SIZES:
+        def load(filename=fixtures.chrFiles[name]):
+            TileGroup().loadFromFile(filename)
+        benchmarks.append(("loadFromFile_%s" %(name), load))
+
+    for name in ("8k", "256k"):
+        tileGroup = fixtures.loadTileGroup(name)
+        def getIntMatrix(tileGroup=tileGroup):
+            tileGroup.getBank().setData(tileGroup.getBank().getData())  # Drop the decode cache
+            for tile in tileGroup.tilesIterator():
+                tile.getIntMatrix()
+        benchmarks.append(("getIntMatrix_%s" %(name), getIntMatrix))
+
+    tileGroup = fixtures.loadTileGroup("8k")
+    matrices = [tile.getIntMatrix() for tile in tileGroup.tilesIterator()]
+    def setData():
+        for tile, matrix in zip(tileGroup.tilesIterator(), matrices):
+            tile.setData(matrix)
+    benchmarks.append(("setData_8k", setData))
+
+    nametable = Nametable()
+    nametable.fromBytes(fixtures.nametableData, tileGroup)
+    dumpFilename = os.path.join(fixtures.directory, "dump.asm")
+    def dump():
+        nametable.dumpToFile(dumpFilename, "nametable", "attribute")
+    benchmarks.append(("dumpToFile", dump))
+
+    compositor = Compositor(tileGroup, fixtures.palettes)
+    def render():
+        compositor.render(nametable)
+    benchmarks.append(("render", render))
+    def renderPNG():
+        compositor.saveImage(nametable, os.path.join(fixtures.directory, "render.png"))
+    benchmarks.append(("renderPNG", renderPNG))
+    return benchmarks
+
+def timeFunction(function, repeat=5, minTime=0.05):
+    """Time a function. The function is called in a loop taking at least
+    minTime seconds, so that short functions are timed accurately, and
+    the loop is timed repeat times.
+
+    Returns {'best', 'mean', 'runs', 'number'}, the best and mean time of
+    one call in seconds, the number of timed loops and calls per loop"""
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < minTime:  # Also warms up caches built once
+        number *= 10
+    times = [time/number for time in timer.repeat(repeat, number)]
+    return {'best':min(times), 'mean':sum(times)/len(times), 'runs':len(times), 'number':number}
+
+def runBenchmarks(repeat=5, nameFilter=None, minTime=0.05):
+    """Run the benchmarks whose names contain nameFilter (all if None)
+    and return the results: {name: result}, see timeFunction"""
+    directory = tempfile.mkdtemp()
+    try:
+        fixtures = Fixtures(directory)
+        results = {}
+        for name, function in getBenchmarks(fixtures):
+            if nameFilter is not None and nameFilter not in name:
+                continue
+            results[name] = timeFunction(function, repeat, minTime)
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+def saveResults(filename, results):
+    """Save results as JSON, together with the Python version"""
+    with open(filename, "w") as f:
+        json.dump({'python':platform.python_version(), 'results':results}, f,
+                  indent=1, sort_keys=True)
+
+def loadResults(filename):
+    """Load results saved by saveResults"""
+    with open(filename) as f:
+        return json.load(f)['results']
+
+def compareResults(results, baseline, threshold=0.2):
+    """Compare the best times with a baseline. Returns a list of
+    (name, baselineTime, time, change) sorted by name, change being the
+    relative change of the time, and a list of the names of the
+    regressions, where the change is larger than the threshold"""
+    comparison = []
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['best']
+        after = results[name]['best']
+        change = (after-before)/before if before > 0 else 0.0
+        comparison.append((name, before, after, change))
+        if change > threshold:
+            regressions.append(name)
+    return comparison, regressions
+
+def main(argv=None):
+    """Run the benchmarks from the command line. Returns the exit status"""
+    parser = argparse.ArgumentParser(description="Run the benchmarks")
+    parser.add_argument("-o", "--output", default=None, metavar="RESULTS.json",
+                        help="save the results as JSON")
+    parser.add_argument("--baseline", default=None, metavar="BASELINE.json",
+                        help="compare with the results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="the relative slowdown counted as a regression (default: 0.2)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="the number of runs of every benchmark (default: 5)")
+    parser.add_argument("--filter", default=None, dest="nameFilter", metavar="TEXT",
+                        help="only run the benchmarks with names containing TEXT")
+    args = parser.parse_args(argv)
+    profiling.enableFromEnvironment()
+
+    results = runBenchmarks(args.repeat, args.nameFilter)
+    for name in sorted(results):
+        sys.stdout.write("%-20s %10.2f ms  (mean %.2f ms)\n"
+                         %(name, results[name]['best']*1000, results[name]['mean']*1000))
+    if args.output is not None:
+        saveResults(args.output, results)
+    if args.baseline is None:
+        return 0
+
+    comparison, regressions = compareResults(results, loadResults(args.baseline), args.threshold)
+    sys.stdout.write("\nCompared with %s:\n" %(args.baseline))
+    for name, before, after, change in comparison:
+        sys.stdout.write("%-20s %10.2f ms -> %10.2f ms  %+6.1f %%%s\n"
+                         %(name, before*1000, after*1000, change*100,
+                           "  REGRESSION" if name in regressions else ""))
+    return 1 if regressions else 0
+
+# *************** Unit tests ***********
+class TestBenchmark(unittest.TestCase):
+    def test_run(self):
+        results = runBenchmarks(repeat=2, nameFilter="8k", minTime=0.001)
+        self.assertEqual(sorted(results), ["getIntMatrix_8k", "loadFromFile_8k", "setData_8k"])
+        for result in results.values():
+            self.assertEqual(result['runs'], 2)
+            self.assertTrue(0 < result['best'] <= result['mean'])
+
+    def test_compare(self):
+        baseline = {'a':{'best':1.0}, 'b':{'best':2.0}, 'c':{'best':1.0}}
+        results = {'a':{'best':1.1}, 'b':{'best':3.0}, 'd':{'best':1.0}}
+        comparison, regressions = compareResults(results, baseline, threshold=0.2)
+        self.assertEqual([entry[0] for entry in comparison], ['a', 'b'])
+        self.assertAlmostEqual(comparison[1][3], 0.5)
+        self.assertEqual(regressions, ['b'])
+
+    def test_save(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "results.json")
+            saveResults(filename, {'a':{'best':1.0, 'mean':1.5, 'runs':2}})
+            self.assertEqual(loadResults(filename), {'a':{'best':1.0, 'mean':1.5, 'runs':2}})
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,11 @@
 import unittest
 from plotter import Tile
 
+# The attribute nibble (subblock) of every tile id in a block and the
+# shift of its two bits in the attribute byte, see Attribute
+_TILE_NIBBLES = [0,0,1,1, 0,0,1,1, 2,2,3,3, 2,2,3,3]
+_TILE_SHIFTS = [6-nibble*2 for nibble in _TILE_NIBBLES]
+
 class Block:
     """A block is composed of 4*4 tiles and an attribute byte.
     The block unit is used in a nametable for the actual graphics.
@@ -62,7 +67,61 @@ class Block:
         setting when creating a new block)"""
         self.inBottomRow = False
         
-class Attribute:
+class BlockView(Block):
+    """A block which is a view into the tile indexes and the attribute
+    table stored in a nametable, see nametable.Nametable.
+    
+    Nothing is stored in the view itself. Reading the tiles or the
+    attribute reads the nametable and setting them writes the nametable"""
+    def __init__(self, nametable, blockNr):
+        """Init"""
+        Block.__init__(self)
+        self._nametable = nametable
+        self._blockNr = blockNr
+        blocksInRow = nametable.nTiles['x']//4
+        self._x = (blockNr%blocksInRow)*4
+        self._y = (blockNr//blocksInRow)*4
+        self.inBottomRow = self._y+4 > nametable.nTiles['y']
+        
+    def getTiles(self):
+        """Get the tiles list. The rows below the bottom of the 
+        nametable use tile 0"""
+        tiles = []
+        for y in range(self._y, self._y+4):
+            for x in range(self._x, self._x+4):
+                if y < self._nametable.nTiles['y']:
+                    tiles.append(self._nametable.getTile(x, y))
+                else:
+                    tiles.append(self._nametable.getTileForIndex(0))
+        return tiles
+    
+    def setTiles(self, tiles):
+        """Write the indexes of the tiles to the nametable"""
+        assert(len(tiles)==4*4)
+        for row in range(4):
+            y = self._y+row
+            if y < self._nametable.nTiles['y']:
+                for col in range(4):
+                    self._nametable.setTileIndex(self._x+col, y, tiles[row*4+col].getIndex())
+                
+    def getRowForNametable(self, rowNumber):
+        """Get a complete row of tile indexes
+        for creating nametable"""
+        assert(0<=rowNumber<=3)
+        if self.inBottomRow and rowNumber>1:
+            return []
+        y = self._y+rowNumber
+        return [self._nametable.getTileIndex(x, y) for x in range(self._x, self._x+4)]
+        
+    def getAttribute(self):
+        """Get the attribute, which is a view into the attribute table"""
+        return Attribute(self._nametable.getAttributeTable(), self._blockNr)
+        
+    def setAttribute(self, attr):
+        """Copy the attribute byte to the attribute table"""
+        self._nametable.getAttributeTable()[self._blockNr] = attr.getAttributeByte()
+        
+class Attribute(object):
     """The attribute is used in a block to set the palette used
     for the separate tiles within the block.
     
@@ -79,10 +138,26 @@ class Attribute:
     -----|-----
      8  9|10 11
     12 13|14 15
+    
+    The attribute byte may be stored in a bytearray shared with other
+    attributes, like the attribute table of a nametable. The attribute
+    is then a view of the byte at the given offset
     """
-    def __init__(self):
+    def __init__(self, storage=None, offset=0):
         """Init"""
-        self.attributeByte = None
+        if storage is None:
+            storage = [None]    # The attribute holds its own byte
+            offset = 0
+        self._storage = storage
+        self._offset = offset
+        
+    def _getAttributeByte(self):
+        return self._storage[self._offset]
+    
+    def _setAttributeByte(self, attributeByte):
+        self._storage[self._offset] = attributeByte
+        
+    attributeByte = property(_getAttributeByte, _setAttributeByte)
     
     def getAttributeByte(self):
         """Return the attribute byte"""
@@ -95,28 +170,17 @@ class Attribute:
     def getAttribute(self, tileId):
         """Get the attribute of the specified tile"""
         assert(0<=tileId<=15)
-        
-        nibble = self._getNibble(tileId)
-        attr = (self.attributeByte>>(6-nibble*2))&0x03
-        return attr
+        return (self.attributeByte>>_TILE_SHIFTS[tileId])&0x03
     
     def _getNibble(self, tileId):
         """As the block is divided of subblocks with
         2*2 tiles, each using a nibble (2 bits) of the attribute,
         there is a need for some kind of mapping.
         
-        This method resilves the mapping of tile to attribute nibble"""
-        if tileId in [0,1,4,5]:
-            nibble=0
-        elif tileId in [2,3,6,7]:
-            nibble=1
-        elif tileId in [8,9,12,13]:
-            nibble=2
-        elif tileId in [10,11,14,15]:
-            nibble=3
-        else:
+        This method resolves the mapping of tile to attribute nibble"""
+        if not 0<=tileId<=15:
             raise AttributeError("tileId not found")
-        return nibble
+        return _TILE_NIBBLES[tileId]
     
     def setAttribute(self, tileId, attr):
         """Set the attribute of the specified tile
@@ -125,10 +189,8 @@ class Attribute:
         2*2 tiles
         """
         assert(0<=tileId<=15)
-        nibble = self._getNibble(tileId)
-        mask = ~(0x03<<(6-nibble*2)) # Mask: ^0b11000000 for tileId=0
-        attrShifted = attr<<(6-nibble*2)
-        self.attributeByte = (self.attributeByte & mask) | attrShifted
+        shift = _TILE_SHIFTS[tileId]
+        self.attributeByte = (self.attributeByte & ~(0x03<<shift)) | (attr<<shift)
     
     def getAttributeByteStr(self):
         """Return the attribute byte as an ascii string.
@@ -141,6 +203,69 @@ class Attribute:
             attrStr += "%d" %((self.attributeByte>>(7-i))&0x01)
         return attrStr
         
+class AttributeTable:
+    """The 64 byte attribute table of a nametable, seen as a grid of
+    16*15 areas of 2*2 tiles, each area having a palette number (0-3).
+    
+    The table is a view of a bytearray, like the attribute table of a 
+    nametable. The byte and the bit shift of every area are looked up
+    in precomputed tables, so whole regions are read and written without
+    handling one block or tile at a time"""
+    WIDTH = 16      # The number of areas in a row
+    HEIGHT = 15     # The number of rows of areas
+    
+    # The byte and the shift of every area, for 16*16 areas
+    _BYTES = [(y//2)*8 + x//2 for y in range(16) for x in range(16)]
+    _SHIFTS = [_TILE_SHIFTS[(y%2)*8 + (x%2)*2] for y in range(16) for x in range(16)]
+    
+    def __init__(self, storage=None):
+        """Init"""
+        if storage is None:
+            storage = bytearray(64)
+        assert(len(storage) == 64)
+        self._storage = storage
+        
+    def getAttributeBytes(self):
+        """Return the attribute table bytes"""
+        return self._storage
+    
+    def getArea(self, x, y):
+        """Return the palette number of the area at column x and row y"""
+        i = y*16 + x
+        return (self._storage[self._BYTES[i]]>>self._SHIFTS[i])&0x03
+    
+    def setArea(self, x, y, palette):
+        """Set the palette number of the area at column x and row y"""
+        self.fill(x, y, 1, 1, palette)
+    
+    def getGrid(self):
+        """Return the palette numbers of all areas as a list of 15 rows,
+        each a bytearray of 16 palette numbers"""
+        storage = self._storage
+        grid = []
+        for y in range(self.HEIGHT):
+            start = y*16
+            grid.append(bytearray([(storage[byte]>>shift)&0x03 for byte, shift in 
+                                   zip(self._BYTES[start:start+16], self._SHIFTS[start:start+16])]))
+        return grid
+    
+    def setRegion(self, x, y, rows):
+        """Set the palette numbers of a region of areas with its top left
+        area at column x and row y. rows is a list of rows of palette 
+        numbers, like the ones returned by getGrid"""
+        assert(y+len(rows) <= self.HEIGHT)
+        storage = self._storage
+        for rowY, row in enumerate(rows, y):
+            assert(x+len(row) <= self.WIDTH)
+            start = rowY*16 + x
+            for byte, shift, palette in zip(self._BYTES[start:start+len(row)], 
+                                            self._SHIFTS[start:start+len(row)], row):
+                storage[byte] = (storage[byte] & ~(0x03<<shift)) | (palette<<shift)
+                
+    def fill(self, x, y, width, height, palette):
+        """Set the palette number of a rectangle of areas"""
+        self.setRegion(x, y, [[palette]*width]*height)
+        
 # *************** Unit tests ***********
 class TestTile(unittest.TestCase):
     def setUp(self):
@@ -195,6 +320,29 @@ class TestTile(unittest.TestCase):
         self.assertEqual(a.getAttribute(tileId=9), 0x00)
         self.assertEqual(a.getAttribute(tileId=14), 0x03)
         
+    def test_attributeTable(self):
+        storage = bytearray([0xC6]*64)
+        table = AttributeTable(storage)
+        # The areas of a block are the tile ids 0, 2, 8 and 10
+        a = Attribute()
+        a.setAttributeByte(0xC6)
+        self.assertEqual([table.getArea(x, y) for y in range(2) for x in range(2)],
+                         [a.getAttribute(tileId) for tileId in [0, 2, 8, 10]])
+        self.assertEqual(table.getGrid()[14][15], a.getAttribute(2))
+        self.assertEqual(len(table.getGrid()), 15)
+        
+        table.fill(1, 0, 2, 2, 0)
+        self.assertEqual(storage[0], 0xC6 & 0xCC)
+        self.assertEqual(storage[1], 0xC6 & 0x33)
+        table.setArea(15, 14, 0x01)
+        a.setAttribute(tileId=2, attr=0x01)
+        self.assertEqual(storage[63], a.getAttributeByte())
+        
+        grid = table.getGrid()
+        table2 = AttributeTable()
+        table2.setRegion(0, 0, grid)
+        self.assertEqual(table2.getGrid(), grid)
+        
 class TestBlock(unittest.TestCase):
     def test_init(self):
         b = Block()
@@ -207,4 +355,30 @@ class TestBlock(unittest.TestCase):
         a.setAttributeByte(0xCA)
         
         b.setTiles(tiles)
-        b.setAttribute(a)
\ No newline at end of file
+        b.setAttribute(a)
+        
+    def test_view(self):
+        from nametable import Nametable
+        n = Nametable()
+        n.fromBytes(bytearray([i%256 for i in range(960)] + [0xC6]*64))
+        b = BlockView(n, 9)
+        self.assertEqual(b.getRowForNametable(0), [132,133,134,135])
+        self.assertEqual([tile.getIndex() for tile in b.getTiles()[4:8]], [164,165,166,167])
+        
+        tiles = []
+        for i in range(4*4):
+            tile = Tile()
+            tile.setIndex(i)
+            tiles.append(tile)
+        b.setTiles(tiles)
+        self.assertEqual(n.getTileIndex(5, 5), 5)
+        
+        a = b.getAttribute()
+        a.setAttribute(tileId=0, attr=0x02)
+        self.assertEqual(n.getAttributeBytes()[9], 0x86)
+        a = Attribute()
+        a.setAttributeByte(0x1B)
+        b.setAttribute(a)
+        self.assertEqual(n.getAttributeBytes()[9], 0x1B)
+        self.assertFalse(b.inBottomRow)
+        self.assertTrue(BlockView(n, 60).inBottomRow)
\ No newline at end of file
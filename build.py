@@ -0,0 +1,386 @@
+"""Batch build of all assets in a directory
+
+    python build.py ASSET_DIR OUTPUT_DIR [-j JOBS] [--compression rle|lzss]
+                    [--metric rgb|weighted|cie] [--palette-time SECONDS]
+                    [--dedupe] [--cache CACHE_DIR | --no-cache]
+
+The asset directory is searched recursively. Every asset is built on
+its own, so the assets are spread over a pool of processes. The outputs
+are written to the same relative path in the output directory, which
+must not be inside the asset directory:
+
+.chr         CHR banks, written as they are. With --dedupe the duplicate
+             tiles are removed, and a .map file tells the new number of
+             every tile of the bank as 16 bit little endian words
+.png .ppm    Images, converted with converter.convertImage to a .chr file
+             with the tiles, a .nam file with the nametables (compressed
+             if a compression is given), a .pal file with the 16 bytes of
+             the palettes and a .asm file with the nametables as .db lines
+.nam         Binary nametables, dumped as .db lines to a .asm file
+
+The outputs keep the name of the asset without its extension, so two
+assets writing the same output, e.g. level.chr and level.png, are
+rejected before anything is built.
+
+Unchanged assets are restored from a build cache instead of being built
+again, see buildcache.py. The cache is kept in .cache in the output
+directory unless another directory is given.
+
+A summary with the time spent on every asset is printed when done."""
+from plotter import TileGroup
+from nametable import dumpNametablesToFile, saveBinaryFile, loadBinaryFile
+from dedupe import dedupeTiles
+from buildcache import BuildCache
+import converter
+import compression
+import profiling
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import tempfile
+import shutil
+import struct
+import traceback
+import unittest
+
+def buildChr(source, outputBase, options):
+    """Write a CHR bank, with the duplicate tiles removed if the
+    dedupe option is set"""
+    tileGroup = TileGroup()
+    tileGroup.loadFromFile(source)
+    output = outputBase + ".chr"
+    if not options['dedupe']:
+        with open(output, "wb") as f:
+            f.write(tileGroup.getBank().getData())
+        return [output]
+    
+    uniqueTileGroup, remap = dedupeTiles(tileGroup)
+    with open(output, "wb") as f:
+        f.write(uniqueTileGroup.getBank().getData())
+    with open(outputBase + ".map", "wb") as f:
+        f.write(struct.pack("<%dH" %(len(remap)), *[tileNr for tileNr, flips in remap]))
+    return [output, outputBase + ".map"]
+
+def buildImage(source, outputBase, options):
+    """Convert an image to tiles, nametables and palettes"""
+    # The palette optimizer runs in this process, as pool workers can
+    # not start processes of their own
+    tileGroup, nametables, palettes = converter.convertImageFile(
+        source, options['metric'], options['paletteTime'], processes=1)
+    name = os.path.basename(outputBase)
+    outputs = [outputBase + extension for extension in (".chr", ".nam", ".pal", ".asm")]
+    with open(outputs[0], "wb") as f:
+        f.write(tileGroup.getBank().getData())
+    saveBinaryFile(outputs[1], nametables, options['compression'])
+    with open(outputs[2], "wb") as f:
+        f.write(bytearray([color for palette in palettes for color in palette.getColors()]))
+    dumpNametablesToFile(outputs[3], _tagNametables(name, nametables))
+    return outputs
+
+def buildNametables(source, outputBase, options):
+    """Dump binary nametables as .db lines"""
+    name = os.path.basename(outputBase)
+    output = outputBase + ".asm"
+    dumpNametablesToFile(output, _tagNametables(name, loadBinaryFile(source)))
+    return [output]
+
+def _tagNametables(name, nametables):
+    """Generator yielding (nametable, ntTag, attrTag) with tags
+    based on the name, numbered if there are several nametables"""
+    name = name.replace("-", "_").replace(".", "_")
+    for i, nametable in enumerate(nametables):
+        suffix = "" if i == 0 else str(i)
+        yield nametable, "%s_nametable%s" %(name, suffix), "%s_attribute%s" %(name, suffix)
+
+TOOL_VERSION = "2"  # Change when the outputs change, to not use cached outputs
+
+BUILDERS = {'.chr':buildChr,
+            '.png':buildImage,
+            '.ppm':buildImage,
+            '.nam':buildNametables,
+            }
+
+# The options used by the builders, which are part of the cache keys
+BUILDER_OPTIONS = {buildChr:['dedupe'],
+                   buildImage:['compression', 'metric', 'paletteTime'],
+                   buildNametables:[],
+                   }
+
+# The extensions of the outputs of the builders
+BUILDER_OUTPUTS = {buildChr:[".chr"],   # And .map with the dedupe option
+                   buildImage:[".chr", ".nam", ".pal", ".asm"],
+                   buildNametables:[".asm"],
+                   }
+
+DEFAULT_OPTIONS = {'compression':None,  # Compression of the .nam files of images
+                   'metric':"rgb",      # Color metric, see colors.NearestColorCube
+                   'paletteTime':None,  # Time budget of the palette optimizer
+                   'dedupe':False,      # Remove the duplicate tiles of CHR banks
+                   }
+
+def findAssets(directory):
+    """Return the paths relative to the directory of all assets
+    that can be built, in sorted order"""
+    assets = []
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            if os.path.splitext(filename)[1].lower() in BUILDERS:
+                assets.append(os.path.relpath(os.path.join(root, filename), directory))
+    return sorted(assets)
+
+def getOutputs(path, options):
+    """Return the paths relative to the output directory of the outputs
+    of building an asset"""
+    builder = BUILDERS[os.path.splitext(path)[1].lower()]
+    extensions = list(BUILDER_OUTPUTS[builder])
+    if builder is buildChr and options['dedupe']:
+        extensions.append(".map")
+    return [os.path.splitext(path)[0] + extension for extension in extensions]
+
+def checkOutputs(assets, options):
+    """Raise an AttributeError if two assets would write the same output,
+    e.g. level.chr and level.png, which both write level.chr"""
+    writers = {}    # Output: asset
+    for path in assets:
+        for output in getOutputs(path, options):
+            other = writers.setdefault(os.path.normcase(output), path)
+            if other != path:
+                raise AttributeError("%s and %s both write %s" %(other, path, output))
+
+def buildAsset(job):
+    """Build one asset. Runs in a worker process.
+    job is (assetDir, relativePath, outputDir, options)
+
+    Returns (relativePath, outputs, seconds, error, cached), where error
+    is None or the traceback of the exception that stopped the build and
+    cached tells if the outputs were restored from the build cache"""
+    assetDir, path, outputDir, options = job
+    start = time.time()
+    outputBase = os.path.join(outputDir, os.path.splitext(path)[0])
+    try:
+        if not os.path.isdir(os.path.dirname(outputBase)):
+            os.makedirs(os.path.dirname(outputBase))
+        builder = BUILDERS[os.path.splitext(path)[1].lower()]
+        outputs = builder(os.path.join(assetDir, path), outputBase, options)
+        error = None
+    except Exception:
+        outputs = []
+        error = traceback.format_exc()
+    return path, outputs, time.time()-start, error, False
+
+def buildAll(assetDir, outputDir, options=None, processes=None, assets=None, cacheDir=None):
+    """Build the assets of a directory, see buildAsset. All assets are
+    built unless a list of relative paths is given.
+
+    With a cache directory, assets which have been built before with the
+    same contents and options are restored from the cache, see 
+    buildcache.BuildCache. The other assets are built by a pool with the 
+    given number of processes, one per core if None. With one process 
+    everything is built in this process. Returns the results of 
+    buildAsset, in the order of the assets"""
+    # The outputs would be found as assets by the next build
+    assetPath = os.path.join(os.path.realpath(assetDir), "")
+    if os.path.join(os.path.realpath(outputDir), "").startswith(assetPath):
+        raise AttributeError("The output directory must not be inside the asset directory")
+    settings = dict(DEFAULT_OPTIONS)
+    settings.update(options or {})
+    if assets is None:
+        assets = findAssets(assetDir)
+    checkOutputs(assets, settings)
+    cache = None
+    if cacheDir is not None:
+        cache = BuildCache(cacheDir, TOOL_VERSION)
+
+    results = [None]*len(assets)
+    keys = {}   # Asset number: cache key
+    for i, path in enumerate(assets):
+        if cache is not None:
+            start = time.time()
+            builder = BUILDERS[os.path.splitext(path)[1].lower()]
+            keys[i] = cache.getKey(path, [os.path.join(assetDir, path)],
+                                   dict([(name, settings[name]) for name in BUILDER_OPTIONS[builder]]))
+            outputs = cache.restore(keys[i], outputDir)
+            if outputs is not None:
+                results[i] = (path, outputs, time.time()-start, None, True)
+    missing = [i for i, result in enumerate(results) if result is None]
+    built = _runJobs([(assetDir, assets[i], outputDir, settings) for i in missing], processes)
+    for i, result in zip(missing, built):
+        results[i] = result
+        if cache is not None and result[3] is None:
+            cache.store(keys[i], outputDir, result[1], [os.path.join(assetDir, assets[i])])
+    if cache is not None:
+        cache.save()
+        cache.evict()
+    return results
+
+def _runJobs(jobs, processes):
+    """Run buildAsset for the jobs, in a pool unless there is only one 
+    process or job. Returns the results in the order of the jobs"""
+    if processes == 1 or len(jobs) <= 1:
+        return [buildAsset(job) for job in jobs]
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Build the largest assets first to keep all processes busy to the end
+        order = sorted(range(len(jobs)), 
+                       key=lambda i: -os.path.getsize(os.path.join(jobs[i][0], jobs[i][1])))
+        if profiling.isEnabled():
+            results = []
+            for result, profile in pool.map(_buildAssetProfiled, [jobs[i] for i in order], chunksize=1):
+                profiling.addProfile(profile)
+                results.append(result)
+        else:
+            results = pool.map(buildAsset, [jobs[i] for i in order], chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+    return [result for i, result in sorted(zip(order, results))]
+
+def _buildAssetProfiled(job):
+    """Build one asset in a worker process of a profiled build.
+    Returns the result of buildAsset and the profile of the build"""
+    return profiling.profileCall(buildAsset, job)
+
+def writeSummary(results, totalSeconds, out=sys.stdout):
+    """Write the time spent on every asset and the total"""
+    width = max([result[0] for result in results] + ["Total"], key=len)
+    width = len(width)
+    for path, outputs, seconds, error, cached in results:
+        if error:
+            status = "FAILED"
+        else:
+            status = "%d outputs%s" %(len(outputs), " (cached)" if cached else "")
+        out.write("%-*s %8.3f s  %s\n" %(width, path, seconds, status))
+    failed = [result for result in results if result[3]]
+    for path, outputs, seconds, error, cached in failed:
+        out.write("\n%s:\n%s" %(path, error))
+    out.write("%-*s %8.3f s  %d assets, %d cached, %d failed, %.3f s of work\n"
+              %(width, "Total", totalSeconds, len(results), 
+                len([result for result in results if result[4]]), len(failed),
+                sum([result[2] for result in results])))
+
+def main(argv=None):
+    """Run the build from the command line. Returns the exit status"""
+    parser = argparse.ArgumentParser(description="Build all CHR banks, images and nametables "
+                                     "of an asset directory")
+    parser.add_argument("assetDir", help="the directory with the assets")
+    parser.add_argument("outputDir", help="the directory to write the outputs to")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="the number of processes (default: one per core)")
+    parser.add_argument("--compression", choices=compression.CODECS, default=None,
+                        help="compress the nametables of images")
+    parser.add_argument("--metric", choices=["rgb", "weighted", "cie"], default="rgb",
+                        help="the color metric used for images")
+    parser.add_argument("--palette-time", type=float, default=None, dest="paletteTime", metavar="SECONDS",
+                        help="seconds to spend optimizing the palettes of every image")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="remove duplicate tiles from CHR banks, writing the new tile numbers to .map files")
+    parser.add_argument("--cache", default=None, metavar="CACHE_DIR",
+                        help="the build cache directory (default: OUTPUT_DIR/.cache)")
+    parser.add_argument("--no-cache", action="store_true", dest="noCache",
+                        help="build all assets without a build cache")
+    args = parser.parse_args(argv)
+    profiling.enableFromEnvironment()
+
+    options = {'compression':args.compression, 'metric':args.metric,
+               'paletteTime':args.paletteTime, 'dedupe':args.dedupe}
+    cacheDir = args.cache
+    if cacheDir is None and not args.noCache:
+        cacheDir = os.path.join(args.outputDir, ".cache")
+    start = time.time()
+    results = buildAll(args.assetDir, args.outputDir, options, args.jobs, cacheDir=cacheDir)
+    writeSummary(results, time.time()-start)
+    return 1 if [result for result in results if result[3]] else 0
+
+# *************** Unit tests ***********
+class TestBuild(unittest.TestCase):
+    def setUp(self):
+        import image
+        import constants
+        self.tempDir = tempfile.mkdtemp()
+        self.assetDir = os.path.join(self.tempDir, "assets")
+        self.outputDir = os.path.join(self.tempDir, "out")
+        os.makedirs(os.path.join(self.assetDir, "levels"))
+        with open(os.path.join(self.assetDir, "font.chr"), "wb") as f:
+            f.write(bytearray(16) + bytearray(range(16)) + bytearray(16))
+        indexes = bytearray([0x0F, 0x16][(x//8)%2] for y in range(240) for x in range(256))
+        image.savePNG(os.path.join(self.assetDir, "levels", "level1.png"), 256, 240,
+                      indexes, constants.PALETTE)
+        with open(os.path.join(self.assetDir, "title.nam"), "wb") as f:
+            f.write(bytearray(1024)*2)
+        with open(os.path.join(self.assetDir, "broken.ppm"), "wb") as f:
+            f.write(b"P6\n1 1\n255\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_build(self):
+        self.assertEqual(findAssets(self.assetDir),
+                         ["broken.ppm", "font.chr", os.path.join("levels", "level1.png"),
+                          "title.nam"])
+        for processes in (1, 2):
+            results = buildAll(self.assetDir, self.outputDir, {'compression':"lzss"}, processes)
+            self.assertEqual([result[0] for result in results], findAssets(self.assetDir))
+            self.assertTrue(results[0][3] is not None)
+            for path, outputs, seconds, error, cached in results[1:]:
+                self.assertEqual(error, None)
+                self.assertFalse(cached)
+                for output in outputs:
+                    self.assertTrue(os.path.isfile(output))
+
+        self.assertEqual(os.path.getsize(os.path.join(self.outputDir, "font.chr")), 48)
+        self.assertEqual(os.path.getsize(os.path.join(self.outputDir, "levels", "level1.pal")), 16)
+        with open(os.path.join(self.outputDir, "title.asm")) as f:
+            dump = f.read()
+        self.assertTrue("title_nametable1:" in dump)
+
+    def test_sameStem(self):
+        levels = os.path.join(self.assetDir, "levels")
+        shutil.copy(os.path.join(self.assetDir, "font.chr"), os.path.join(levels, "level.chr"))
+        shutil.copy(os.path.join(self.assetDir, "title.nam"), os.path.join(levels, "level.nam"))
+        buildAll(self.assetDir, self.outputDir, processes=1)  # Different outputs
+        shutil.copy(os.path.join(levels, "level1.png"), os.path.join(levels, "level.png"))
+        self.assertRaises(AttributeError, buildAll, self.assetDir, self.outputDir, None, 2)
+        try:
+            checkOutputs(["level.nam", "level.png"], DEFAULT_OPTIONS)
+            self.fail()
+        except AttributeError as error:
+            self.assertEqual(str(error), "level.nam and level.png both write level.asm")
+        self.assertRaises(AttributeError, checkOutputs, ["level.chr", "level.png"], DEFAULT_OPTIONS)
+
+    def test_dedupe(self):
+        results = buildAll(self.assetDir, self.outputDir, {'dedupe':True}, 1, ["font.chr"])
+        self.assertEqual(results[0][1], [os.path.join(self.outputDir, name) for name in ("font.chr", "font.map")])
+        self.assertEqual(os.path.getsize(results[0][1][0]), 32)
+        with open(results[0][1][1], "rb") as f:
+            self.assertEqual(f.read(), b"\x00\x00\x01\x00\x00\x00")
+        self.assertRaises(AttributeError, buildAll, self.assetDir, os.path.join(self.assetDir, "out"))
+        self.assertRaises(AttributeError, buildAll, self.assetDir, self.assetDir)
+        
+    def test_cache(self):
+        cacheDir = os.path.join(self.tempDir, "cache")
+        results = buildAll(self.assetDir, self.outputDir, processes=1, cacheDir=cacheDir)
+        self.assertEqual([result[4] for result in results], [False]*4)
+        os.remove(os.path.join(self.outputDir, "title.asm"))
+        results = buildAll(self.assetDir, self.outputDir, processes=1, cacheDir=cacheDir)
+        # The broken asset is built again, the others are restored
+        self.assertEqual([result[4] for result in results], [False, True, True, True])
+        self.assertTrue(os.path.isfile(os.path.join(self.outputDir, "title.asm")))
+        
+        results = buildAll(self.assetDir, self.outputDir, {'compression':"rle"}, 1,
+                           cacheDir=cacheDir)
+        self.assertEqual([result[4] for result in results], [False, True, False, True])
+
+    def test_summary(self):
+        import StringIO
+        out = StringIO.StringIO()
+        writeSummary([("a.chr", ["a.chr"], 0.5, None, True),
+                      ("b.png", [], 0.25, "Traceback\n", False)], 0.6, out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "a.chr    0.500 s  1 outputs (cached)")
+        self.assertEqual(lines[1], "b.png    0.250 s  FAILED")
+        self.assertTrue(lines[-1].startswith("Total    0.600 s  2 assets, 1 cached, 1 failed"))
+
+if __name__ == "__main__":
+    sys.exit(main())
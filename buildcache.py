@@ -0,0 +1,265 @@
+"""An on-disk cache of built assets, see build.py
+
+Every build of an asset gets a key, which is the hash of the tool
+version, the name of the asset, the build options and the contents of
+the input files. When an asset is built, its outputs are copied to the
+cache and a manifest is written, listing the inputs and the hash of
+every output. When the key is found again, the outputs are restored
+from the cache instead of being built, and outputs that are already
+up to date are left alone.
+
+Files are hashed with SHA-1. The size and modification time of every
+hashed file is recorded, so a file which has not been touched since
+the last build is not read again. This makes a rebuild without changes
+cost a few stat calls per asset.
+
+The cache directory holds:
+objects/     The outputs, named by their hash
+manifests/   One manifest per key, in JSON
+stats.json   Size, modification time and hash of the hashed files
+
+The size of the cache is bounded. The least recently used manifests
+are removed first, followed by the outputs no manifest refers to."""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+class BuildCache:
+    """A content-hash cache of build outputs"""
+    def __init__(self, directory, toolVersion, maxBytes=256*1024*1024):
+        """Init
+        directory    The cache directory, created if needed
+        toolVersion  A string which is part of every key, so that a new
+                     version of the tool does not use old outputs
+        maxBytes     The size the cache is reduced to by evict"""
+        self._directory = directory
+        self._toolVersion = toolVersion
+        self._maxBytes = maxBytes
+        self._stats = {}    # Absolute path: [size, mtime, hash]
+        self._hits = 0
+        self._misses = 0
+        for subdirectory in ("objects", "manifests"):
+            path = os.path.join(directory, subdirectory)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        try:
+            with open(self._getStatsFilename()) as f:
+                self._stats = json.load(f)
+        except (IOError, ValueError):
+            pass    # A missing or broken stats file only costs hashing
+
+    def hashFile(self, path):
+        """Return the SHA-1 hash of a file. The file is only read if
+        its size or modification time has changed since it was last hashed"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        recorded = self._stats.get(path)
+        if recorded is not None and recorded[0] == stat.st_size and recorded[1] == stat.st_mtime:
+            return recorded[2]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024*1024), b""):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+        self._stats[path] = [stat.st_size, stat.st_mtime, digest]
+        return digest
+
+    def getKey(self, name, inputs, options):
+        """Return the key of building the asset with the given name from
+        the input files with the given options (a dict)"""
+        description = [self._toolVersion, name, sorted(options.items()),
+                       [self.hashFile(path) for path in inputs]]
+        return hashlib.sha1(json.dumps(description).encode("utf-8")).hexdigest()
+
+    def restore(self, key, outputDir):
+        """Restore the outputs of a key to the output directory.
+        Returns the paths of the outputs, or None if the key is not cached"""
+        manifest = self._loadManifest(key)
+        if manifest is None:
+            self._misses += 1
+            return None
+        outputs = []
+        for relativePath, digest in sorted(manifest['outputs'].items()):
+            output = os.path.join(outputDir, relativePath)
+            if not os.path.isfile(output) or self.hashFile(output) != digest:
+                if not os.path.isfile(self._getObjectFilename(digest)):
+                    self._misses += 1
+                    return None
+                directory = os.path.dirname(output)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                shutil.copyfile(self._getObjectFilename(digest), output)
+                self.hashFile(output)
+            outputs.append(output)
+        # The modification time of the manifest tells when it was last used
+        os.utime(self._getManifestFilename(key), None)
+        self._hits += 1
+        return outputs
+
+    def store(self, key, outputDir, outputs, inputs=()):
+        """Copy the outputs (paths in the output directory) to the cache and
+        write the manifest of the key, recording the inputs as dependencies"""
+        manifest = {'toolVersion':self._toolVersion,
+                    'inputs':dict([(path, self.hashFile(path)) for path in inputs]),
+                    'outputs':{},
+                    }
+        for output in outputs:
+            digest = self.hashFile(output)
+            objectFilename = self._getObjectFilename(digest)
+            if not os.path.isfile(objectFilename):
+                with open(output, "rb") as f:
+                    self._writeFile(objectFilename, f.read())
+            manifest['outputs'][os.path.relpath(output, outputDir)] = digest
+        self._writeFile(self._getManifestFilename(key), json.dumps(manifest, indent=1, sort_keys=True))
+
+    def save(self):
+        """Save the recorded stats of the hashed files, leaving out
+        files which no longer exist"""
+        self._stats = dict([(path, recorded) for path, recorded in self._stats.items()
+                            if os.path.isfile(path)])
+        self._writeFile(self._getStatsFilename(), json.dumps(self._stats))
+
+    def evict(self):
+        """Remove the least recently used manifests until the cache fits
+        in maxBytes, then the outputs no manifest refers to.
+        Returns the number of removed manifests"""
+        manifestDir = os.path.join(self._directory, "manifests")
+        manifests = []
+        for filename in os.listdir(manifestDir):
+            path = os.path.join(manifestDir, filename)
+            manifests.append((os.path.getmtime(path), path))
+        manifests.sort()
+
+        objectSizes = {}
+        for root, dirs, files in os.walk(os.path.join(self._directory, "objects")):
+            for filename in files:
+                objectSizes[filename] = os.path.getsize(os.path.join(root, filename))
+
+        # The size of a manifest includes the outputs it is the only user of
+        users = {}
+        loaded = []
+        for mtime, path in manifests:
+            with open(path) as f:
+                digests = set(json.load(f)['outputs'].values())
+            loaded.append((path, digests))
+            for digest in digests:
+                users[digest] = users.get(digest, 0) + 1
+        total = sum(objectSizes.values()) + sum([os.path.getsize(path) for mtime, path in manifests])
+
+        removed = 0
+        for path, digests in loaded:
+            if total <= self._maxBytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+            removed += 1
+            for digest in digests:
+                users[digest] -= 1
+                if users[digest] == 0:
+                    total -= objectSizes.get(digest, 0)
+        for digest in objectSizes:
+            if not users.get(digest):
+                os.remove(self._getObjectFilename(digest))
+        return removed
+
+    def getStats(self):
+        """Return a dict with the number of hits and misses"""
+        return {'hits':self._hits, 'misses':self._misses}
+
+    def _loadManifest(self, key):
+        """Return the manifest of a key, or None"""
+        try:
+            with open(self._getManifestFilename(key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _getManifestFilename(self, key):
+        return os.path.join(self._directory, "manifests", key + ".json")
+
+    def _getObjectFilename(self, digest):
+        return os.path.join(self._directory, "objects", digest[:2], digest)
+
+    def _getStatsFilename(self):
+        return os.path.join(self._directory, "stats.json")
+
+    def _writeFile(self, filename, data):
+        """Write a file through a temporary file, so that a half
+        written file is never read"""
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tempFilename = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tempFilename, filename)
+
+# *************** Unit tests ***********
+class TestBuildCache(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.tempDir, "cache")
+        self.outputDir = os.path.join(self.tempDir, "out")
+        os.makedirs(self.outputDir)
+        self.input = os.path.join(self.tempDir, "input.chr")
+        with open(self.input, "wb") as f:
+            f.write(b"tiles")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def writeOutput(self, name, data):
+        output = os.path.join(self.outputDir, name)
+        with open(output, "wb") as f:
+            f.write(data)
+        return output
+
+    def test_restore(self):
+        cache = BuildCache(self.cacheDir, "1")
+        key = cache.getKey("input.chr", [self.input], {'compression':None})
+        self.assertEqual(cache.restore(key, self.outputDir), None)
+        output = self.writeOutput("input.asm", b"output")
+        cache.store(key, self.outputDir, [output], [self.input])
+        cache.save()
+
+        # A new cache finds the key, and restores a changed output
+        cache = BuildCache(self.cacheDir, "1")
+        self.assertEqual(cache.getKey("input.chr", [self.input], {'compression':None}), key)
+        self.writeOutput("input.asm", b"changed")
+        os.utime(output, (time.time()+10, time.time()+10))
+        self.assertEqual(cache.restore(key, self.outputDir), [output])
+        with open(output, "rb") as f:
+            self.assertEqual(f.read(), b"output")
+        os.remove(output)
+        self.assertEqual(cache.restore(key, self.outputDir), [output])
+        self.assertEqual(cache.getStats(), {'hits':2, 'misses':0})
+
+        # The options, the version and the input are part of the key
+        self.assertNotEqual(cache.getKey("input.chr", [self.input], {'compression':"rle"}), key)
+        self.assertNotEqual(BuildCache(self.cacheDir, "2").getKey("input.chr", [self.input],
+                                                                  {'compression':None}), key)
+        with open(self.input, "wb") as f:
+            f.write(b"other tiles")
+        self.assertNotEqual(cache.getKey("input.chr", [self.input], {'compression':None}), key)
+
+    def test_evict(self):
+        cache = BuildCache(self.cacheDir, "1", maxBytes=2500)
+        keys = []
+        for i in range(4):
+            key = "%040d" %(i)
+            output = self.writeOutput("output%d" %(i), bytes(bytearray([i]))*1000)
+            cache.store(key, self.outputDir, [output])
+            os.utime(cache._getManifestFilename(key), (1000+i, 1000+i))
+            keys.append(key)
+        os.utime(cache._getManifestFilename(keys[0]), None)    # Recently used
+        self.assertEqual(cache.evict(), 2)
+        self.assertTrue(cache.restore(keys[0], self.outputDir) is not None)
+        self.assertEqual(cache.restore(keys[1], self.outputDir), None)
+        self.assertEqual(cache.restore(keys[2], self.outputDir), None)
+        self.assertTrue(cache.restore(keys[3], self.outputDir) is not None)
+        self.assertEqual(len([name for root, dirs, files in os.walk(os.path.join(self.cacheDir, "objects"))
+                              for name in files]), 2)
@@ -1,5 +1,12 @@
 import Tkinter as tk
 import constants
+import os
+import zlib
+import tempfile
+import shutil
+import unittest
+
+CANONICAL_BLACK = 0x0F  # Used for all the duplicate blacks of the palette
         
 class Color():
     """Containing methods for handling a color"""
@@ -24,6 +31,170 @@ def importColors():
     for color in constants.PALETTE:
         colors.append(Color(color))
     return colors
+
+def _createCanonicalIndexes():
+    """Return the canonical index of every palette index. Colors which
+    are found several times in the palette are mapped to their first
+    index, except black which is mapped to CANONICAL_BLACK"""
+    canonical = []
+    for color in constants.PALETTE:
+        if color == constants.PALETTE[CANONICAL_BLACK]:
+            canonical.append(CANONICAL_BLACK)
+        else:
+            canonical.append(constants.PALETTE.index(color))
+    return canonical
+
+_CANONICAL_INDEXES = _createCanonicalIndexes()
+
+def canonicalColorIndex(index):
+    """Return the canonical palette index for a color, see
+    _createCanonicalIndexes. $0D-$0F, $1D etc all become $0F"""
+    return _CANONICAL_INDEXES[index]
+
+def _toLab(rgb):
+    """Convert an sRGB color to CIE L*a*b* (D65)"""
+    linear = []
+    for value in rgb:
+        value = value/255.0
+        if value <= 0.04045:
+            linear.append(value/12.92)
+        else:
+            linear.append(((value+0.055)/1.055)**2.4)
+    r, g, b = linear
+    xyz = ((0.4124*r + 0.3576*g + 0.1805*b)/0.95047,
+           (0.2126*r + 0.7152*g + 0.0722*b)/1.0,
+           (0.0193*r + 0.1192*g + 0.9505*b)/1.08883)
+    f = [value**(1/3.0) if value > 0.008856 else 7.787*value + 16/116.0 for value in xyz]
+    return (116*f[1]-16, 500*(f[0]-f[1]), 200*(f[1]-f[2]))
+
+# The color spaces in which the distance between colors is measured
+_METRICS = {'rgb':lambda rgb: tuple(rgb),
+            'weighted':lambda rgb: (rgb[0]*2**0.5, rgb[1]*2.0, rgb[2]*3**0.5), # 2*dR^2+4*dG^2+3*dB^2
+            'cie':_toLab,
+            }
+
+class NearestColorCube:
+    """Maps any RGB color to the index of the nearest color in 
+    constants.PALETTE, using a lookup cube.
+    
+    The RGB space is divided in (2**bits)**3 cells, and the nearest
+    palette color is stored for the center of each cell. Colors which
+    are exactly found in the palette are always mapped to themselves.
+    The returned indexes are canonical, see canonicalColorIndex.
+    
+    Building the cube takes a moment, so it is stored in cacheDir and
+    loaded from there the next time. The distance between colors is
+    measured with the metric "rgb", "weighted" (RGB with weights 2, 4, 3)
+    or "cie" (CIE76, the distance in L*a*b*)"""
+    def __init__(self, metric="rgb", bits=5, cacheDir=None):
+        """Init"""
+        if metric not in _METRICS:
+            raise AttributeError("Unknown metric: %s" %(metric))
+        self._metric = metric
+        self._bits = bits
+        self._cacheDir = cacheDir
+        if self._cacheDir is None:
+            self._cacheDir = os.path.join(os.path.expanduser("~"), ".cache", "nes_tools_py")
+        self._exact = {} # Exact palette colors as three byte strings: index
+        for index, color in enumerate(constants.PALETTE):
+            self._exact.setdefault(bytes(bytearray(color)), canonicalColorIndex(index))
+        self._cube = self._loadCube()
+        
+    def getCube(self):
+        """Return the cube as a string with one palette index per cell,
+        indexed as (r>>shift)<<(2*bits) | (g>>shift)<<bits | (b>>shift)"""
+        return self._cube
+    
+    def lookup(self, rgb):
+        """Return the index of the nearest palette color"""
+        rgb = bytes(bytearray(rgb))
+        index = self._exact.get(rgb)
+        if index is None:
+            shift = 8-self._bits
+            r, g, b = bytearray(rgb)
+            index = ord(self._cube[((r>>shift)<<(2*self._bits)) | ((g>>shift)<<self._bits) | (b>>shift)])
+        return index
+    
+    def lookupBuffer(self, rgb):
+        """Map RGB data (three bytes per pixel) to palette indexes.
+        Returns a string with one palette index per pixel"""
+        rgb = bytes(rgb)
+        nearest = _LookupMemo(self)
+        return bytes(bytearray([nearest[rgb[i:i+3]] for i in range(0, len(rgb), 3)]))
+    
+    def _getCacheFilename(self):
+        """Return the name of the cache file, which depends on the palette"""
+        paletteHash = zlib.crc32(repr(constants.PALETTE)) & 0xFFFFFFFF
+        return os.path.join(self._cacheDir, "nearest_%s_%d_%08X.bin" %(self._metric, self._bits, paletteHash))
+    
+    def _loadCube(self):
+        """Load the cube from the cache directory, or build and save it"""
+        filename = self._getCacheFilename()
+        nCells = 1<<(3*self._bits)
+        try:
+            with open(filename, "rb") as f:
+                cube = f.read()
+            if len(cube) == nCells:
+                return cube
+        except IOError:
+            pass
+        cube = self._buildCube()
+        try:
+            if not os.path.isdir(self._cacheDir):
+                os.makedirs(self._cacheDir)
+            # Write to a temporary file first, so that a half written
+            # cube is never loaded
+            fd, tempFilename = tempfile.mkstemp(dir=self._cacheDir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(cube)
+            os.rename(tempFilename, filename)
+        except (IOError, OSError):
+            pass # The cube is still used, just not cached
+        return cube
+    
+    def _buildCube(self):
+        """Find the nearest palette color for the center of every cell"""
+        toSpace = _METRICS[self._metric]
+        indexes = sorted(set(_CANONICAL_INDEXES))
+        candidates = [toSpace(constants.PALETTE[index]) for index in indexes]
+        size = 1<<self._bits
+        shift = 8-self._bits
+        centers = [(value<<shift) + (1<<shift)//2 for value in range(size)]
+        cube = bytearray()
+        for r in centers:
+            for g in centers:
+                for b in centers:
+                    x, y, z = toSpace((r, g, b))
+                    distances = [(x-cx)**2 + (y-cy)**2 + (z-cz)**2 for cx, cy, cz in candidates]
+                    cube.append(indexes[distances.index(min(distances))])
+        return bytes(cube)
+    
+class _LookupMemo(dict):
+    """A dict from three byte RGB strings to palette indexes,
+    filled in from a NearestColorCube on lookup"""
+    def __init__(self, cube):
+        dict.__init__(self)
+        self._cube = cube
+        
+    def __missing__(self, rgb):
+        index = self._cube.lookup(rgb)
+        self[rgb] = index
+        return index
+
+_nearestColorCubes = {}
+
+def getNearestColorCube(metric="rgb"):
+    """Return a shared NearestColorCube for the metric, which is
+    created on first use"""
+    cube = _nearestColorCubes.get(metric)
+    if cube is None:
+        cube = NearestColorCube(metric)
+        _nearestColorCubes[metric] = cube
+    return cube
+
+def nearestColorIndex(rgb, metric="rgb"):
+    """Return the index of the palette color nearest to an RGB color"""
+    return getNearestColorCube(metric).lookup(rgb)
     
     
 class ColorPicker():
@@ -105,4 +276,35 @@ class ColorPicker():
             # Communicate the colors to the plotter window
             self.plotterCanvas.setFgBgColors(self._fgColor, self._bgColor)
             self.drawFgBgColors()
-     
\ No newline at end of file
+
+# *************** Unit tests ***********
+class TestNearestColorCube(unittest.TestCase):
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
+        
+    def test_canonical(self):
+        self.assertEqual(canonicalColorIndex(0x0D), CANONICAL_BLACK)
+        self.assertEqual(canonicalColorIndex(0x1F), CANONICAL_BLACK)
+        self.assertEqual(canonicalColorIndex(0x20), 0x20)
+        
+    def test_lookup(self):
+        for metric in ("rgb", "weighted", "cie"):
+            cube = NearestColorCube(metric, bits=3, cacheDir=self.cacheDir)
+            self.assertEqual(len(cube.getCube()), 8**3)
+            for index, color in enumerate(constants.PALETTE):
+                self.assertEqual(cube.lookup(color), canonicalColorIndex(index))
+            self.assertEqual(cube.lookup([250, 2, 3]), 0x16)
+            self.assertEqual(cube.lookupBuffer(b"\x00\x00\x01\xF8\xF8\xF8\x00\x00\x01"),
+                             b"\x0F\x20\x0F")
+            
+    def test_cache(self):
+        cube = NearestColorCube("rgb", bits=3, cacheDir=self.cacheDir)
+        self.assertEqual(len(os.listdir(self.cacheDir)), 1)
+        filename = os.path.join(self.cacheDir, os.listdir(self.cacheDir)[0])
+        with open(filename, "wb") as f:
+            f.write(b"\x01"*8**3)
+        cube = NearestColorCube("rgb", bits=3, cacheDir=self.cacheDir)
+        self.assertEqual(cube.lookup([1, 2, 3]), 0x01) # Loaded from the cache file
@@ -0,0 +1,161 @@
+from plotter import Palette, TileGroup
+from nametable import Nametable
+import constants
+import image
+import os
+import unittest
+
+class Compositor:
+    """Renders nametables to an indexed framebuffer without Tkinter,
+    like the PPU does for the background.
+
+    The framebuffer is a bytearray of 256x240 bytes, row by row, where
+    every byte is an index into constants.PALETTE. Color 0 of the
+    first palette is used as the common background color for all
+    four palettes, as on the NES.
+
+    Every row of every tile is expanded to palette indexes once for
+    each of the four palettes. Rendering a nametable then only joins
+    precomputed rows. The expanded rows are made again when the tiles
+    or palettes have been modified since, which is checked through their
+    versions, so a compositor registers no listeners and is freed as
+    soon as it is no longer used"""
+    WIDTH = 256
+    HEIGHT = 240
+
+    def __init__(self, tileGroup, palettes):
+        """Init
+        tileGroup    The tiles referenced by the nametables
+        palettes     A list of four Palette objects with colors that
+                     are indexes into constants.PALETTE"""
+        self._tileGroup = tileGroup
+        self._palettes = None
+        self._tileRows = None   # _tileRows[palette][tileIndex] is a list of 8 rows
+        self._tileRowsVersion = None    # The versions of the bank and palettes of _tileRows
+        self.setPalettes(palettes)
+
+    def setPalettes(self, palettes):
+        """Set the four palettes"""
+        assert(len(palettes) == 4)
+        self._palettes = palettes
+        self._tileRows = None
+
+    def render(self, nametable):
+        """Render a nametable and return the framebuffer"""
+        tileRows = self._getTileRows()
+        tileIndexes = nametable.getTileIndexes()
+        areaPalettes = nametable.getAttributes().getGrid()
+        nTilesX = self.WIDTH//8
+
+        lines = []
+        for tileY in range(self.HEIGHT//8):
+            palettes = areaPalettes[tileY//2]
+            rowTiles = []
+            for tileX in range(nTilesX):
+                rowTiles.append(tileRows[palettes[tileX//2]][tileIndexes[tileY*nTilesX + tileX]])
+            for y in range(8):
+                lines.append(b"".join([rows[y] for rows in rowTiles]))
+        return bytearray(b"".join(lines))
+
+    def toRGB(self, framebuffer):
+        """Convert a framebuffer to RGB data"""
+        return image.indexedToRGB(framebuffer, constants.PALETTE)
+
+    def saveImage(self, nametable, filename):
+        """Render a nametable and save it as PPM or PNG, depending on the
+        file extension (.ppm or .png)"""
+        framebuffer = self.render(nametable)
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == ".png":
+            image.savePNG(filename, self.WIDTH, self.HEIGHT, framebuffer, constants.PALETTE)
+        elif extension == ".ppm":
+            image.savePPM(filename, self.WIDTH, self.HEIGHT, self.toRGB(framebuffer))
+        else:
+            raise AttributeError("Unknown image format: %s" %(extension))
+
+    def _getTileRows(self):
+        """Return the expanded tile rows, creating them if needed"""
+        bank = self._tileGroup.getBank()
+        version = (bank, bank.getVersion(), [palette.getVersion() for palette in self._palettes])
+        if self._tileRows is None or version != self._tileRowsVersion:
+            self._tileRowsVersion = version
+            pixels = bytes(self._tileGroup.decodeAll())
+            backgroundColor = self._palettes[0].getColor(0)
+            self._tileRows = []
+            for palette in self._palettes:
+                colors = [backgroundColor] + list(palette.getColors()[1:4])
+                translation = bytes(bytearray(colors + [0]*252))
+                expanded = pixels.translate(translation)
+                self._tileRows.append([[expanded[start:start+8] for start in range(tileStart, tileStart+64, 8)]
+                                       for tileStart in range(0, len(expanded), 64)])
+        return self._tileRows
+
+# *************** Unit tests ***********
+class TestCompositor(unittest.TestCase):
+    def setUp(self):
+        from block import Block, Attribute
+        from plotter import Tile
+        # Tile 0 is empty, tile 1 has pixel value 1 in its first row
+        # and pixel value 3 in the other rows
+        self.tileGroup = TileGroup()
+        self.tileGroup.loadFromPixels([0]*64 + [1]*8 + [3]*56)
+        self.palettes = []
+        for i in range(4):
+            palette = Palette()
+            palette.setColors([0x0F+i, 0x10+i, 0x20+i, 0x30+i])
+            self.palettes.append(palette)
+
+        # Only the top left tile of each block is tile 1
+        tiles = []
+        for i in range(16):
+            tile = Tile()
+            tile.setIndex(1 if i == 0 else 0)
+            tiles.append(tile)
+        blocks = []
+        for i in range(64):
+            block = Block()
+            attribute = Attribute()
+            attribute.setAttributeByte(0x40)   # Top left subblock uses palette 1
+            block.setTiles(tiles)
+            block.setAttribute(attribute)
+            if i>=(8*7):
+                block.isInBottomRow()
+            blocks.append(block)
+        self.nametable = Nametable()
+        self.nametable.setBlocks(blocks)
+
+    def test_render(self):
+        compositor = Compositor(self.tileGroup, self.palettes)
+        framebuffer = compositor.render(self.nametable)
+        self.assertEqual(len(framebuffer), 256*240)
+        self.assertEqual(framebuffer[:8], bytearray([0x11]*8))
+        self.assertEqual(framebuffer[8:32], bytearray([0x0F]*24))
+        self.assertEqual(framebuffer[32:40], bytearray([0x11]*8))  # Next block
+        self.assertEqual(framebuffer[256:264], bytearray([0x31]*8))
+        self.assertEqual(framebuffer[256*224:256*224+8], bytearray([0x11]*8)) # Bottom row of blocks
+
+        # Changing the palette and the tiles is picked up
+        self.palettes[1].setColors([0x0F, 0x16, 0x26, 0x36])
+        self.tileGroup.getTile(1).setData([[2]*8]*8)
+        framebuffer = compositor.render(self.nametable)
+        self.assertEqual(framebuffer[:8], bytearray([0x26]*8))
+        
+        # So is a new bank
+        self.tileGroup.loadFromBytes(bytearray(16*16))
+        framebuffer = compositor.render(self.nametable)
+        self.assertEqual(framebuffer[:8], bytearray([0x0F]*8))
+
+    def test_noListeners(self):
+        """A compositor is freed when no longer used"""
+        import weakref
+        compositor = Compositor(self.tileGroup, self.palettes)
+        compositor.render(self.nametable)
+        reference = weakref.ref(compositor)
+        del compositor
+        self.assertEqual(reference(), None)
+
+    def test_toRGB(self):
+        compositor = Compositor(self.tileGroup, self.palettes)
+        rgb = compositor.toRGB(compositor.render(self.nametable))
+        self.assertEqual(len(rgb), 256*240*3)
+        self.assertEqual(bytearray(rgb[:3]), bytearray(constants.PALETTE[0x11]))
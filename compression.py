@@ -0,0 +1,290 @@
+"""Compression of nametables and other binary data for the NES
+
+Two codecs are available:
+"rle"   The RLE format of Shiru's NES Screen Tool, decoded by vram_unrle
+        in neslib. The first byte is a tag byte which is not used in the
+        data. Every other byte is written as is, except that the tag
+        followed by a count N (1-255) repeats the previous byte N times
+        and the tag followed by 0 ends the data.
+"lzss"  A simple LZSS variant. A control byte holds flags for the next
+        eight items, least significant bit first. A 0 flag is a literal
+        byte. A 1 flag is a match: a length byte L and a distance byte D,
+        copying L+2 bytes (3-257) from D+1 bytes back (1-256) in the
+        output. A 1 flag followed by a length byte of 0 ends the data.
+
+The decode cost on the 6502 side is estimated in CPU cycles using a
+simple cost model per decoded item, see RLE_CYCLES and LZSS_CYCLES."""
+import unittest
+
+CODECS = ("rle", "lzss")
+
+# Estimated cycles of vram_unrle in neslib, writing to PPU_DATA
+RLE_CYCLES = {'setup':30,      # Read the tag byte
+              'literal':25,    # Read, compare and write one byte
+              'run':33,        # Read tag and count
+              'runByte':9,     # Write one repeated byte
+              'end':30,        # Read tag and the final 0
+              }
+
+# Estimated cycles of an LZSS decoder writing to a RAM buffer
+LZSS_CYCLES = {'setup':30,
+               'control':20,   # Read a control byte
+               'flag':7,       # Shift out one flag
+               'literal':22,   # Read and write one byte
+               'match':45,     # Read length and distance, set up the copy
+               'matchByte':16, # Copy one byte
+               'end':20,
+               }
+
+LZSS_MIN_MATCH = 3
+LZSS_MAX_MATCH = 255+2
+LZSS_WINDOW = 256
+
+def compress(data, codec):
+    """Compress data with the given codec ("rle" or "lzss")"""
+    if codec == "rle":
+        return encodeRLE(data)
+    elif codec == "lzss":
+        return encodeLZSS(data)
+    raise AttributeError("Unknown codec: %s" %(codec))
+
+def decompress(data, codec):
+    """Decompress data compressed with the given codec"""
+    return _decoder(codec)(data)[0]
+
+def estimateDecodeCycles(data, codec):
+    """Return the estimated number of 6502 cycles for decoding
+    data compressed with the given codec"""
+    return _decoder(codec)(data)[1]
+
+def compressionReport(data, codecs=CODECS):
+    """Compress data with each codec and return a list with one dict
+    per codec: {'codec', 'size', 'ratio', 'cycles'}. The values are None
+    for a codec which can not compress the data"""
+    report = []
+    for codec in codecs:
+        try:
+            compressed = compress(data, codec)
+        except AttributeError:
+            report.append({'codec':codec, 'size':None, 'ratio':None, 'cycles':None})
+            continue
+        report.append({'codec':codec,
+                       'size':len(compressed),
+                       'ratio':float(len(compressed))/max(len(data), 1),
+                       'cycles':estimateDecodeCycles(compressed, codec),
+                       })
+    return report
+
+def compressBatch(datas, codec):
+    """Compress a number of data strings with the same codec"""
+    encoder = {"rle":encodeRLE, "lzss":encodeLZSS}.get(codec)
+    if encoder is None:
+        raise AttributeError("Unknown codec: %s" %(codec))
+    return [encoder(data) for data in datas]
+
+def _decoder(codec):
+    """Return the decoder of a codec, returning (data, cycles)"""
+    if codec == "rle":
+        return _decodeRLE
+    elif codec == "lzss":
+        return _decodeLZSS
+    raise AttributeError("Unknown codec: %s" %(codec))
+
+# *************** RLE ***********
+def encodeRLE(data):
+    """Encode data in the RLE format of NES Screen Tool"""
+    data = bytearray(data)
+    counts = [0]*256
+    for byte in data:
+        counts[byte] += 1
+    if 0 not in counts:
+        raise AttributeError("All byte values are used, no RLE tag available")
+    tag = counts.index(0)
+
+    out = bytearray([tag])
+    i = 0
+    n = len(data)
+    while i < n:
+        byte = data[i]
+        runEnd = i+1
+        while runEnd < n and data[runEnd] == byte:
+            runEnd += 1
+        out.append(byte)
+        repeats = runEnd-i-1
+        if repeats == 1:
+            out.append(byte)
+        while repeats > 1:
+            count = min(repeats, 255)
+            out.extend((tag, count))
+            repeats -= count
+            if repeats == 1:
+                out.append(byte)
+                repeats = 0
+        i = runEnd
+    out.extend((tag, 0))
+    return out
+
+def decodeRLE(data):
+    """Decode data in the RLE format of NES Screen Tool"""
+    return _decodeRLE(data)[0]
+
+def _decodeRLE(data):
+    """Reference decoder, returning the data and the estimated cycles"""
+    data = bytearray(data)
+    cost = RLE_CYCLES
+    cycles = cost['setup']
+    tag = data[0]
+    out = bytearray()
+    last = 0
+    i = 1
+    while True:
+        byte = data[i]
+        i += 1
+        if byte != tag:
+            out.append(byte)
+            last = byte
+            cycles += cost['literal']
+            continue
+        count = data[i]
+        i += 1
+        if count == 0:
+            cycles += cost['end']
+            break
+        out.extend(bytearray([last])*count)
+        cycles += cost['run'] + count*cost['runByte']
+    return out, cycles
+
+# *************** LZSS ***********
+def encodeLZSS(data, maxChain=32):
+    """Encode data in the LZSS format.
+
+    Matches are found through hash chains on three byte prefixes. At
+    most maxChain earlier positions are tried for every position"""
+    data = bytes(bytearray(data))
+    n = len(data)
+    head = {}           # Three byte prefix: latest position
+    prev = [-1]*n       # Position: previous position with the same prefix
+
+    items = []          # Literal byte values or (length, distance) tuples
+    i = 0
+    while i < n:
+        bestLength = 0
+        bestDistance = 0
+        if i+LZSS_MIN_MATCH <= n:
+            key = data[i:i+LZSS_MIN_MATCH]
+            candidate = head.get(key, -1)
+            maxLength = min(LZSS_MAX_MATCH, n-i)
+            chain = maxChain
+            while candidate >= 0 and i-candidate <= LZSS_WINDOW and chain > 0:
+                length = LZSS_MIN_MATCH
+                while length < maxLength and data[candidate+length] == data[i+length]:
+                    length += 1
+                if length > bestLength:
+                    bestLength = length
+                    bestDistance = i-candidate
+                    if length == maxLength:
+                        break
+                candidate = prev[candidate]
+                chain -= 1
+        if bestLength >= LZSS_MIN_MATCH:
+            items.append((bestLength, bestDistance))
+            step = bestLength
+        else:
+            items.append(ord(data[i:i+1]))
+            step = 1
+        # Insert all passed positions in the hash chains
+        for pos in range(i, min(i+step, n-LZSS_MIN_MATCH+1)):
+            key = data[pos:pos+LZSS_MIN_MATCH]
+            prev[pos] = head.get(key, -1)
+            head[key] = pos
+        i += step
+    items.append(None)  # End marker
+
+    out = bytearray()
+    for start in range(0, len(items), 8):
+        control = 0
+        group = bytearray()
+        for bit, item in enumerate(items[start:start+8]):
+            if item is None:
+                control |= 1<<bit
+                group.append(0)
+            elif isinstance(item, tuple):
+                control |= 1<<bit
+                group.append(item[0]-2)
+                group.append(item[1]-1)
+            else:
+                group.append(item)
+        out.append(control)
+        out.extend(group)
+    return out
+
+def decodeLZSS(data):
+    """Decode data in the LZSS format"""
+    return _decodeLZSS(data)[0]
+
+def _decodeLZSS(data):
+    """Reference decoder, returning the data and the estimated cycles"""
+    data = bytearray(data)
+    cost = LZSS_CYCLES
+    cycles = cost['setup']
+    out = bytearray()
+    i = 0
+    while True:
+        control = data[i]
+        i += 1
+        cycles += cost['control']
+        for bit in range(8):
+            cycles += cost['flag']
+            if not control & (1<<bit):
+                out.append(data[i])
+                i += 1
+                cycles += cost['literal']
+                continue
+            length = data[i]
+            if length == 0:
+                cycles += cost['end']
+                return out, cycles
+            length += 2
+            distance = data[i+1]+1
+            i += 2
+            start = len(out)-distance
+            for pos in range(start, start+length):
+                out.append(out[pos])    # The source may overlap the output
+            cycles += cost['match'] + length*cost['matchByte']
+
+# *************** Unit tests ***********
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.datas = [bytearray(),
+                      bytearray([5]),
+                      bytearray([5, 5]),
+                      bytearray([0]*1024),
+                      bytearray([1, 2, 3]*100 + [7]*600 + [8, 7]),
+                      bytearray([(i*i)%200 for i in range(1024)]),
+                      ]
+
+    def test_rle(self):
+        for data in self.datas:
+            compressed = encodeRLE(data)
+            self.assertEqual(decodeRLE(compressed), data)
+        self.assertEqual(encodeRLE([4, 4, 4, 4, 9]), bytearray([0, 4, 0, 3, 9, 0, 0]))
+        self.assertEqual(len(encodeRLE([0]*1024)), 1+1+5*2+2)
+        self.assertRaises(AttributeError, encodeRLE, range(256))
+
+    def test_lzss(self):
+        for data in self.datas:
+            compressed = encodeLZSS(data)
+            self.assertEqual(decodeLZSS(compressed), data)
+        self.assertTrue(len(encodeLZSS([0]*1024)) < 20)
+        self.assertEqual(decodeLZSS(encodeLZSS(range(256)*4)), bytearray(range(256)*4))
+
+    def test_report(self):
+        report = compressionReport(bytearray([0]*1000 + range(24)))
+        self.assertEqual([entry['codec'] for entry in report], list(CODECS))
+        for entry in report:
+            self.assertTrue(entry['size'] < 100)
+            self.assertTrue(entry['cycles'] > 1024*9)
+        self.assertRaises(AttributeError, compress, bytearray(), "zip")
+        report = compressionReport(range(256))
+        self.assertEqual(report[0]['size'], None)
+        self.assertTrue(report[1]['size'] > 256)
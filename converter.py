@@ -0,0 +1,252 @@
+"""Conversion of images to tiles and nametables
+
+An image is converted in these steps:
+1. Every pixel is mapped to the nearest color in constants.PALETTE
+2. The image is divided in areas of 16x16 pixels, the areas sharing
+   a palette through the attribute table. A common background color
+   and four palettes of three colors each are chosen so that they
+   fit the colors of the areas
+3. The image is sliced into 8x8 tiles using the palette of each area.
+   Duplicate tiles are removed
+4. A nametable is created for every screen of 256x240 pixels
+
+Images wider than one screen give one nametable per screen, all
+using the same tiles."""
+from plotter import TileGroup, Palette, encodeTiles
+from nametable import Nametable
+from block import AttributeTable
+from dedupe import TileIndex
+from colors import getNearestColorCube
+import constants
+import image
+import collections
+import unittest
+
+SCREEN_WIDTH = 256
+SCREEN_HEIGHT = 240
+AREA_SIZE = 16  # Width and height of the area sharing a palette
+MAX_TILES = 256 # The number of tiles in a pattern table
+
+def _createDistanceTable():
+    """Return the squared RGB distances between all colors
+    in constants.PALETTE: table[index1][index2]"""
+    return [[sum([(a-b)**2 for a, b in zip(color1, color2)]) for color2 in constants.PALETTE]
+            for color1 in constants.PALETTE]
+
+_DISTANCES = _createDistanceTable()
+
+def convertImageFile(filename, metric="rgb", timeBudget=None, processes=None):
+    """Convert a PNG or PPM image, see convertImage"""
+    width, height, rgb = image.loadImage(filename)
+    return convertImage(width, height, rgb, metric, timeBudget, processes)
+
+def convertImage(width, height, rgb, metric="rgb", timeBudget=None, processes=None):
+    """Convert an image with RGB data to tiles and nametables.
+    The width must be a multiple of 256 pixels and the height 240 pixels.
+    The colors are mapped to the palette using the given metric, see
+    colors.NearestColorCube.
+
+    The palettes are chosen greedily. With a timeBudget in seconds they
+    are then optimized for all screens together, using the given number
+    of processes, see paletteopt.optimizePalettes.
+
+    Returns (tileGroup, nametables, palettes), where palettes is a list
+    of four Palette objects with indexes into constants.PALETTE"""
+    if width%SCREEN_WIDTH != 0 or height != SCREEN_HEIGHT:
+        raise AttributeError("The image must be a number of screens of 256x240 pixels")
+    indexes = quantize(rgb, metric)
+    areaColors = getAreaColors(width, height, indexes)
+    background, paletteColors = choosePalettes(areaColors)
+    if timeBudget is not None:
+        from paletteopt import optimizePalettes
+        paletteColors = optimizePalettes(areaColors, background, timeBudget, processes,
+                                         initialPalettes=paletteColors)
+    areaPalettes = assignPalettes(areaColors, background, paletteColors)
+    return createNametables(width, height, indexes, background, paletteColors, areaPalettes)
+
+def quantize(rgb, metric="rgb"):
+    """Map RGB data to the nearest colors in constants.PALETTE.
+    Returns the palette indexes as a string with one byte per pixel"""
+    return getNearestColorCube(metric).lookupBuffer(rgb)
+
+def getAreaColors(width, height, indexes):
+    """Count the colors in every area of 16x16 pixels.
+    Returns a list of Counters, area by area and row by row"""
+    areaColors = []
+    for y in range(0, height, AREA_SIZE):
+        rows = [indexes[(y+i)*width:(y+i+1)*width] for i in range(min(AREA_SIZE, height-y))]
+        for x in range(0, width, AREA_SIZE):
+            area = bytearray(b"".join([row[x:x+AREA_SIZE] for row in rows]))
+            areaColors.append(collections.Counter(area))
+    return areaColors
+
+def choosePalettes(areaColors):
+    """Choose the background color and up to four palettes of up to three
+    colors each, fitting the colors of the areas.
+
+    The most common color becomes the background. The areas are then
+    handled from the one with the most colors to the one with the least.
+    An area which does not fit in any palette gets a new palette, or is
+    merged into a palette with room for its colors. Only the three most
+    common colors (besides the background) of an area are considered.
+
+    Returns (background, paletteColors)"""
+    total = collections.Counter()
+    for counts in areaColors:
+        total.update(counts)
+    background = total.most_common(1)[0][0]
+
+    colorSets = set()
+    for counts in areaColors:
+        colors = [color for color, count in counts.most_common() if color != background]
+        colorSets.add(frozenset(colors[:3]))
+
+    paletteColors = []
+    for colorSet in sorted(colorSets, key=lambda colorSet: (-len(colorSet), sorted(colorSet))):
+        if [colors for colors in paletteColors if colorSet <= set(colors)]:
+            continue    # Already fits in a palette
+        for colors in paletteColors:
+            if len(colorSet | set(colors)) <= 3:
+                colors.extend(sorted(colorSet - set(colors)))
+                break
+        else:
+            if len(paletteColors) < 4:
+                paletteColors.append(sorted(colorSet))
+    return background, paletteColors
+
+def areaError(counts, colors):
+    """Return the error of showing an area with the given color counts
+    using the given colors. The error is the squared RGB distance to
+    the nearest color, summed over all pixels"""
+    error = 0
+    for color, count in counts.items():
+        distances = _DISTANCES[color]
+        error += count*min([distances[c] for c in colors])
+    return error
+
+def assignPalettes(areaColors, background, paletteColors):
+    """Return the number of the palette giving the smallest error for
+    every area"""
+    areaPalettes = []
+    for counts in areaColors:
+        errors = [areaError(counts, [background]+colors) for colors in paletteColors]
+        areaPalettes.append(errors.index(min(errors)) if errors else 0)
+    return areaPalettes
+
+def createPalettes(background, paletteColors):
+    """Return four Palette objects with the background color as color 0.
+    Unused colors are set to the background color"""
+    palettes = []
+    for i in range(4):
+        colors = paletteColors[i] if i < len(paletteColors) else []
+        palette = Palette()
+        palette.setColors([background] + colors + [background]*(3-len(colors)))
+        palettes.append(palette)
+    return palettes
+
+def createNametables(width, height, indexes, background, paletteColors, areaPalettes):
+    """Slice the image with palette indexes into tiles and create one
+    nametable per screen. Returns (tileGroup, nametables, palettes)"""
+    palettes = createPalettes(background, paletteColors)
+
+    # Translation tables from palette index to the nearest color
+    # (pixel value 0-3) of each palette
+    translations = []
+    for palette in palettes:
+        colors = palette.getColors()
+        pixelValues = []
+        for index in range(256):
+            if index < len(_DISTANCES):
+                distances = [_DISTANCES[index][color] for color in colors]
+                pixelValues.append(distances.index(min(distances)))
+            else:
+                pixelValues.append(0)
+        translations.append(bytes(bytearray(pixelValues)))
+
+    nAreasX = width//AREA_SIZE
+    nTilesX = SCREEN_WIDTH//8
+    nTilesY = SCREEN_HEIGHT//8
+    nScreens = width//SCREEN_WIDTH
+    tilePixels = []
+    for screen in range(nScreens):
+        for tileY in range(nTilesY):
+            for tileX in range(screen*nTilesX, (screen+1)*nTilesX):
+                area = (tileY*8//AREA_SIZE)*nAreasX + tileX*8//AREA_SIZE
+                start = tileY*8*width + tileX*8
+                pixels = b"".join([indexes[rowStart:rowStart+8]
+                                   for rowStart in range(start, start+8*width, width)])
+                tilePixels.append(pixels.translate(translations[areaPalettes[area]]))
+    data = bytes(encodeTiles(b"".join(tilePixels)))
+
+    tileIndex = TileIndex()
+    tileNumbers = bytearray([tileIndex.add(data[start:start+16])[0]
+                             for start in range(0, len(data), 16)])
+    if tileIndex.getBank().getNumTiles() > MAX_TILES:
+        raise AttributeError("The image needs %d unique tiles, only %d fit in a pattern table"
+                             %(tileIndex.getBank().getNumTiles(), MAX_TILES))
+    tileGroup = TileGroup()
+    tileGroup.loadFromBytes(tileIndex.getBank().getData())
+
+    nametables = []
+    nTilesInScreen = nTilesX*nTilesY
+    for screen in range(nScreens):
+        attributeBytes = createAttributeBytes(areaPalettes, nAreasX, screen)
+        nametable = Nametable()
+        nametable.fromBytes(tileNumbers[screen*nTilesInScreen:(screen+1)*nTilesInScreen] +
+                            attributeBytes, tileGroup)
+        nametables.append(nametable)
+    return tileGroup, nametables, palettes
+
+def createAttributeBytes(areaPalettes, nAreasX, screen):
+    """Return the 64 bytes of the attribute table of a screen"""
+    areasInScreen = SCREEN_WIDTH//AREA_SIZE
+    start = screen*areasInScreen
+    table = AttributeTable()
+    table.setRegion(0, 0, [areaPalettes[y*nAreasX+start:y*nAreasX+start+areasInScreen]
+                           for y in range(SCREEN_HEIGHT//AREA_SIZE)])
+    return table.getAttributeBytes()
+
+# *************** Unit tests ***********
+class TestConverter(unittest.TestCase):
+    def createImage(self, nScreens):
+        """Create an image using more colors than fit in one palette,
+        with stripes of 8 pixels in different colors"""
+        colors = [0x0F, 0x16, 0x27, 0x30, 0x11, 0x21, 0x31]
+        width = SCREEN_WIDTH*nScreens
+        indexes = bytearray(width*SCREEN_HEIGHT)
+        for y in range(SCREEN_HEIGHT):
+            for x in range(width):
+                if (x//64)%2 == 0:
+                    indexes[y*width+x] = colors[(x//8+y//8)%4]
+                else:
+                    indexes[y*width+x] = colors[[0, 4, 5, 6][(x//8)%4]]
+        return width, indexes
+
+    def test_convert(self):
+        from compositor import Compositor
+        width, indexes = self.createImage(2)
+        rgb = image.indexedToRGB(indexes, constants.PALETTE)
+        tileGroup, nametables, palettes = convertImage(width, SCREEN_HEIGHT, rgb)
+        self.assertEqual(len(nametables), 2)
+        self.assertTrue(tileGroup.getNumTiles() <= 8)
+        self.assertEqual(palettes[0].getColor(0), 0x0F)
+
+        # Render the screens again and compare with the original image
+        compositor = Compositor(tileGroup, palettes)
+        for screen, nametable in enumerate(nametables):
+            framebuffer = compositor.render(nametable)
+            for y in range(0, SCREEN_HEIGHT, 7):
+                start = y*width + screen*SCREEN_WIDTH
+                self.assertEqual(framebuffer[y*SCREEN_WIDTH:(y+1)*SCREEN_WIDTH],
+                                 indexes[start:start+SCREEN_WIDTH])
+
+    def test_optimize(self):
+        width, indexes = self.createImage(1)
+        rgb = image.indexedToRGB(indexes, constants.PALETTE)
+        tileGroup, nametables, palettes = convertImage(width, SCREEN_HEIGHT, rgb,
+                                                       timeBudget=0.5, processes=1)
+        self.assertEqual(len(nametables), 1)
+        self.assertTrue(tileGroup.getNumTiles() <= 8)
+
+    def test_wrong_size(self):
+        self.assertRaises(AttributeError, convertImage, 8, 8, bytes(bytearray(8*8*3)))
@@ -0,0 +1,134 @@
+"""Removal of duplicate tiles
+
+Tiles are compared by their 16 bytes of raw data through a dict, so
+deduplicating a bank takes linear time. For sprites, tiles that are
+horizontal and/or vertical flips of each other can be treated as
+duplicates as well. The flips are given with the bits used in the
+sprite attribute byte, FLIP_H and FLIP_V."""
+from plotter import TileGroup, TileBank
+import unittest
+
+FLIP_H = 0x40   # Horizontal flip
+FLIP_V = 0x80   # Vertical flip
+FLIPS = (0, FLIP_H, FLIP_V, FLIP_H|FLIP_V)
+
+# Translation table reversing the bits of a byte
+_REVERSED_BITS = bytes(bytearray([sum([((byte>>i)&0x01)<<(7-i) for i in range(8)])
+                                  for byte in range(256)]))
+
+def flipTileData(data, flips):
+    """Return the 16 bytes of raw tile data flipped horizontally
+    (FLIP_H) and/or vertically (FLIP_V)"""
+    data = bytes(bytearray(data))
+    if flips & FLIP_H:
+        data = data.translate(_REVERSED_BITS)
+    if flips & FLIP_V:
+        data = data[7::-1] + data[15:7:-1]
+    return data
+
+class TileIndex:
+    """An index of unique tiles, which are collected in a TileBank
+
+    Every unique tile is stored in a dict with its raw data as key.
+    If flips are allowed, the flipped variants of the tile are stored
+    as well, so that looking up a tile is a single dict lookup"""
+    def __init__(self, flips=False):
+        """Init"""
+        self._flips = FLIPS if flips else (0,)
+        self._index = {}    # Raw data: (tileNr, flips)
+        self._bank = TileBank()
+
+    def getBank(self):
+        """Return the bank with the unique tiles"""
+        return self._bank
+
+    def find(self, data):
+        """Return (tileNr, flips) of a tile with the given raw data, where
+        flips tells how to flip the unique tile to get the data.
+        None is returned if the tile is not found"""
+        return self._index.get(bytes(bytearray(data)))
+
+    def add(self, data):
+        """Add a tile if there is no duplicate of it in the index and
+        return (tileNr, flips), see find"""
+        data = bytes(bytearray(data))
+        found = self._index.get(data)
+        if found is not None:
+            return found
+        tileNr = self._bank.appendTile(data)
+        for flips in self._flips:
+            # A symmetric tile keeps the variant with the least flips
+            self._index.setdefault(flipTileData(data, flips), (tileNr, flips))
+        return (tileNr, 0)
+
+def dedupeTiles(tileGroup, flips=False):
+    """Remove duplicate tiles from a tile group
+
+    Returns (uniqueTileGroup, remap), where remap[oldIndex] is
+    (newIndex, flips). The flips are always 0 unless flips is true,
+    which should only be used for sprite tiles"""
+    tileIndex = TileIndex(flips)
+    data = bytes(tileGroup.getBank().getData())
+    remap = [tileIndex.add(data[start:start+16]) for start in range(0, len(data), 16)]
+    uniqueTileGroup = TileGroup()
+    uniqueTileGroup.loadFromBytes(tileIndex.getBank().getData())
+    return uniqueTileGroup, remap
+
+def remapNametable(nametable, remap):
+    """Rewrite the tile indexes of all blocks in a nametable using
+    the remap table returned by dedupeTiles.
+
+    An AttributeError is raised if any tile used by the nametable is
+    missing from the remap table, gets an index above 255 or needs to be
+    flipped, since background tiles can not be flipped"""
+    translation = bytearray(range(256))
+    for index in set(nametable.getTileIndexes()):
+        if index >= len(remap):
+            raise AttributeError("Tile %d is not in the remap table" %(index))
+        if remap[index][0] > 255:
+            raise AttributeError("Tile %d is remapped to %d, above 255" %(index, remap[index][0]))
+        if remap[index][1] != 0:
+            raise AttributeError("Tile %d can only be used flipped" %(index))
+        translation[index] = remap[index][0]
+    nametable.setTileIndexes(bytes(nametable.getTileIndexes()).translate(bytes(translation)))
+
+# *************** Unit tests ***********
+class TestDedupe(unittest.TestCase):
+    def setUp(self):
+        self.tile = bytes(bytearray([0x80, 0x40, 0, 0, 0, 0, 0, 0x01,
+                                     0xF0, 0, 0, 0, 0, 0, 0, 0]))
+
+    def test_flip(self):
+        flipped = flipTileData(self.tile, FLIP_H)
+        self.assertEqual(bytearray(flipped[:2]), bytearray([0x01, 0x02]))
+        flipped = flipTileData(self.tile, FLIP_V)
+        self.assertEqual(bytearray(flipped[6:9]), bytearray([0x40, 0x80, 0]))
+        self.assertEqual(flipTileData(flipTileData(self.tile, FLIP_H|FLIP_V), FLIP_H|FLIP_V),
+                         self.tile)
+
+    def test_dedupe(self):
+        empty = bytes(bytearray(16))
+        tileGroup = TileGroup()
+        tileGroup.loadFromBytes(empty + self.tile + empty + flipTileData(self.tile, FLIP_V))
+
+        uniqueTileGroup, remap = dedupeTiles(tileGroup)
+        self.assertEqual(uniqueTileGroup.getNumTiles(), 3)
+        self.assertEqual(remap, [(0, 0), (1, 0), (0, 0), (2, 0)])
+
+        uniqueTileGroup, remap = dedupeTiles(tileGroup, flips=True)
+        self.assertEqual(uniqueTileGroup.getNumTiles(), 2)
+        self.assertEqual(remap, [(0, 0), (1, 0), (0, 0), (1, FLIP_V)])
+
+    def test_remapNametable(self):
+        from nametable import Nametable
+        nametable = Nametable()
+        nametable.fromBytes(bytearray([0, 1, 2, 3]*240 + [0]*64))
+        remap = [(0, 0), (1, 0), (0, 0), (1, FLIP_V)]
+        self.assertRaises(AttributeError, remapNametable, nametable, remap)
+        remap[3] = (256, 0)
+        self.assertRaises(AttributeError, remapNametable, nametable, remap)
+        self.assertRaises(AttributeError, remapNametable, nametable, remap[:3])
+        remap[3] = (2, 0)
+        remap.append((300, 0))  # Not used by the nametable
+        remapNametable(nametable, remap)
+        self.assertEqual(nametable.getTileIndexes()[:8], bytearray([0, 1, 0, 2]*2))
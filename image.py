@@ -0,0 +1,222 @@
+"""Reading and writing of images without Tkinter or extra libraries.
+
+Images are handled as a width, a height and a string of pixel data,
+row by row without padding. The pixel data is either RGB with three
+bytes per pixel or indexes (one byte per pixel) into a palette given as
+a list of [r, g, b] colors, like constants.PALETTE."""
+import struct
+import zlib
+import unittest
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def indexedToRGB(pixels, palette):
+    """Convert indexed pixels to RGB data using the palette"""
+    pixels = bytes(bytearray(pixels))
+    padding = [0]*(256-len(palette))
+    rgb = bytearray(len(pixels)*3)
+    # Translate the pixels once for each of the three channels
+    for channel in range(3):
+        translation = bytes(bytearray([color[channel] for color in palette] + padding))
+        rgb[channel::3] = pixels.translate(translation)
+    return bytes(rgb)
+
+def loadImage(filename):
+    """Load a PNG or PPM image and return (width, height, rgb)"""
+    with open(filename, "rb") as f:
+        data = f.read()
+    if data.startswith(PNG_SIGNATURE):
+        return decodePNG(data)
+    elif data.startswith(b"P6"):
+        return decodePPM(data)
+    raise AttributeError("Unknown image format: %s" %(filename))
+
+def decodePPM(data):
+    """Decode a binary PPM (P6) image and return (width, height, rgb)"""
+    # The header is four whitespace separated fields, and may have comments
+    fields = []
+    pos = 0
+    while len(fields) < 4:
+        while data[pos:pos+1].isspace():
+            pos += 1
+        if data[pos:pos+1] == b"#":
+            pos = data.index(b"\n", pos)
+            continue
+        end = pos
+        while not data[end:end+1].isspace():
+            end += 1
+        fields.append(data[pos:end])
+        pos = end
+    magic, width, height, maxValue = fields[0], int(fields[1]), int(fields[2]), int(fields[3])
+    if magic != b"P6" or maxValue != 255:
+        raise AttributeError("Only P6 PPM images with 8 bits per channel are supported")
+    pos += 1    # A single whitespace character ends the header
+    rgb = data[pos:pos+width*height*3]
+    if len(rgb) != width*height*3:
+        raise AttributeError("The PPM image is truncated")
+    return width, height, rgb
+
+def savePPM(filename, width, height, rgb):
+    """Save RGB data as a binary PPM (P6) image"""
+    assert(len(rgb) == width*height*3)
+    with open(filename, "wb") as f:
+        f.write(b"P6\n%d %d\n255\n" %(width, height))
+        f.write(bytes(rgb))
+
+def savePNG(filename, width, height, data, palette=None):
+    """Save an image as PNG.
+
+    Without a palette the data is RGB. With a palette (at most 256 colors)
+    the data is indexes into the palette and an indexed PNG is written"""
+    with open(filename, "wb") as f:
+        f.write(encodePNG(width, height, data, palette))
+
+def encodePNG(width, height, data, palette=None):
+    """Return an image encoded as PNG, see savePNG"""
+    data = bytes(data)
+    if palette is None:
+        bytesPerPixel = 3
+        colorType = 2   # RGB
+    else:
+        assert(len(palette) <= 256)
+        bytesPerPixel = 1
+        colorType = 3   # Indexed
+    stride = width*bytesPerPixel
+    assert(len(data) == stride*height)
+
+    # Every row starts with the filter type, 0 for no filter
+    rows = b"".join([b"\x00" + data[start:start+stride]
+                     for start in range(0, len(data), stride)])
+    chunks = [_pngChunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, colorType, 0, 0, 0))]
+    if palette is not None:
+        chunks.append(_pngChunk(b"PLTE", b"".join([bytes(bytearray(color)) for color in palette])))
+    chunks.append(_pngChunk(b"IDAT", zlib.compress(rows, 6)))
+    chunks.append(_pngChunk(b"IEND", b""))
+    return PNG_SIGNATURE + b"".join(chunks)
+
+def decodePNG(data):
+    """Decode a PNG image and return (width, height, rgb)
+    
+    Non interlaced images with 8 bits per channel are supported, in 
+    grayscale, RGB or indexed color, with or without alpha. The alpha 
+    channel is ignored"""
+    chunks = {}
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        length, chunkType = struct.unpack(">I4s", data[pos:pos+8])
+        chunks.setdefault(chunkType, []).append(data[pos+8:pos+8+length])
+        pos += 12+length
+    width, height, bitDepth, colorType, compression, filterMethod, interlace = \
+        struct.unpack(">IIBBBBB", chunks[b"IHDR"][0])
+    channels = {0:1, 2:3, 3:1, 4:2, 6:4}.get(colorType)
+    if bitDepth != 8 or interlace != 0 or channels is None:
+        raise AttributeError("Only non interlaced PNG images with 8 bits per channel are supported")
+    
+    pixels = _unfilterPNG(zlib.decompress(b"".join(chunks[b"IDAT"])), width, height, channels)
+    
+    # Convert to RGB
+    if colorType == 3:
+        palette = bytearray(chunks[b"PLTE"][0])
+        palette = [palette[i:i+3] for i in range(0, len(palette), 3)]
+        return width, height, indexedToRGB(pixels, palette)
+    rgb = bytearray(width*height*3)
+    if colorType in (0, 4):
+        gray = pixels[0::channels]
+        rgb[0::3] = gray
+        rgb[1::3] = gray
+        rgb[2::3] = gray
+    else:
+        for channel in range(3):
+            rgb[channel::3] = pixels[channel::channels]
+    return width, height, bytes(rgb)
+
+def _unfilterPNG(data, width, height, bytesPerPixel):
+    """Undo the filtering of the rows of a PNG image"""
+    data = bytearray(data)
+    stride = width*bytesPerPixel
+    bpp = bytesPerPixel
+    pixels = bytearray(stride*height)
+    prev = bytearray(stride)
+    for y in range(height):
+        start = y*(stride+1)
+        filterType = data[start]
+        line = data[start+1:start+1+stride]
+        if filterType == 1:     # Sub
+            for i in range(bpp, stride):
+                line[i] = (line[i] + line[i-bpp]) & 0xFF
+        elif filterType == 2:   # Up
+            for i in range(stride):
+                line[i] = (line[i] + prev[i]) & 0xFF
+        elif filterType == 3:   # Average
+            for i in range(stride):
+                left = line[i-bpp] if i >= bpp else 0
+                line[i] = (line[i] + ((left + prev[i])>>1)) & 0xFF
+        elif filterType == 4:   # Paeth
+            for i in range(stride):
+                if i >= bpp:
+                    a = line[i-bpp]
+                    c = prev[i-bpp]
+                else:
+                    a = c = 0
+                b = prev[i]
+                p = a + b - c
+                pa = abs(p-a)
+                pb = abs(p-b)
+                pc = abs(p-c)
+                if pa <= pb and pa <= pc:
+                    predictor = a
+                elif pb <= pc:
+                    predictor = b
+                else:
+                    predictor = c
+                line[i] = (line[i] + predictor) & 0xFF
+        elif filterType != 0:
+            raise AttributeError("Unknown PNG filter type %d" %(filterType))
+        pixels[y*stride:(y+1)*stride] = line
+        prev = line
+    return pixels
+
+def _pngChunk(chunkType, data):
+    """Return a PNG chunk with length and checksum"""
+    crc = zlib.crc32(chunkType + data) & 0xFFFFFFFF
+    return struct.pack(">I", len(data)) + chunkType + data + struct.pack(">I", crc)
+
+# *************** Unit tests ***********
+class TestPNG(unittest.TestCase):
+    def test_indexed(self):
+        palette = [[0,0,0], [255,0,0]]
+        png = encodePNG(3, 2, bytearray([0,1,0, 1,0,1]), palette)
+        self.assertEqual(png[:8], PNG_SIGNATURE)
+        self.assertEqual(png[12:16], b"IHDR")
+        self.assertEqual(struct.unpack(">IIBB", png[16:26]), (3, 2, 8, 3))
+
+        idat = png.index(b"IDAT")
+        length = struct.unpack(">I", png[idat-4:idat])[0]
+        self.assertEqual(zlib.decompress(png[idat+4:idat+4+length]),
+                         b"\x00\x00\x01\x00\x00\x01\x00\x01")
+
+    def test_decode(self):
+        palette = [[0,0,0], [255,0,0]]
+        png = encodePNG(3, 2, bytearray([0,1,0, 1,0,1]), palette)
+        self.assertEqual(decodePNG(png), (3, 2, indexedToRGB([0,1,0, 1,0,1], palette)))
+        rgb = bytes(bytearray(range(18)))
+        self.assertEqual(decodePNG(encodePNG(3, 2, rgb)), (3, 2, rgb))
+        
+    def test_filters(self):
+        # Rows with filters Sub, Up, Average and Paeth, one RGB pixel each plus one more
+        rows = bytearray([1, 10,20,30, 5,5,5,
+                          2, 1,1,1, 1,1,1,
+                          3, 2,2,2, 2,2,2,
+                          4, 3,3,3, 3,3,3])
+        pixels = _unfilterPNG(zlib.decompress(zlib.compress(bytes(rows))), 2, 4, 3)
+        self.assertEqual(pixels[:12], bytearray([10,20,30, 15,25,35, 11,21,31, 16,26,36]))
+        self.assertEqual(pixels[12:18], bytearray([7,12,17, 13,21,28]))
+        self.assertEqual(pixels[18:], bytearray([10,15,20, 16,24,31]))
+        
+    def test_ppm(self):
+        ppm = b"P6\n# A comment\n2 1\n255\n" + bytes(bytearray(range(6)))
+        self.assertEqual(decodePPM(ppm), (2, 1, bytes(bytearray(range(6)))))
+        
+    def test_indexedToRGB(self):
+        rgb = indexedToRGB([1,0], [[1,2,3], [4,5,6]])
+        self.assertEqual(rgb, b"\x04\x05\x06\x01\x02\x03")
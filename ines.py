@@ -0,0 +1,280 @@
+"""Reading of iNES and NES 2.0 ROM files
+
+    python ines.py GAME.nes [--scan]
+
+A ROM file starts with a 16 byte header, followed by an optional
+trainer of 512 bytes, the PRG ROM and the CHR ROM:
+0-3    "NES" and 0x1A
+4      PRG ROM size in 16 KB units
+5      CHR ROM size in 8 KB units, 0 for CHR RAM
+6      Flags: bit 0 vertical mirroring, bit 1 battery, bit 2 trainer,
+       bit 3 four-screen mirroring, bits 4-7 mapper bits 0-3
+7      Flags: bits 2-3 are 2 for NES 2.0, bits 4-7 mapper bits 4-7
+NES 2.0 only:
+8      Bits 0-3 mapper bits 8-11, bits 4-7 submapper
+9      Bits 0-3 PRG ROM size bits 8-11, bits 4-7 CHR ROM size bits 8-11.
+       When these bits are 0xF, byte 4 (or 5) is EEEEEEMM and the size
+       is 2**E*(M*2+1) bytes
+11     Bits 0-3 CHR RAM size, 64<<n bytes unless 0
+
+The file is memory mapped, so opening a ROM only reads its header.
+Every CHR bank of 8 KB is given as a TileGroup whose bank is a
+read-only buffer of the mapped file (see TileBank.setBuffer), so a bank
+is first read when its tiles are used and only decoded when its pixels
+are asked for.
+
+Games with CHR RAM copy their tiles from the PRG ROM. scanForChr finds
+the parts of the PRG ROM that look like tiles, see its documentation."""
+from plotter import TileGroup
+import argparse
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HEADER_SIZE = 16
+TRAINER_SIZE = 512
+PRG_BANK_SIZE = 16*1024
+CHR_BANK_SIZE = 8*1024
+MAGIC = b"NES\x1a"
+MIN_SCAN_TILES = 16     # The smallest region of tiles found by scanForChr
+MAX_TILE_VALUES = 8     # The most distinct byte values in a tile looking like graphics
+
+class Rom:
+    """An iNES or NES 2.0 ROM file"""
+    def __init__(self, filename):
+        """Init"""
+        with open(filename, "rb") as f:
+            header = bytearray(f.read(HEADER_SIZE))
+            if len(header) < HEADER_SIZE or header[:4] != bytearray(MAGIC):
+                raise AttributeError("%s is not an iNES file" %(filename))
+            # The mapping stays valid after closing the file. It is unmapped
+            # when the last buffer of it, e.g. a CHR bank, is gone
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._header = parseHeader(header)
+        self._prgOffset = HEADER_SIZE + (TRAINER_SIZE if self._header['trainer'] else 0)
+        self._chrOffset = self._prgOffset + self._header['prgSize']
+        if self._chrOffset + self._header['chrSize'] > len(self._map):
+            raise AttributeError("%s is shorter than given by its header" %(filename))
+        self._chrBanks = {}     # Bank number: TileGroup
+
+    def getHeader(self):
+        """Return the header as a dict, see parseHeader"""
+        return dict(self._header)
+
+    def getNumPrgBanks(self):
+        """Return the number of 16 KB PRG banks"""
+        return (self._header['prgSize']+PRG_BANK_SIZE-1)//PRG_BANK_SIZE
+
+    def getNumChrBanks(self):
+        """Return the number of 8 KB CHR banks, 0 for CHR RAM"""
+        return (self._header['chrSize']+CHR_BANK_SIZE-1)//CHR_BANK_SIZE
+
+    def getBanks(self):
+        """Return a list of (kind, bankNr, offset, size) of the banks,
+        kind being "PRG" or "CHR" and offset the offset in the file"""
+        banks = []
+        for kind, offset, size, bankSize in (("PRG", self._prgOffset, self._header['prgSize'], PRG_BANK_SIZE),
+                                              ("CHR", self._chrOffset, self._header['chrSize'], CHR_BANK_SIZE)):
+            for bankNr, start in enumerate(range(0, size, bankSize)):
+                banks.append((kind, bankNr, offset+start, min(bankSize, size-start)))
+        return banks
+
+    def getPrg(self):
+        """Return a read-only buffer of the whole PRG ROM"""
+        return buffer(self._map, self._prgOffset, self._header['prgSize'])
+
+    def getPrgBank(self, bankNr):
+        """Return a read-only buffer of a 16 KB PRG bank"""
+        return self._getBank(bankNr, self.getNumPrgBanks(), self._prgOffset,
+                             self._header['prgSize'], PRG_BANK_SIZE)
+
+    def getChrBank(self, bankNr):
+        """Return a TileGroup with the 512 tiles of an 8 KB CHR bank.
+        The tiles are read from the file as they are used"""
+        tileGroup = self._chrBanks.get(bankNr)
+        if tileGroup is None:
+            tileGroup = TileGroup()
+            tileGroup.loadFromBuffer(self._getBank(bankNr, self.getNumChrBanks(), self._chrOffset,
+                                                   self._header['chrSize'], CHR_BANK_SIZE))
+            self._chrBanks[bankNr] = tileGroup
+        return tileGroup
+
+    def getPrgTiles(self, offset, size):
+        """Return a TileGroup with the tiles of a part of the PRG ROM,
+        e.g. a region found by scanPrg"""
+        if offset < 0 or offset + size > self._header['prgSize']:
+            raise IndexError("PRG region %d+%d out of range" %(offset, size))
+        tileGroup = TileGroup()
+        tileGroup.loadFromBuffer(buffer(self._map, self._prgOffset+offset, size))
+        return tileGroup
+
+    def scanPrg(self, minTiles=MIN_SCAN_TILES):
+        """Return the regions of the PRG ROM looking like tiles as a list
+        of (offset, size), see scanForChr"""
+        return scanForChr(self.getPrg(), minTiles)
+
+    def _getBank(self, bankNr, numBanks, offset, size, bankSize):
+        """Return a read-only buffer of a bank"""
+        if not 0 <= bankNr < numBanks:
+            raise IndexError("Bank number %d out of range" %(bankNr))
+        start = bankNr*bankSize
+        return buffer(self._map, offset+start, min(bankSize, size-start))
+
+def parseHeader(header):
+    """Parse the 16 byte header of an iNES or NES 2.0 file. Returns a
+    dict with format ("iNES" or "NES 2.0"), mapper, submapper, mirroring
+    ("horizontal", "vertical" or "four-screen"), battery, trainer and
+    prgSize, chrSize and chrRamSize in bytes"""
+    header = bytearray(header)
+    flags6 = header[6]
+    flags7 = header[7]
+    nes2 = (flags7 & 0x0C) == 0x08
+    result = {'format':"NES 2.0" if nes2 else "iNES",
+              'mirroring':"four-screen" if flags6 & 0x08 else ("vertical" if flags6 & 0x01 else "horizontal"),
+              'battery':bool(flags6 & 0x02),
+              'trainer':bool(flags6 & 0x04),
+              'submapper':0,
+              }
+    if nes2:
+        result['mapper'] = (flags6 >> 4) | (flags7 & 0xF0) | ((header[8] & 0x0F) << 8)
+        result['submapper'] = header[8] >> 4
+        result['prgSize'] = _getRomSize(header[4], header[9] & 0x0F, PRG_BANK_SIZE)
+        result['chrSize'] = _getRomSize(header[5], header[9] >> 4, CHR_BANK_SIZE)
+        shift = header[11] & 0x0F
+        result['chrRamSize'] = 64 << shift if shift else 0
+    else:
+        # Bytes 7-15 of old iNES files may hold garbage, e.g. "DiskDude!"
+        if any(header[12:16]):
+            flags7 = 0
+        result['mapper'] = (flags6 >> 4) | (flags7 & 0xF0)
+        result['prgSize'] = header[4]*PRG_BANK_SIZE
+        result['chrSize'] = header[5]*CHR_BANK_SIZE
+        result['chrRamSize'] = 0 if header[5] else CHR_BANK_SIZE
+    return result
+
+def _getRomSize(lsb, msb, unit):
+    """Return the size in bytes of a NES 2.0 ROM size"""
+    if msb == 0x0F:
+        return 2**(lsb >> 2) * ((lsb & 0x03)*2+1)
+    return ((msb << 8) | lsb)*unit
+
+def scanForChr(data, minTiles=MIN_SCAN_TILES):
+    """Find the parts of a buffer looking like tiles. Returns a list of
+    (offset, size) of regions of at least minTiles tiles.
+
+    Only tiles at offsets divisible by 16 are looked at. A tile looks
+    like graphics when it has at most MAX_TILE_VALUES distinct byte
+    values, as the rows of a tile repeat, while code and most other data
+    is varied. Tiles with a single byte value, e.g. unused space filled
+    with 0xFF, extend a region but are not part of its ends, and a region
+    must have more tiles with graphics than without"""
+    data = bytes(data[:len(data)//16*16])
+    regions = []
+    start = None    # Offset of the first tile of the current region
+    end = 0         # Offset after the last tile with graphics in the region
+    numGraphics = 0
+    for offset in range(0, len(data)+16, 16):
+        values = len(set(data[offset:offset+16])) if offset < len(data) else 0
+        if values == 1 and start is not None:
+            continue
+        if 1 < values <= MAX_TILE_VALUES:
+            if start is None:
+                start = offset
+                numGraphics = 0
+            end = offset + 16
+            numGraphics += 1
+        elif start is not None:
+            size = end - start
+            if size//16 >= minTiles and numGraphics*2 > size//16:
+                regions.append((start, size))
+            start = None
+    return regions
+
+def main(argv=None):
+    """List the banks of a ROM from the command line"""
+    parser = argparse.ArgumentParser(description="List the banks of an iNES or NES 2.0 ROM")
+    parser.add_argument("rom", help="the .nes file")
+    parser.add_argument("--scan", action="store_true",
+                        help="find data looking like tiles in the PRG ROM")
+    args = parser.parse_args(argv)
+
+    rom = Rom(args.rom)
+    header = rom.getHeader()
+    sys.stdout.write("%s, mapper %d.%d, %s mirroring%s\n"
+                     %(header['format'], header['mapper'], header['submapper'], header['mirroring'],
+                       ", battery" if header['battery'] else ""))
+    for kind, bankNr, offset, size in rom.getBanks():
+        sys.stdout.write("%s %3d  offset 0x%06X  %5d bytes\n" %(kind, bankNr, offset, size))
+    if header['chrRamSize']:
+        sys.stdout.write("CHR RAM %d bytes\n" %(header['chrRamSize']))
+    if args.scan:
+        for offset, size in rom.scanPrg():
+            sys.stdout.write("Tiles in PRG at 0x%06X: %d tiles (bank %d)\n"
+                             %(offset, size//16, offset//PRG_BANK_SIZE))
+    return 0
+
+# *************** Unit tests ***********
+class TestRom(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def writeRom(self, header, prg, chr):
+        filename = os.path.join(self.tempDir, "test.nes")
+        with open(filename, "wb") as f:
+            f.write(bytearray(header) + bytearray(HEADER_SIZE-len(header)) + prg + chr)
+        return filename
+
+    def test_header(self):
+        header = parseHeader(b"NES\x1a\x02\x01\x31\x08\x12\x00\x00\x07" + b"\x00"*4)
+        self.assertEqual(header['format'], "NES 2.0")
+        self.assertEqual(header['mapper'], 0x203)
+        self.assertEqual(header['submapper'], 1)
+        self.assertEqual(header['mirroring'], "vertical")
+        self.assertEqual((header['prgSize'], header['chrSize'], header['chrRamSize']),
+                         (2*PRG_BANK_SIZE, CHR_BANK_SIZE, 8192))
+        self.assertEqual(parseHeader(b"NES\x1a\x09\x00\x00\x08\x00\x0F" + b"\x00"*6)['prgSize'],
+                         2**2*3)
+        header = parseHeader(b"NES\x1a\x01\x00\x40" + b"\x00"*9)
+        self.assertEqual((header['format'], header['mapper'], header['chrRamSize']), ("iNES", 4, 8192))
+
+    def test_banks(self):
+        prg = bytearray(range(256))*(2*PRG_BANK_SIZE//256)
+        chr = bytearray([i//16 & 0xFF for i in range(2*CHR_BANK_SIZE)])
+        rom = Rom(self.writeRom(b"NES\x1a\x02\x02", prg, chr))
+        self.assertEqual(rom.getNumPrgBanks(), 2)
+        self.assertEqual(rom.getNumChrBanks(), 2)
+        self.assertEqual(rom.getBanks()[2], ("CHR", 0, HEADER_SIZE + 2*PRG_BANK_SIZE, CHR_BANK_SIZE))
+        self.assertEqual(bytearray(rom.getPrgBank(1)[:4]), bytearray([0, 1, 2, 3]))
+
+        tileGroup = rom.getChrBank(1)
+        self.assertTrue(tileGroup is rom.getChrBank(1))
+        self.assertTrue(tileGroup.getBank().isReadOnly())
+        self.assertEqual(tileGroup.getNumTiles(), 512)
+        self.assertEqual(tileGroup.getTile(3).getRawBytes(), b"\x03"*16)
+        self.assertRaises(IndexError, rom.getChrBank, 2)
+
+        # Modifying the tiles does not modify the file
+        tileGroup.getTile(3).setRawData(bytearray(16))
+        self.assertEqual(tileGroup.getTile(3).getRawBytes(), b"\x00"*16)
+        self.assertEqual(rom.getChrBank(0).getTile(3).getRawBytes(), b"\x03"*16)
+
+    def test_scan(self):
+        code = bytearray([(i*97 + i//7) & 0xFF for i in range(4096)])
+        tiles = bytearray([0x00, 0x3C, 0x66, 0x66, 0x66, 0x66, 0x3C, 0x00]*2)*32
+        prg = code + bytearray([0xFF]*256) + tiles + code
+        prg += bytearray([0xFF]*(PRG_BANK_SIZE-len(prg)))
+        filename = self.writeRom(b"NES\x1a\x01\x00", prg, b"")
+        rom = Rom(filename)
+        self.assertEqual(rom.getNumChrBanks(), 0)
+        self.assertEqual(rom.scanPrg(), [(4096+256, len(tiles))])
+        self.assertEqual(rom.getPrgTiles(4096+256, len(tiles)).getNumTiles(), 32)
+        self.assertRaises(AttributeError, Rom, self.writeRom(b"NES\x1a\x02\x00", prg, b""))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,271 @@
+"""Loading of tiles and nametables in a background thread
+
+Reading and decoding a large CHR file takes long enough to freeze the
+window when it is done before the mainloop is started. A BackgroundLoader
+instead runs a job in a worker thread. A job is an iterator yielding
+(done, total, chunk), where done and total tell the progress, e.g. in
+bytes. Every chunk is put on a queue, which the Tk thread polls with
+after() and hands to a callback, so the mainloop keeps running while
+the file is loaded.
+
+The first chunk of a CHR file is small, FIRST_CHUNK_SIZE bytes, so the
+first tiles are shown within a poll interval of starting, however large
+the file is. The following chunks are CHUNK_SIZE bytes.
+
+A load is cancelled by cancel(). The worker stops before the next chunk
+and chunks still in the queue are dropped."""
+from plotter import decodeTiles
+from nametable import Nametable
+import Queue
+import Tkinter
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+FIRST_CHUNK_SIZE = 4*1024   # 256 tiles
+CHUNK_SIZE = 64*1024
+POLL_INTERVAL = 20          # ms between polls of the queue
+POLL_TIME = 0.02            # s spent on chunks per poll, at most
+
+class BackgroundLoader:
+    """Runs a job in a worker thread and hands its chunks to the Tk thread"""
+    def __init__(self, widget=None, pollInterval=POLL_INTERVAL):
+        """Init
+        widget        A Tkinter widget used to schedule the polls. If None,
+                      poll must be called by the user"""
+        self._widget = widget
+        self._pollInterval = pollInterval
+        self._queue = Queue.Queue()
+        self._cancelEvent = threading.Event()
+        self._thread = None
+        self._state = "idle"
+        self._error = None
+        self._callbacks = {}
+
+    def start(self, job, onChunk, onProgress=None, onDone=None):
+        """Start running a job, see the module documentation
+        onChunk      Called as onChunk(chunk) for every chunk
+        onProgress   Called as onProgress(done, total) after every chunk
+        onDone       Called as onDone(state, error) when the job has ended,
+                     state being "done", "cancelled" or "failed" and error
+                     the exception of a failed job"""
+        if self._state == "loading":
+            raise AttributeError("A job is already running")
+        self._queue = Queue.Queue()
+        self._cancelEvent = threading.Event()
+        self._state = "loading"
+        self._error = None
+        self._callbacks = {'chunk':onChunk, 'progress':onProgress, 'done':onDone}
+        self._thread = threading.Thread(target=self._run, args=(job, self._queue, self._cancelEvent))
+        self._thread.daemon = True     # Closing the window does not wait for the job
+        self._thread.start()
+        if self._widget is not None:
+            self._widget.after(self._pollInterval, self._schedulePoll)
+
+    def cancel(self):
+        """Cancel the running job. onDone is called with "cancelled"
+        at the next poll"""
+        if self._state == "loading":
+            self._cancelEvent.set()
+
+    def getState(self):
+        """Return "idle", "loading", "done", "cancelled" or "failed" """
+        return self._state
+
+    def getError(self):
+        """Return the exception of a failed job, or None"""
+        return self._error
+
+    def join(self, timeout=None):
+        """Wait for the worker thread to end"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def poll(self):
+        """Hand the queued chunks to the callbacks. Returns True while
+        the job is running"""
+        deadline = time.time() + POLL_TIME
+        while self._state == "loading":
+            if self._cancelEvent.is_set():
+                self._finish("cancelled", None)
+                break
+            try:
+                message = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if message[0] == "chunk":
+                kind, done, total, chunk = message
+                self._callbacks['chunk'](chunk)
+                if self._callbacks['progress'] is not None:
+                    self._callbacks['progress'](done, total)
+            elif message[0] == "done":
+                self._finish("done", None)
+            else:
+                self._finish("failed", message[1])
+            if time.time() > deadline:
+                break   # Let Tkinter handle the events before the next chunk
+        return self._state == "loading"
+
+    def _schedulePoll(self):
+        """Poll and schedule the next poll while the job is running"""
+        if self.poll():
+            self._widget.after(self._pollInterval, self._schedulePoll)
+
+    def _finish(self, state, error):
+        """Called when the job has ended"""
+        self._state = state
+        self._error = error
+        if self._callbacks['done'] is not None:
+            self._callbacks['done'](state, error)
+
+    @staticmethod
+    def _run(job, queue, cancelEvent):
+        """The worker thread"""
+        try:
+            for done, total, chunk in job:
+                if cancelEvent.is_set():
+                    return
+                queue.put(("chunk", done, total, chunk))
+            queue.put(("done",))
+        except Exception as error:
+            queue.put(("error", error))
+
+def readChrChunks(filename, firstChunkSize=FIRST_CHUNK_SIZE, chunkSize=CHUNK_SIZE):
+    """Job reading and decoding a CHR file. Yields (done, total, chunk) in
+    bytes, chunk being (data, pixels) with the raw data of whole tiles
+    and its pixels, see decodeTiles. Trailing bytes not filling up a
+    whole tile are ignored"""
+    total = os.path.getsize(filename)//16*16
+    done = 0
+    with open(filename, "rb") as f:
+        size = firstChunkSize
+        while done < total:
+            data = bytearray(f.read(min(size, total-done)))
+            if not data:
+                break
+            done += len(data)
+            yield done, total, (data, decodeTiles(data))
+            size = chunkSize
+
+def readNametableChunks(filename):
+    """Job reading a file of nametables, 1024 bytes each. Yields
+    (done, total, data) in nametables"""
+    total = os.path.getsize(filename)//1024
+    with open(filename, "rb") as f:
+        for i in range(total):
+            yield i+1, total, bytearray(f.read(1024))
+
+def loadTileGroup(loader, filename, tileGroup, onChunk=None, onProgress=None, onDone=None):
+    """Load the tiles of a CHR file into a tile group in the background.
+    The tiles are appended to the bank of the tile group chunk by chunk,
+    so views of the tile group show the tiles as they are loaded.
+    onChunk is called as onChunk(tileGroup) after every chunk"""
+    tileGroup.getBank().setData(b"")
+    def addChunk(chunk):
+        data, pixels = chunk
+        tileGroup.getBank().appendData(data, pixels)
+        if onChunk is not None:
+            onChunk(tileGroup)
+    loader.start(readChrChunks(filename), addChunk, onProgress, onDone)
+
+def loadNametables(loader, filename, onNametable, tileGroup=None, onProgress=None, onDone=None):
+    """Load the nametables of a file in the background. onNametable is
+    called as onNametable(nametable) for every nametable"""
+    def addChunk(data):
+        nametable = Nametable()
+        nametable.fromBytes(data, tileGroup)
+        onNametable(nametable)
+    loader.start(readNametableChunks(filename), addChunk, onProgress, onDone)
+
+class LoadingStatus(Tkinter.Frame):
+    """Shows the progress of a BackgroundLoader, with a button cancelling it"""
+    def __init__(self, master, loader, text="Loading", **kwargs):
+        """Init"""
+        Tkinter.Frame.__init__(self, master, **kwargs)
+        self._loader = loader
+        self._text = text
+        self._label = Tkinter.Label(self, text=text, anchor="w")
+        self._label.pack(side="left", fill="x", expand=True)
+        self._button = Tkinter.Button(self, text="Cancel", command=loader.cancel)
+        self._button.pack(side="right")
+
+    def setProgress(self, done, total):
+        """Show the progress, see BackgroundLoader.start"""
+        self._label.configure(text="%s: %d %%" %(self._text, 100*done//max(total, 1)))
+
+    def setDone(self, state, error):
+        """Show how the job ended, see BackgroundLoader.start"""
+        if state == "failed":
+            self._label.configure(text="%s failed: %s" %(self._text, error))
+        else:
+            self._label.configure(text="%s %s" %(self._text, state))
+        self._button.configure(state="disabled")
+
+# *************** Unit tests ***********
+class TestLoader(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.chrFilename = os.path.join(self.tempDir, "tiles.chr")
+        self.data = bytearray([i*7 & 0xFF for i in range(100*1024)])
+        with open(self.chrFilename, "wb") as f:
+            f.write(self.data + bytearray(3))  # Not a whole tile
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_chrChunks(self):
+        chunks = list(readChrChunks(self.chrFilename))
+        self.assertEqual([done for done, total, chunk in chunks],
+                         [FIRST_CHUNK_SIZE, FIRST_CHUNK_SIZE+CHUNK_SIZE, len(self.data)])
+        self.assertEqual(chunks[0][1], len(self.data))
+        self.assertEqual(chunks[0][2][1], decodeTiles(self.data[:FIRST_CHUNK_SIZE]))
+
+    def test_loadTileGroup(self):
+        from plotter import TileGroup
+        tileGroup = TileGroup()
+        loader = BackgroundLoader()
+        progress = []
+        ended = []
+        loadTileGroup(loader, self.chrFilename, tileGroup,
+                      onProgress=lambda done, total: progress.append(done),
+                      onDone=lambda state, error: ended.append(state))
+        loader.join()
+        while loader.poll():
+            pass
+        self.assertEqual(ended, ["done"])
+        self.assertEqual(progress[-1], len(self.data))
+        self.assertEqual(tileGroup.getBank().getData(), self.data)
+        self.assertEqual(tileGroup.decodeAll(), decodeTiles(self.data))
+
+    def test_cancel(self):
+        gate = threading.Event()
+        def job():
+            yield 1, 3, "a"
+            gate.wait()
+            yield 2, 3, "b"
+            yield 3, 3, "c"
+        loader = BackgroundLoader()
+        chunks = []
+        ended = []
+        loader.start(job(), chunks.append, onDone=lambda state, error: ended.append(state))
+        while not chunks:
+            loader.poll()
+        loader.cancel()
+        gate.set()
+        loader.join()
+        self.assertFalse(loader.poll())
+        self.assertEqual(chunks, ["a"])
+        self.assertEqual(ended, ["cancelled"])
+
+    def test_error(self):
+        loader = BackgroundLoader()
+        ended = []
+        loadNametables(loader, os.path.join(self.tempDir, "missing.nam"), None,
+                       onDone=lambda state, error: ended.append((state, error)))
+        loader.join()
+        loader.poll()
+        self.assertEqual(ended[0][0], "failed")
+        self.assertTrue(isinstance(ended[0][1], OSError))
@@ -0,0 +1,198 @@
+"""Metatiles: blocks of tiles stored once and referenced by index
+
+Levels repeat the same blocks of tiles over and over. A metatile
+library holds every unique block once, and a screen is then stored as
+a map of metatile indexes, one byte each. Two sizes are supported:
+
+2   2x2 tiles and a palette number (0-3), the area of one palette in
+    the attribute table. A screen is 16x15 metatiles, 240 bytes
+4   4x4 tiles and an attribute byte, a block of the nametable, see
+    block.Block. A screen is 8x8 metatiles, 64 bytes. The bottom row
+    of blocks only has two rows of tiles, the other rows use tile 0
+
+Identical metatiles are found through a dict with their contents as
+key. The library is exported as one table per tile position followed
+by the palettes (or attribute bytes), the layout usually used by the
+6502 code reading the metatiles:
+name_tile0   .db tile 0 of every metatile
+name_tile1   .db tile 1 of every metatile
+...
+name_palette .db the palette or attribute byte of every metatile"""
+from nametable import Nametable, dumpDbLines
+import unittest
+
+METATILE_SIZES = (2, 4)
+MAX_METATILES = 256     # The indexes of the maps are bytes
+
+class MetatileLibrary:
+    """A library of unique metatiles of 2x2 or 4x4 tiles"""
+    def __init__(self, size=4):
+        """Init"""
+        if size not in METATILE_SIZES:
+            raise AttributeError("The metatile size must be 2 or 4")
+        self._size = size
+        self._metatiles = []    # (tile indexes, palette)
+        self._index = {}        # Tile indexes and palette as bytes: metatile index
+        self.settings = {'numDumpedBytesInRow':16}
+
+    def getSize(self):
+        """Return the width and height of the metatiles in tiles"""
+        return self._size
+
+    def getNumMetatiles(self):
+        """Return the number of metatiles"""
+        return len(self._metatiles)
+
+    def getMetatile(self, index):
+        """Return (tileIndexes, palette) of a metatile, where tileIndexes
+        is a bytearray with the tiles row by row"""
+        tileIndexes, palette = self._metatiles[index]
+        return bytearray(tileIndexes), palette
+
+    def add(self, tileIndexes, palette):
+        """Add a metatile unless it is already in the library.
+        Returns the index of the metatile"""
+        assert(len(tileIndexes) == self._size*self._size)
+        key = bytes(bytearray(tileIndexes)) + bytes(bytearray([palette]))
+        index = self._index.get(key)
+        if index is None:
+            if len(self._metatiles) >= MAX_METATILES:
+                raise AttributeError("More than %d metatiles" %(MAX_METATILES))
+            index = len(self._metatiles)
+            self._metatiles.append((key[:-1], palette))
+            self._index[key] = index
+        return index
+
+    def encodeNametable(self, nametable):
+        """Add the metatiles of a nametable and return its map of
+        metatile indexes, row by row"""
+        tiles = bytes(nametable.getTileIndexes()) + bytes(bytearray(32*2))  # Rows below the bottom
+        size = self._size
+        if size == 4:
+            palettes = nametable.getAttributeBytes()
+        else:
+            palettes = bytearray(b"".join([bytes(row) for row in nametable.getAttributes().getGrid()]))
+        columns = 32//size
+        indexMap = bytearray()
+        for i, palette in enumerate(palettes):
+            start = (i//columns)*size*32 + (i%columns)*size
+            tileIndexes = b"".join([tiles[rowStart:rowStart+size]
+                                    for rowStart in range(start, start+size*32, 32)])
+            indexMap.append(self.add(tileIndexes, palette))
+        return indexMap
+
+    def decodeNametable(self, indexMap, tileGroup=None):
+        """Return the nametable of a map of metatile indexes"""
+        size = self._size
+        columns = 32//size
+        tiles = bytearray(32*32)
+        palettes = []
+        for i, index in enumerate(indexMap):
+            tileIndexes, palette = self._metatiles[index]
+            start = (i//columns)*size*32 + (i%columns)*size
+            for row in range(size):
+                rowStart = start + row*32
+                tiles[rowStart:rowStart+size] = tileIndexes[row*size:(row+1)*size]
+            palettes.append(palette)
+        nametable = Nametable()
+        if size == 4:
+            nametable.fromBytes(tiles[:960] + bytearray(palettes), tileGroup)
+        else:
+            nametable.fromBytes(tiles[:960] + bytearray(64), tileGroup)
+            nametable.getAttributes().setRegion(0, 0, [palettes[y*16:(y+1)*16] for y in range(15)])
+        return nametable
+
+    def getTables(self):
+        """Return the tables of the library: a list of (name, bytearray),
+        one table per tile position and the palettes last"""
+        tables = []
+        for position in range(self._size*self._size):
+            tables.append(("tile%d" %(position),
+                           bytearray(b"".join([tileIndexes[position:position+1]
+                                               for tileIndexes, palette in self._metatiles]))))
+        tables.append(("palette", bytearray([palette for tileIndexes, palette in self._metatiles])))
+        return tables
+
+    def toBytes(self):
+        """Return the tables after each other"""
+        return bytearray(b"".join([bytes(table) for name, table in self.getTables()]))
+
+    def saveBinary(self, filename):
+        """Save the tables as a binary file, see toBytes"""
+        with open(filename, "wb") as f:
+            f.write(self.toBytes())
+
+    def dumpLines(self, tag):
+        """Generator yielding the lines of the tables as .db lines,
+        every table with the label tag_name"""
+        for name, table in self.getTables():
+            yield "\n%s_%s:\n" %(tag, name)
+            for line in dumpDbLines(table, self.settings['numDumpedBytesInRow']):
+                yield line
+
+    def dumpToFile(self, filename, tag):
+        """Dump the tables to a file, see dumpLines"""
+        with open(filename, "w") as f:
+            f.write("; Metatiles generated from Python script\n")
+            f.writelines(self.dumpLines(tag))
+
+def encodeNametables(nametables, size=4):
+    """Build a metatile library of a number of nametables.
+    Returns (library, indexMaps) with one map per nametable"""
+    library = MetatileLibrary(size)
+    return library, [library.encodeNametable(nametable) for nametable in nametables]
+
+def saveIndexMaps(filename, indexMaps):
+    """Save maps of metatile indexes after each other in a binary file"""
+    with open(filename, "wb") as f:
+        for indexMap in indexMaps:
+            f.write(indexMap)
+
+def dumpIndexMaps(filename, indexMaps, tag, bytesInRow=16):
+    """Dump maps of metatile indexes as .db lines, labeled tag0, tag1..."""
+    with open(filename, "w") as f:
+        f.write("; Metatile maps generated from Python script\n")
+        for i, indexMap in enumerate(indexMaps):
+            f.write("\n%s%d:\n" %(tag, i))
+            f.writelines(dumpDbLines(indexMap, bytesInRow))
+
+# *************** Unit tests ***********
+class TestMetatile(unittest.TestCase):
+    def setUp(self):
+        # A screen with a checkerboard of two kinds of 4x4 blocks
+        data = bytearray(1024)
+        for y in range(30):
+            for x in range(32):
+                data[y*32+x] = ((x//4 + y//4)%2)*16 + (y%4)*4 + x%4
+        data[960:] = bytearray([[0x1B, 0xE4][(i%8 + i//8)%2] for i in range(64)])
+        self.nametable = Nametable()
+        self.nametable.fromBytes(data)
+
+    def test_blocks(self):
+        library, indexMaps = encodeNametables([self.nametable]*3, size=4)
+        # Two kinds of blocks, with two attribute bytes, in the full rows
+        # and the bottom row
+        self.assertEqual(library.getNumMetatiles(), 4)
+        self.assertEqual(len(indexMaps[0]), 64)
+        self.assertEqual(indexMaps[0][:3], bytearray([0, 1, 0]))
+        self.assertEqual(library.getMetatile(1), (bytearray(range(16, 32)), 0xE4))
+        self.assertEqual(library.decodeNametable(indexMaps[2]).toBytes(), self.nametable.toBytes())
+
+    def test_areas(self):
+        library, indexMaps = encodeNametables([self.nametable], size=2)
+        self.assertEqual(len(indexMaps[0]), 240)
+        self.assertEqual(library.getMetatile(0), (bytearray([0, 1, 4, 5]), 0x00))
+        decoded = library.decodeNametable(indexMaps[0])
+        self.assertEqual(decoded.getTileIndexes(), self.nametable.getTileIndexes())
+        self.assertEqual(decoded.getAttributes().getGrid(), self.nametable.getAttributes().getGrid())
+
+    def test_export(self):
+        library, indexMaps = encodeNametables([self.nametable], size=4)
+        tables = library.getTables()
+        self.assertEqual([name for name, table in tables][-2:], ["tile15", "palette"])
+        self.assertEqual(tables[1][1], bytearray([1, 17, 17, 1]))
+        self.assertEqual(len(library.toBytes()), 17*4)
+        lines = list(library.dumpLines("level"))
+        self.assertEqual(lines[0], "\nlevel_tile0:\n")
+        self.assertEqual(lines[1], "    .db $00,$10,$10,$00\n")
+        self.assertRaises(AttributeError, MetatileLibrary, 3)
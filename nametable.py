@@ -1,14 +1,24 @@
-from block import Block, Attribute
-from plotter import Tile, CanvasPlotter
+from block import Block, BlockView, Attribute, AttributeTable
+from plotter import Tile, CanvasPlotter, DEFAULT_CHR_FILE
 from plotter import TileGroup
 from plotter import Palette
+import compression
+import profiling
 import Tkinter as tk
 import unittest
+import mmap
+import os
+import tempfile
+import shutil
+import sys
 
-def run():
-    """Run the nametable viewer"""
+NAMETABLE_BYTES = 1024  # Size of a nametable including the attribute table
+
+def run(chrFilename=DEFAULT_CHR_FILE):
+    """Run the nametable viewer, using the tiles of a CHR file"""
+    profiling.enableFromEnvironment()
     root = tk.Tk()
-    nv = NametableViewer(root)
+    nv = NametableViewer(root, chrFilename=chrFilename)
     
     nv.pack(side="top", fill="both", expand=True)
 
@@ -32,112 +42,220 @@ class Nametable:
     the corresponding subblock.
     
     Total number of bytes: 960+64=1024
+    
+    The nametable is stored as these 1024 bytes. The blocks are views
+    into them, created when asked for with getBlocks
     """
     def __init__(self):
         """Init"""
-        self.blocks = None
         self.nTiles={'x':32, 'y':30} # The nametable size in tiles
         self.settings={'numDumpedBytesInRow':16, # The number of bytes in a row in the dump file
                        'numDumpedAttrInRow':6,  # Number of attribute bytes in row
                        }
+        # The nametable is stored in the layout used by the PPU
+        self._tileIndexes = bytearray(self.nTiles['x']*self.nTiles['y'])
+        self._attributeTable = bytearray(NAMETABLE_BYTES-len(self._tileIndexes))
+        self._tileGroup = None  # The tiles referenced by the indexes, if known
     
     def getBlocks(self):
-        """Get all blocks in the nametable"""
-        return self.blocks
+        """Get all blocks in the nametable. The blocks are views into 
+        the nametable, see block.BlockView"""
+        return [BlockView(self, blockNr) for blockNr in range(len(self._attributeTable))]
     
     def setBlocks(self, blocks):
-        """Set the blocks in the nametable"""
-        self.blocks = blocks
+        """Set the blocks in the nametable. The tile indexes and 
+        attribute bytes of the blocks are copied to the nametable"""
+        assert(len(blocks) == len(self._attributeTable))
+        for blockNr, block in enumerate(blocks):
+            view = BlockView(self, blockNr)
+            view.setTiles(block.getTiles())
+            view.setAttribute(block.getAttribute())
+            
+    def getTileIndex(self, x, y):
+        """Return the index of the tile at column x and row y"""
+        return self._tileIndexes[y*self.nTiles['x'] + x]
+    
+    def setTileIndex(self, x, y, index):
+        """Set the index of the tile at column x and row y"""
+        self._tileIndexes[y*self.nTiles['x'] + x] = index
+        
+    def getTile(self, x, y):
+        """Return the tile at column x and row y, see getTileForIndex"""
+        return self.getTileForIndex(self.getTileIndex(x, y))
+    
+    def getTileForIndex(self, index):
+        """Return a tile object with the given index. The tile is taken
+        from the tile group given to fromBytes, if any. Otherwise a tile 
+        only holding the index is returned"""
+        if self._tileGroup is not None:
+            return self._tileGroup.getTile(index)
+        tile = Tile()
+        tile.setIndex(index)
+        return tile
+        
+    def getTileIndexes(self):
+        """Return a copy of the 960 tile indexes of the nametable as a 
+        bytearray in the order used by the PPU, i.e. row by row with 
+        32 tiles per row"""
+        return bytearray(self._tileIndexes)
+    
+    def setTileIndexes(self, data):
+        """Set all 960 tile indexes, in the order used by the PPU"""
+        assert(len(data) == len(self._tileIndexes))
+        self._tileIndexes[:] = data
+    
+    def getAttributeBytes(self):
+        """Return a copy of the 64 bytes of the attribute table as a bytearray"""
+        return bytearray(self._attributeTable)
+    
+    def getAttributeTable(self):
+        """Return the attribute table itself, which may be modified"""
+        return self._attributeTable
+    
+    def getAttributes(self):
+        """Return an AttributeTable view of the attribute table, for
+        reading and writing the palettes of areas of 2*2 tiles"""
+        return AttributeTable(self._attributeTable)
+    
+    def toBytes(self):
+        """Return the nametable as the 1024 bytes used by the PPU:
+        960 tile indexes followed by the 64 byte attribute table"""
+        return self._tileIndexes + self._attributeTable
+    
+    def fromBytes(self, data, tileGroup=None):
+        """Set the nametable from the 1024 bytes used by the PPU
+        
+        The tiles of the blocks are taken from tileGroup if given.
+        Otherwise tiles only holding the index are used"""
+        assert(len(data) == NAMETABLE_BYTES)
+        nIndexes = len(self._tileIndexes)
+        self._tileIndexes[:] = data[:nIndexes]
+        self._attributeTable[:] = data[nIndexes:]
+        self._tileGroup = tileGroup
+        
+    def toCompressed(self, codec):
+        """Return the 1024 bytes compressed with a codec 
+        from the compression module ("rle" or "lzss")"""
+        return compression.compress(self.toBytes(), codec)
+    
+    def getCompressionReport(self, codecs=compression.CODECS):
+        """Return the compressed size and estimated decode cycles for
+        each codec, see compression.compressionReport"""
+        return compression.compressionReport(self.toBytes(), codecs)
+        
+    def saveBinary(self, filename, codec=None):
+        """Save the nametable as a 1024 byte binary file, the format
+        used with .incbin and by emulators.
+        
+        If a compression codec is given ("rle" or "lzss"), the 
+        compressed data is saved instead"""
+        if codec is None:
+            data = self.toBytes()
+        else:
+            data = self.toCompressed(codec)
+        with open(filename, 'wb') as f:
+            f.write(data)
+            
+    def loadBinary(self, filename, index=0, tileGroup=None):
+        """Load the nametable with the given index from a binary file 
+        holding one or more nametables, see loadBinaryFile"""
+        with open(filename, 'rb') as f:
+            f.seek(index*NAMETABLE_BYTES)
+            data = f.read(NAMETABLE_BYTES)
+        if len(data) != NAMETABLE_BYTES:
+            raise IndexError("No nametable %d in %s" %(index, filename))
+        self.fromBytes(data, tileGroup)
         
     def dumpToFile(self, filename, ntTag, attrTag):
         """Dump the nametable to a file using the following format:
         .nametable .db $00, $01, $02, ...  
         
         .attribute .db %10110001, %10110010, ..."""
-        f = open(filename, 'w')
-        f.write("; Nametable generated from Python script\n\n")
-        self._dumpNametableBytes(f, tag=ntTag)
-        self._dumpAttributeBytes(f, tag=attrTag)
-        f.close()
+        dumpNametablesToFile(filename, [(self, ntTag, attrTag)])
+        
+    def dumpLines(self, ntTag, attrTag):
+        """Generator yielding the lines of the dump, see dumpToFile"""
+        for line in self._dumpNametableLines(ntTag):
+            yield line
+        for line in self._dumpAttributeLines(attrTag):
+            yield line
         
-    def _dumpNametableBytes(self, f, tag):
-        """Dump the bytes of the nametable
+    def _dumpNametableLines(self, tag):
+        """Generator yielding the lines with the bytes of the nametable
         One byte corresponds to a tile number
         
-        The blocks are written line by line, which means
-        that the top four tiles of each block in a row is written first.
-        Then the next four tiles of each block is written in the next line
-        and so on."""
-        
-        # The blocks need to be split into rows with bytes
-        #       Block1  Block2  Block3
-        # Row1  AB      EF      IJ
-        # Row2  CD      GH      KL
-        #
-        N_ROWS = 4      # Number of rows in a block
-        N_COLS = 4      # Number of columns in a block
-        dumpStr     = ""
-        tilesInRow=0
-        bytestream      = []
-        bytestreamRows  = [[] for i in range(N_ROWS)]
-        for block in self.blocks:
-            # Dump the data four rows at a time
-            for row in range(N_ROWS):
-                bytestreamRows[row]+=block.getRowForNametable(row)
-            # Split the block into row bytestreams
-            tilesInRow += N_COLS # Add two tiles to the tiles row counter
-            if tilesInRow >= self.nTiles['x']:
-                # Finished one row
-                # Add the rows to the bytestream
-                for bytestreamRow in bytestreamRows:
-                    bytestream += bytestreamRow
-                    
-                # Reset to beginning of next row
-                tilesInRow=0
-                bytestreamRows  = [[] for i in range(N_ROWS)]
-        
-        # Now all tile indexes are stored in the list bytestream
-        byteCounter = 0
-        dumpStr += "\n%s:" %(tag)
-        dumpStr += "\n    .db "
-        for byte in bytestream:
-            if byteCounter>=self.settings['numDumpedBytesInRow']:
-                # Start a new row in the output file
-                dumpStr = dumpStr[:-1] # Strip last ", "
-                dumpStr += "\n    .db "
-                byteCounter = 0
-            dumpStr += "$%02X," %(byte)
-            byteCounter += 1
-        
-        dumpStr = dumpStr[:-1] # Strip last ", "
-        dumpStr += "\n"
-        f.write(dumpStr)
-            
-                
+        The tiles are written in the order used by the PPU, 
+        see getTileIndexes"""
+        yield "\n%s:\n" %(tag)
+        for line in dumpDbLines(self._tileIndexes, self.settings['numDumpedBytesInRow']):
+            yield line
+
+    def _dumpAttributeLines(self, tag):
+        """Generator yielding the lines with the attribute bytes 
+        in binary format for better readability"""
+        yield "\n%s:\n" %(tag)
+        for line in dumpDbLines(self._attributeTable, self.settings['numDumpedAttrInRow'],
+                                binary=True):
+            yield line
+        
+    
+# The bytes formatted for the .db lines of the dump
+_DB_HEX = ["$%02X" %(byte) for byte in range(256)]
+_DB_BINARY = ["%%%s" %("".join([str((byte>>(7-i))&0x01) for i in range(8)])) for byte in range(256)]
 
-    def _dumpAttributeBytes(self, f, tag):
-        """Dump the attribute bytes in binary format
-        for better readability"""
-        dumpStr = ""
-        
-        byteCounter = 0
-        dumpStr += "\n%s:" %(tag)
-        dumpStr += "\n    .db "
-        for block in self.blocks:
-            if byteCounter>=self.settings['numDumpedAttrInRow']:
-                # Start a new row in the output file
-                dumpStr = dumpStr[:-1] # Strip last ", "
-                dumpStr += "\n    .db "
-                byteCounter = 0
-            dumpStr += "%%%s," %(block.getAttribute().getAttributeByteStr())
-            byteCounter += 1
-        dumpStr = dumpStr[:-1] # Strip last ", "
-        dumpStr += "\n"
-        f.write(dumpStr)
+def dumpDbLines(data, bytesInRow=16, binary=False):
+    """Generator yielding ".db" lines with bytesInRow bytes in each line.
+    The bytes are written in hex ($1F), or in binary (%00011111) if
+    binary is true"""
+    formattedBytes = _DB_BINARY if binary else _DB_HEX
+    for start in range(0, len(data), bytesInRow):
+        yield "    .db %s\n" %(",".join([formattedBytes[byte] for byte in data[start:start+bytesInRow]]))
         
+def dumpNametablesToFile(filename, nametables):
+    """Dump a number of nametables to one file in a single pass,
+    see Nametable.dumpToFile.
     
+    nametables is an iterable (which may be a generator) of 
+    (nametable, ntTag, attrTag) tuples. The lines are streamed to 
+    the file one nametable at a time."""
+    with open(filename, 'w') as f:
+        f.write("; Nametable generated from Python script\n\n")
+        for nametable, ntTag, attrTag in nametables:
+            f.writelines(nametable.dumpLines(ntTag, attrTag))
+
+def saveBinaryFile(filename, nametables, codec=None):
+    """Save a number of nametables after each other in one binary file.
+    If a compression codec is given ("rle" or "lzss"), the nametables
+    are compressed together and the compressed data is saved instead"""
+    with open(filename, 'wb') as f:
+        if codec is not None:
+            f.write(compression.compress(b"".join([bytes(nametable.toBytes()) 
+                                                   for nametable in nametables]), codec))
+            return
+        for nametable in nametables:
+            f.write(nametable.toBytes())
+            
+def loadBinaryFile(filename, tileGroup=None):
+    """Load all nametables from a binary file holding nametables
+    after each other. This is a generator yielding one nametable at a
+    time. The file is memory mapped, so only the nametables that 
+    have been yielded so far are read"""
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < NAMETABLE_BYTES:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start in range(0, size-NAMETABLE_BYTES+1, NAMETABLE_BYTES):
+                nametable = Nametable()
+                nametable.fromBytes(data[start:start+NAMETABLE_BYTES], tileGroup)
+                yield nametable
+        finally:
+            data.close()
+            
 class NametableViewer(tk.Frame):
     def __init__(self, *args, **kwargs):
+        chrFilename = kwargs.pop('chrFilename', DEFAULT_CHR_FILE)
         tk.Frame.__init__(self, *args, **kwargs)
         nametableCanvas = tk.Canvas(self,  width=500, height=400, bd=0, highlightthickness=0)
         nametableCanvas.pack()
@@ -146,15 +264,22 @@ class NametableViewer(tk.Frame):
         self._createEmptyNametable()
         self.canvasPlotter = CanvasPlotter(nametableCanvas)
         self.canvasPlotter.setScale(10,10)
-        blocks = self._nametable.getBlocks()
+        self._tileIndex = self._nametable.getBlocks()[0].getRowForNametable(0)[0]
+        self._tilePlotted = False
         
-        tileGroup = TileGroup()
-        filename = r"../game/src/test.chr"
-    
-        # Load a group of tiles from file
-        tileGroup.loadFromFile(filename) 
+        # Load a group of tiles from file while the window is shown
+        from loader import BackgroundLoader, LoadingStatus, loadTileGroup
+        self._loader = BackgroundLoader(self)
+        status = LoadingStatus(self, self._loader, text="Loading %s" %(chrFilename))
+        status.pack(side="bottom", fill="x")
+        loadTileGroup(self._loader, chrFilename, TileGroup(), onChunk=self._tilesLoaded,
+                      onProgress=status.setProgress, onDone=status.setDone)
         
-        tile = tileGroup.getTile(blocks[0].getRowForNametable(0)[0])
+    def _tilesLoaded(self, tileGroup):
+        """Plot the tile as soon as it is loaded"""
+        if self._tilePlotted or self._tileIndex >= tileGroup.getNumTiles():
+            return
+        tile = tileGroup.getTile(self._tileIndex)
         
         # Set the colors to use with the tiles
         palette = Palette()
@@ -163,6 +288,7 @@ class NametableViewer(tk.Frame):
         xOffset = 0
         yOffset = 0
         self.canvasPlotter.plotTileInCanvas(tile, xOffset, yOffset)
+        self._tilePlotted = True
         
     def _createEmptyNametable(self):
         """Create a complete nametable using empty tiles"""
@@ -245,8 +371,77 @@ class TestNametable(unittest.TestCase):
         filename = r"../game/src/test_dump.asm"
         n.dumpToFile(filename, "nametable2", "attribute2")
         
+    def test_binary(self):
+        data = bytearray([i%256 for i in range(960)] + [0xC6-i for i in range(64)])
+        n = Nametable()
+        n.fromBytes(data)
+        self.assertEqual(n.getBlocks()[1].getRowForNametable(1), [36,37,38,39])
+        self.assertEqual(n.getBlocks()[63].getRowForNametable(2), [])
+        self.assertEqual(n.getBlocks()[63].getAttribute().getAttributeByte(), 0xC6-63)
+        self.assertEqual(n.toBytes(), data)
+        self.assertEqual(n.getTileIndex(4, 1), 36)
+        n.setTileIndex(4, 1, 7)
+        self.assertEqual(n.getBlocks()[1].getRowForNametable(1), [7,37,38,39])
+        n.setTileIndex(4, 1, 36)
+        
+        # Blocks set from separate objects are copied into the nametable
+        n2 = Nametable()
+        n2.setBlocks(n.getBlocks())
+        self.assertEqual(n2.toBytes(), data)
+        
+        tempDir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempDir, "test.nam")
+            n.saveBinary(filename)
+            n2 = Nametable()
+            n2.loadBinary(filename)
+            self.assertEqual(n2.toBytes(), data)
+            
+            saveBinaryFile(filename, [n, n2, n])
+            self.assertEqual([nt.toBytes() for nt in loadBinaryFile(filename)], [data]*3)
+            n2.loadBinary(filename, index=2)
+            self.assertEqual(n2.toBytes(), data)
+            self.assertRaises(IndexError, n2.loadBinary, filename, 3)
+            
+            saveBinaryFile(filename, [n, n2], codec="lzss")
+            with open(filename, 'rb') as f:
+                self.assertEqual(compression.decompress(f.read(), "lzss"), data*2)
+            
+            n.saveBinary(filename, codec="lzss")
+            with open(filename, 'rb') as f:
+                self.assertEqual(compression.decompress(f.read(), "lzss"), data)
+            self.assertEqual(len(n.getCompressionReport()), len(compression.CODECS))
+        finally:
+            shutil.rmtree(tempDir)
+            
+    def test_dumpLines(self):
+        n = Nametable()
+        n.fromBytes(bytearray([i%256 for i in range(960)] + [0xC6]*64))
+        n.settings['numDumpedBytesInRow'] = 32
+        lines = list(n.dumpLines("nametable", "attribute"))
+        self.assertEqual(len(lines), 1+30+1+11)
+        self.assertEqual(lines[0], "\nnametable:\n")
+        self.assertEqual(lines[1], "    .db %s\n" %(",".join(["$%02X" %(i) for i in range(32)])))
+        self.assertEqual(lines[31], "\nattribute:\n")
+        self.assertEqual(lines[32], "    .db %s\n" %(",".join(["%11000110"]*6)))
+        self.assertEqual(lines[-1], "    .db %11000110,%11000110,%11000110,%11000110\n")
+        self.assertEqual(list(dumpDbLines(bytearray([1, 0xAB, 2]), 2)), ["    .db $01,$AB\n", "    .db $02\n"])
+        
+        tempDir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempDir, "test.asm")
+            dumpNametablesToFile(filename, [(n, "nt%d" %(i), "attr%d" %(i)) for i in range(3)])
+            with open(filename) as f:
+                dump = f.read()
+            self.assertEqual(dump.count(".db"), 3*(30+11))
+            self.assertTrue(dump.startswith("; Nametable generated from Python script\n\n\nnt0:\n"))
+        finally:
+            shutil.rmtree(tempDir)
+        
     
 if __name__ == "__main__":
-    run()
+    # Run the imported module, whose classes are the ones profiled
+    import nametable
+    nametable.run(*sys.argv[1:2])
     #t = Tiles()
     #t.open(r"../game/src/test.chr")
\ No newline at end of file
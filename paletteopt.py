@@ -0,0 +1,200 @@
+"""Optimization of the four background palettes of a level
+
+converter.choosePalettes picks the palettes greedily, which wastes
+colors when the areas of an image do not fit exactly. The optimizer
+here searches for the palettes that minimize the color error of all
+areas of a whole level, see converter.areaError.
+
+The search is a k-means like clustering of the areas: every area is
+assigned to the palette with the smallest error, and every palette is
+then rebuilt from the colors of its areas. This is repeated until the
+error does not decrease. The clustering is restarted from random
+palettes until the time budget is used, in one process per core.
+
+Identical areas are common in a level, so the areas are first merged
+into unique color counts with a weight, which makes a 50 screen level
+not much slower to optimize than a single screen."""
+from converter import _DISTANCES
+import collections
+import multiprocessing
+import random
+import time
+import unittest
+
+def optimizePalettes(areaColors, background, timeBudget=10.0, processes=None, seed=0,
+                     initialPalettes=None):
+    """Choose up to four palettes of up to three colors each, minimizing
+    the total error of the areas.
+
+    areaColors       A list of Counters with the colors of each area, see
+                     converter.getAreaColors
+    background       The common background color
+    timeBudget       The time in seconds to spend on the search
+    processes        The number of processes searching in parallel. None
+                     uses one process per core, 1 searches in this process
+    seed             The seed of the random restarts
+    initialPalettes  Palettes to start the search from, typically the
+                     result of converter.choosePalettes
+
+    Returns paletteColors, a list of lists of colors"""
+    areaTypes = getAreaTypes(areaColors, background)
+    if not areaTypes:
+        return initialPalettes or []
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    deadline = time.time() + timeBudget
+    jobs = [(areaTypes, background, initialPalettes if i == 0 else None, seed+i, deadline)
+            for i in range(processes)]
+    if processes == 1:
+        results = [_searchPalettes(jobs[0])]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_searchPalettes, jobs)
+        finally:
+            pool.terminate()
+            pool.join()
+    return min(results)[1]
+
+def getAreaTypes(areaColors, background):
+    """Merge areas with the same colors. Returns a list of
+    (colorCounts, weight), where colorCounts is a tuple of (color, count)
+    pairs and weight is the number of areas with those counts.
+    Areas with only the background color are left out"""
+    weights = collections.Counter()
+    for counts in areaColors:
+        if [color for color in counts if color != background]:
+            weights[tuple(sorted(counts.items()))] += 1
+    return sorted(weights.items())
+
+def palettesError(areaTypes, background, paletteColors):
+    """Return the total error of the areas, every area using the palette
+    giving the smallest error"""
+    return sum([weight*min([_typeError(counts, [background]+colors) for colors in paletteColors])
+                for counts, weight in areaTypes])
+
+def _typeError(counts, colors):
+    """Return the error of an area type, see converter.areaError"""
+    error = 0
+    for color, count in counts:
+        distances = _DISTANCES[color]
+        error += count*min([distances[c] for c in colors])
+    return error
+
+def _searchPalettes(job):
+    """Run clusterings from random palettes until the deadline.
+    Runs in a worker process. Returns (error, paletteColors)"""
+    areaTypes, background, initialPalettes, seed, deadline = job
+    rng = random.Random(seed)
+    best = None
+    while True:
+        if initialPalettes and best is None:
+            paletteColors = [list(colors) for colors in initialPalettes]
+        else:
+            paletteColors = _randomPalettes(areaTypes, background, rng)
+        result = _cluster(areaTypes, background, paletteColors, deadline)
+        if best is None or result < best:
+            best = result
+        if best[0] == 0 or time.time() >= deadline:
+            return best
+
+def _randomPalettes(areaTypes, background, rng):
+    """Return up to four palettes from the most common colors of
+    randomly chosen areas, areas used often being chosen more often"""
+    population = []
+    for counts, weight in areaTypes:
+        population.extend([counts]*min(weight, 16))
+    paletteColors = []
+    for counts in rng.sample(population, min(4, len(population))):
+        colors = [color for count, color in sorted([(-count, color) for color, count in counts])
+                  if color != background][:3]
+        if colors not in paletteColors:
+            paletteColors.append(colors)
+    return paletteColors
+
+def _cluster(areaTypes, background, paletteColors, deadline):
+    """Improve the palettes until the error does not decrease or the
+    deadline is passed. Returns (error, paletteColors)"""
+    error = palettesError(areaTypes, background, paletteColors)
+    while time.time() < deadline:
+        clusters = [[] for colors in paletteColors]
+        for areaType in areaTypes:
+            errors = [_typeError(areaType[0], [background]+colors) for colors in paletteColors]
+            clusters[errors.index(min(errors))].append(areaType)
+        newColors = [_bestColors(cluster, background, deadline) if cluster else colors
+                     for cluster, colors in zip(clusters, paletteColors)]
+        newError = palettesError(areaTypes, background, newColors)
+        if newError >= error:
+            break
+        error, paletteColors = newError, newColors
+    return error, paletteColors
+
+def _bestColors(areaTypes, background, deadline):
+    """Return the three colors giving the smallest error for the areas.
+    The colors are added one at a time, each time the one decreasing
+    the error the most, and then replaced one at a time while the
+    error decreases and the deadline is not passed"""
+    candidates = sorted(set([color for counts, weight in areaTypes for color, count in counts
+                             if color != background]))
+    def error(colors):
+        return sum([weight*_typeError(counts, [background]+colors) for counts, weight in areaTypes])
+
+    colors = []
+    while len(colors) < min(3, len(candidates)):
+        colors.append(min([(error(colors+[c]), c) for c in candidates if c not in colors])[1])
+
+    bestError = error(colors)
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for i in range(len(colors)):
+            for candidate in candidates:
+                if candidate in colors:
+                    continue
+                newColors = colors[:i] + [candidate] + colors[i+1:]
+                newError = error(newColors)
+                if newError < bestError:
+                    colors, bestError, improved = newColors, newError, True
+    return sorted(colors)
+
+# *************** Unit tests ***********
+class TestPaletteOptimizer(unittest.TestCase):
+    def setUp(self):
+        # Five color sets which do not fit in four palettes greedily:
+        # two similar blues can share a palette with a small error
+        self.background = 0x0F
+        sets = [[0x16, 0x27, 0x30], [0x11, 0x21, 0x31], [0x12, 0x21, 0x31],
+                [0x19, 0x29, 0x39], [0x14, 0x24, 0x34]]
+        self.areaColors = []
+        for i in range(50):
+            colors = sets[i%len(sets)]
+            self.areaColors.append(collections.Counter({self.background:100, colors[0]:60,
+                                                        colors[1]:50, colors[2]:46}))
+        self.areaColors.append(collections.Counter({self.background:256}))
+
+    def test_areaTypes(self):
+        areaTypes = getAreaTypes(self.areaColors, self.background)
+        self.assertEqual(len(areaTypes), 5)
+        self.assertEqual([weight for counts, weight in areaTypes], [10]*5)
+
+    def test_optimize(self):
+        from converter import choosePalettes
+        areaTypes = getAreaTypes(self.areaColors, self.background)
+        greedy = choosePalettes(self.areaColors)[1]
+        optimized = optimizePalettes(self.areaColors, self.background, timeBudget=0.5,
+                                     processes=1, initialPalettes=greedy)
+        self.assertTrue(len(optimized) <= 4)
+        for colors in optimized:
+            self.assertTrue(len(colors) <= 3)
+        self.assertTrue(palettesError(areaTypes, self.background, optimized) <
+                        palettesError(areaTypes, self.background, greedy))
+        self.assertTrue([0x16, 0x27, 0x30] in optimized)
+
+    def test_pool(self):
+        from converter import choosePalettes
+        areaTypes = getAreaTypes(self.areaColors, self.background)
+        greedy = choosePalettes(self.areaColors)[1]
+        optimized = optimizePalettes(self.areaColors, self.background, timeBudget=0.2,
+                                     processes=2, initialPalettes=greedy)
+        self.assertTrue(palettesError(areaTypes, self.background, optimized) <
+                        palettesError(areaTypes, self.background, greedy))
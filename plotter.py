@@ -1,106 +1,319 @@
 import Tkinter
 from colors import ColorPicker, importColors
 import unittest
+import struct
+import collections
+import profiling
+import sys
 
-def run():
-    """Run graphics"""
+DEFAULT_CHR_FILE = r"../game/src/test.chr"
+
+def run(filename=DEFAULT_CHR_FILE):
+    """Run graphics, showing the tiles of a CHR file"""
+    from loader import BackgroundLoader, LoadingStatus, loadTileGroup
+    profiling.enableFromEnvironment()
     top = Tkinter.Tk()
     
     tileGroup = TileGroup()
-    filename = r"../game/src/test.chr"
-    
-    # Load a group of tiles from file
-    tileGroup.loadFromFile(filename) 
     
     # Set the colors to use with the tiles
     palette = Palette()
     palette.setColors(['black', 'green', 'yellow', 'grey'])
     
-    nTilesX = 16
-    nTilesY = 32
-    xScale  = 3
-    yScale = xScale
-    C = Tkinter.Canvas(top, bg="grey", width=8*nTilesX*xScale, height=8*nTilesY*yScale, cursor = "crosshair")
-    p = CanvasPlotter(C)
-    p.setScale(xScale, yScale)
-    
-    xOffset=0
-    yOffset=0
-    for tile in tileGroup.tilesIterator():
-        print tile.index
-        tile.setPalette(palette)
-       
-        p.plotTileInCanvas(tile, xOffset, yOffset)
-        xOffset += 8*xScale
-        # Start a new row
-        if xOffset>=(nTilesX*8*xScale):
-            yOffset += 8*yScale
-            xOffset = 0
-        
-#        if tile.index>200:
-#            break
-    
-    C.pack()
-    colorPicker = ColorPicker(top, p)
+    viewer = TileBankViewer(top, tileGroup, palette, nTilesX=16, scale=3, nRowsVisible=32)
+    viewer.pack(side="top", fill="both", expand=True)
+    colorPicker = ColorPicker(top, viewer.getPlotter())
+    
+    # Load the tiles from file while the window is shown
+    loader = BackgroundLoader(top)
+    status = LoadingStatus(top, loader, text="Loading %s" %(filename))
+    status.pack(side="bottom", fill="x")
+    loadTileGroup(loader, filename, tileGroup, onProgress=status.setProgress, onDone=status.setDone)
     top.mainloop()
 
  
 class TileGroup:
-    """Contains a group of tiles"""
+    """Contains a group of tiles
+    
+    The raw data of the tiles is kept in a TileBank. The Tile objects
+    are created first when they are asked for, and are then kept by the
+    group, so the palette and index set on a tile are kept as well.
+    A tile is a view into the bank: modifying it modifies the bank, and
+    every user of the group sees the change"""
     def __init__(self):
         """Init"""
-        self._tiles=[]
+        self._bank = TileBank()
+        self._tiles = {}    # Tiles handed out so far, by index
     
     def loadFromFile(self, filename):
-        """Load tiles from file"""
-       
-        tileNr=0
+        """Load tiles from file
+        
+        The whole file is read in one go. See loadFromBytes"""
         with open(filename, "rb") as f:
-            byte = f.read(1)
-            col = 0
-            byteArray = []
-            while True:
-                # A tile is 16 bytes. After each 16th byte, start a new tile
-                if col>15:
-                    tile = Tile()
-                    #print "Tile %d (0x%02X)" %(tileNr, tileNr)
-                    tile.setRawData(byteArray) # Write the raw data directly to the tile object
-                    #print tile.getAsciiMatrix()    # Print the tile as ascii graphic
-                    tile.setIndex(tileNr)
-                    self._tiles.append(tile)
-                    col = 0
-                    byteArray = []
-                    tileNr += 1
-                if byte == "":
-                    break
-                byteArray.append(ord(byte))
-                #print "0x%02X" %(ord(byte)),
-                col += 1
-                byte = f.read(1)
-
-        print "Loaded %d tiles from file" %(tileNr)
+            self.loadFromBytes(f.read())
+    
+    def loadFromBytes(self, data):
+        """Load tiles from a string or buffer with raw CHR data
+        
+        The data is stored in a TileBank and the tiles are
+        created first when they are asked for, as views into the bank.
+        Trailing bytes not filling up a whole tile are ignored."""
+        self._bank = TileBank()
+        self._bank.setData(data)
+        self._tiles = {}
+        
+    def loadFromBuffer(self, data):
+        """Load tiles from a read-only buffer with raw CHR data, e.g. a
+        buffer of a memory mapped file, without copying it.
+        See TileBank.setBuffer"""
+        self._bank = TileBank()
+        self._bank.setBuffer(data)
+        self._tiles = {}
+        
+    def loadFromPixels(self, pixels):
+        """Load tiles from pixel values 0,1,2,3 with 64 values per tile,
+        stored row by row (the format returned by decodeAll)"""
+        self._bank = TileBank()
+        self._bank.setPixels(pixels)
+        self._tiles = {}
+        
+    def getBank(self):
+        """Return the TileBank holding the raw data of all tiles"""
+        return self._bank
+    
+    def _getTile(self, idx):
+        """Return the tile with the given index, creating it
+        on first access"""
+        tile = self._tiles.get(idx)
+        if tile is None:
+            tile = self._bank.getTile(idx)
+            tile.setIndex(idx)
+            self._tiles[idx] = tile
+        return tile
+    
+    def getNumTiles(self):
+        """Return the number of tiles in the group"""
+        return self._bank.getNumTiles()
     
     def tilesIterator(self):
         """This method is using "yield" for returning the
         tiles"""
-        for tile in self._tiles:
-            yield tile
+        for idx in range(self._bank.getNumTiles()):
+            yield self._getTile(idx)
             
     def getTile(self, idx):
         """Get the tile with the given index"""
-        return self._tiles[idx]
+        return self._getTile(idx)
+    
+    def decodeAll(self):
+        """Decode all tiles in one pass. See TileBank.decodeAll"""
+        return self._bank.decodeAll()
+
+class TileBank:
+    """A bank of N tiles stored as raw CHR data in a single
+    bytearray of N*16 bytes.
+    
+    The Tile objects handed out by getTile are views into the bank,
+    so a complete bank takes about as much memory as its raw size.
+    
+    The raw data can also be a read-only buffer, see setBuffer. It is
+    then copied to a bytearray first when a tile is modified"""
+    def __init__(self, numTiles=0):
+        """Init"""
+        self._data = bytearray(numTiles*16)
+        self._readOnly = False  # True while _data is a read-only buffer
+        self._pixels = None # Decoded pixels, see decodeAll
+        self._listeners = []
+        self._version = 0
+        
+    def addListener(self, callback):
+        """Register a function to be called when tiles are modified.
+        It is called as callback(bank, tileNr, oldData), where tileNr is
+        None and oldData the old data of the whole bank when all tiles
+        are replaced"""
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+            
+    def removeListener(self, callback):
+        """Unregister a function registered by addListener"""
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+            
+    def getVersion(self):
+        """Return a number which is changed every time tiles are modified,
+        for users checking if what they computed from the bank is stale"""
+        return self._version
+            
+    def _notify(self, tileNr, oldData):
+        """Tell the listeners about modified tiles"""
+        self._version += 1
+        for callback in self._listeners:
+            callback(self, tileNr, oldData)
+        
+    def setData(self, data):
+        """Set the raw data of the whole bank. Trailing bytes not
+        filling up a whole tile are ignored"""
+        oldData = self._data
+        self._data = bytearray(data[:len(data)//16*16])
+        self._readOnly = False
+        self._pixels = None
+        self._notify(None, oldData)
+        
+    def setBuffer(self, data):
+        """Use a read-only buffer as the raw data of the whole bank,
+        without copying it. Trailing bytes not filling up a whole tile
+        are ignored"""
+        oldData = self._data
+        self._data = buffer(data, 0, len(data)//16*16)
+        self._readOnly = True
+        self._pixels = None
+        self._notify(None, oldData)
+        
+    def isReadOnly(self):
+        """Return True if the raw data is a read-only buffer, see setBuffer"""
+        return self._readOnly
+        
+    def setPixels(self, pixels):
+        """Set the whole bank from pixel values 0,1,2,3 with 64 values
+        per tile, see encodeTiles"""
+        oldData = self._data
+        self._data = encodeTiles(pixels)
+        self._readOnly = False
+        self._pixels = bytearray(pixels)
+        self._notify(None, oldData)
+        
+    def appendData(self, data, pixels=None):
+        """Append the raw data of whole tiles to the end of the bank.
+        pixels are the decoded pixels of the data, see decodeTiles, if
+        they are known. The listeners are called with tileNr None and an
+        empty oldData, as no tiles are replaced"""
+        assert(len(data)%16 == 0)
+        self._makeWritable()
+        if self._pixels is not None:
+            self._pixels.extend(pixels if pixels is not None else decodeTiles(data))
+        elif pixels is not None and not self._data:
+            self._pixels = bytearray(pixels)
+        self._data.extend(data)
+        self._notify(None, bytearray())
+        
+    def getData(self, firstTile=0, numTiles=None):
+        """Return a copy of the raw data of the whole bank, or of numTiles
+        tiles from firstTile on, as a bytearray. Modifying the copy does
+        not change the bank, use setData or setTileData for that"""
+        end = len(self._data) if numTiles is None else (firstTile+numTiles)*16
+        return bytearray(self._data[firstTile*16:end])
+    
+    def getNumTiles(self):
+        """Return the number of tiles in the bank"""
+        return len(self._data)//16
+    
+    def getTileData(self, tileNr):
+        """Return a copy of the 16 raw bytes of a tile"""
+        self._checkTileNr(tileNr)
+        return bytearray(self._data[tileNr*16:tileNr*16+16])
+    
+    def setTileData(self, tileNr, data):
+        """Set the 16 raw bytes of a tile"""
+        self._checkTileNr(tileNr)
+        assert(len(data) == 16)
+        data = bytearray(data)
+        self._makeWritable()
+        oldData = self._data[tileNr*16:tileNr*16+16]
+        self._data[tileNr*16:tileNr*16+16] = data
+        if self._pixels is not None:
+            self._pixels[tileNr*64:tileNr*64+64] = decodeTiles(data)
+        if oldData != data:
+            self._notify(tileNr, oldData)
+        
+    def appendTile(self, data=None):
+        """Add a tile to the end of the bank and return its number.
+        The tile is empty unless 16 raw bytes are given"""
+        tileNr = self.getNumTiles()
+        self._makeWritable()
+        self._data.extend(bytearray(16))
+        if self._pixels is not None:
+            self._pixels.extend(bytearray(64))
+        if data is not None:
+            self.setTileData(tileNr, data)
+        return tileNr
+        
+    def decodeAll(self):
+        """Return the pixel values (0,1,2,3) of all tiles as a bytearray 
+        with 64 bytes per tile, see decodeTiles.
+        
+        The result is cached and kept up to date when tiles are modified
+        through the bank, so it must not be modified by the caller"""
+        if self._pixels is None:
+            self._pixels = decodeTiles(self._data)
+        return self._pixels
+    
+    def getTilePixels(self, tileNr):
+        """Return the 64 pixel values of a tile, row by row"""
+        self._checkTileNr(tileNr)
+        return self.decodeAll()[tileNr*64:tileNr*64+64]
+        
+    def getTile(self, tileNr):
+        """Return a Tile which is a view into the bank"""
+        self._checkTileNr(tileNr)
+        return Tile(self, tileNr*16)
+    
+    def _makeWritable(self):
+        """Copy a read-only buffer to a bytearray before modifying it"""
+        if self._readOnly:
+            self._data = bytearray(self._data)
+            self._readOnly = False
+            
+    def _checkTileNr(self, tileNr):
+        """Make sure that the tile number is within the bank"""
+        if not 0<=tileNr<self.getNumTiles():
+            raise IndexError("Tile number %d out of range" %(tileNr))
 
 class CanvasPlotter:
-    def __init__(self, C):
+    """Plots tiles in a Tkinter canvas
+    
+    Two render modes are available:
+    "rectangle"  Every pixel is plotted as a rectangle with a black outline
+    "image"      The tiles are rasterized into a PhotoImage at the current
+                 scale, which is plotted as a single canvas item. The pixel
+                 grid is an optional overlay, see setGrid"""
+    RENDER_MODES = ("rectangle", "image")
+    SWEEP_SIZE = 64     # The number of held images when they are first swept, see _releaseImages
+    
+    def __init__(self, C, renderMode="rectangle"):
         self.scale={'x':1, 'y':1}  # x and y scale
         self.canvas = C
         self.canvas.bind("<B1-Motion>", self.canvas_paint)
         self._colors = importColors()
+        self.settings = {'renderMode':None,
+                         'grid':False,  # Draw the pixel grid in image mode
+                         }
+        # Tkinter does not keep references to the plotted images, so the images
+        # shown are kept here: image name: (image, canvas items showing it)
+        self._images = {}
+        self._sweepSize = self.SWEEP_SIZE
+        self._tileImages = TileImageCache(onRemove=self._imageRemoved)
+        self.setRenderMode(renderMode)
         
     def setScale(self, x, y):
         """Set the scale in x and y dimension"""
+        oldScale = (self.scale['x'], self.scale['y'])
         self.scale['x'] = x
         self.scale['y'] = y
+        if oldScale != (x, y):
+            self._tileImages.invalidateScale(oldScale)
+            
+    def getTileImageCache(self):
+        """Return the cache of rendered tile images used in image mode"""
+        return self._tileImages
+        
+    def setRenderMode(self, renderMode):
+        """Set the render mode, "rectangle" or "image" """
+        assert(renderMode in self.RENDER_MODES)
+        self.settings['renderMode'] = renderMode
+        
+    def setGrid(self, grid):
+        """Enable or disable the pixel grid overlay in image mode"""
+        self.settings['grid'] = grid
         
     def setFgBgColors(self, fgColor, bgColor):
         """Set the foreground and backround colors to be plotted"""
@@ -109,6 +322,10 @@ class CanvasPlotter:
         
     def plotTileInCanvas(self, tile, xOffset, yOffset):
         """Plot a tile inside canvas"""
+        if self.settings['renderMode'] == "image":
+            self._plotTileImage(tile, xOffset, yOffset)
+            return
+        
         matrix = tile.getIntMatrix()  # Get the data
         x=xOffset
         y=yOffset
@@ -121,10 +338,365 @@ class CanvasPlotter:
             y += self.scale['y']
             x = xOffset
             
+    def plotTileGroupInCanvas(self, tileGroup, palette, nTilesX, xOffset=0, yOffset=0):
+        """Plot all tiles of a tile group with nTilesX tiles per row,
+        using the same palette for all tiles.
+        
+        In image mode the whole group becomes a single image"""
+        if self.settings['renderMode'] == "image":
+            self._plotImage(tileGroup.decodeAll(), nTilesX, palette, xOffset, yOffset)
+            return
+        
+        for tile in tileGroup.tilesIterator():
+            tile.setPalette(palette)
+            row, col = divmod(tile.getIndex(), nTilesX)
+            self.plotTileInCanvas(tile, 
+                                  xOffset+col*8*self.scale['x'], 
+                                  yOffset+row*8*self.scale['y'])
+            
+    def _plotTileImage(self, tile, xOffset, yOffset):
+        """Plot a tile as an image, reusing a cached image of 
+        the same tile data, palette and scale"""
+        palette = tile.getPalette()
+        scale = (self.scale['x'], self.scale['y'])
+        key = (tile.getRawBytes(), tuple(palette.getColors()), scale)
+        image = self._tileImages.get(key)
+        if image is None:
+            image = self.createImage(tile.getPixels(), 1, palette)
+            self._tileImages.put(key, image, 4*image.width()*image.height())
+        self._plotImageItem(image, xOffset, yOffset, 8, 8)
+            
+    def _plotImage(self, pixels, nTilesX, palette, xOffset, yOffset):
+        """Rasterize tiles (64 pixel values per tile) to a PhotoImage
+        and plot it with its upper left corner at xOffset, yOffset"""
+        nTilesY = (len(pixels)//64+nTilesX-1)//nTilesX
+        image = self.createImage(pixels, nTilesX, palette)
+        self._plotImageItem(image, xOffset, yOffset, 8*nTilesX, 8*nTilesY)
+        
+    def createImage(self, pixels, nTilesX, palette):
+        """Rasterize tiles (64 pixel values per tile) to a PhotoImage
+        at the current scale"""
+        nTilesY = (len(pixels)//64+nTilesX-1)//nTilesX
+        colors = [self._tkColor(color) for color in palette.getColors()]
+        image = Tkinter.PhotoImage(width=8*nTilesX*self.scale['x'], 
+                                   height=8*nTilesY*self.scale['y'])
+        image.put(tilesToPhotoImageData(pixels, nTilesX, colors,
+                                        self.scale['x'], self.scale['y']))
+        return image
+    
+    def _plotImageItem(self, image, xOffset, yOffset, nPixelsX, nPixelsY):
+        """Plot an image with its upper left corner at xOffset, yOffset"""
+        item = self.canvas.create_image(xOffset, yOffset, image=image, anchor="nw")
+        self._images.setdefault(str(image), (image, []))[1].append(item)
+        if len(self._images) >= self._sweepSize:
+            self._releaseImages()
+            self._sweepSize = max(self.SWEEP_SIZE, 2*len(self._images))
+        if self.settings['grid']:
+            self._plotGrid(xOffset, yOffset, nPixelsX, nPixelsY)
+            
+    def _releaseImages(self, names=None):
+        """Forget the images (all or the given names) whose canvas items
+        have all been deleted. Cached images are still kept by the cache.
+        All images are swept each time the number of held images has
+        doubled, so that deleted items cost no more than plotted ones"""
+        for name in list(self._images if names is None else names):
+            image, items = self._images.get(name, (None, []))
+            items[:] = [item for item in items if self.canvas.type(item)]
+            if not items:
+                self._images.pop(name, None)
+                
+    def _imageRemoved(self, key, image):
+        """Called by the tile image cache when an image is evicted"""
+        self._releaseImages([str(image)])
+            
+    def _plotGrid(self, xOffset, yOffset, nPixelsX, nPixelsY):
+        """Plot the outline of every pixel as horizontal and vertical lines"""
+        xEnd = xOffset+nPixelsX*self.scale['x']
+        yEnd = yOffset+nPixelsY*self.scale['y']
+        for col in range(nPixelsX+1):
+            x = xOffset+col*self.scale['x']
+            self.canvas.create_line(x, yOffset, x, yEnd, fill="black")
+        for row in range(nPixelsY+1):
+            y = yOffset+row*self.scale['y']
+            self.canvas.create_line(xOffset, y, xEnd, y, fill="black")
+            
+    def _tkColor(self, color):
+        """Return a color Tkinter understands. Integers are indexes
+        into the NES palette, everything else is used as is"""
+        if isinstance(color, int):
+            return self._colors[color].tkColor()
+        return color
+            
     def canvas_paint(self, event):
         """Try to paint some pixels when left mouse button is pressed"""
         self.canvas.create_rectangle(event.x-10, event.y-10, event.x, event.y, fill = self._fgColor.tkColor() , outline = self._fgColor.tkColor())
         
+class TileImageCache:
+    """A bounded cache of rendered tile images where the least 
+    recently used images are evicted first.
+    
+    The images are stored with the key (raw tile data, palette colors, 
+    scale) and an estimate of their size in bytes. As the key holds
+    the contents, an entry never goes stale when a tile or palette is
+    modified. The modified tile simply gets another key, and entries
+    no longer used are evicted as the least recently used. The entries
+    of a scale no longer used are invalidated explicitly."""
+    def __init__(self, maxBytes=4*1024*1024, onRemove=None):
+        """Init
+        onRemove   Called as onRemove(key, image) when an image is evicted
+                   or invalidated"""
+        self._entries = collections.OrderedDict() # key: (image, nBytes)
+        self._onRemove = onRemove
+        self._nBytes = 0
+        self.settings = {'maxBytes':maxBytes}
+        self._stats = {'hits':0, 'misses':0, 'evictions':0, 'invalidations':0}
+        
+    def setMaxBytes(self, maxBytes):
+        """Set the memory cap in bytes"""
+        self.settings['maxBytes'] = maxBytes
+        self._evict()
+        
+    def get(self, key):
+        """Return the image stored with key or None"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self._stats['misses'] += 1
+            return None
+        self._entries[key] = entry # Move last, as most recently used
+        self._stats['hits'] += 1
+        return entry[0]
+    
+    def put(self, key, image, nBytes):
+        """Store an image with its size in bytes"""
+        self._remove(key)
+        self._entries[key] = (image, nBytes)
+        self._nBytes += nBytes
+        self._evict()
+        
+    def getStats(self):
+        """Return a dict with the hit/miss counters and the current size"""
+        stats = dict(self._stats)
+        stats['entries'] = len(self._entries)
+        stats['bytes'] = self._nBytes
+        return stats
+    
+    def clear(self):
+        """Remove all images"""
+        self._entries.clear()
+        self._nBytes = 0
+    
+    def invalidateScale(self, scale):
+        """Remove the images rendered with scale (x, y)"""
+        scale = tuple(scale)
+        for key in [key for key in self._entries if key[2] == scale]:
+            self._remove(key)
+            self._stats['invalidations'] += 1
+            
+    def _remove(self, key):
+        """Remove an entry if it exists"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nBytes -= entry[1]
+            if self._onRemove is not None:
+                self._onRemove(key, entry[0])
+            
+    def _evict(self):
+        """Evict the least recently used entries until below the memory cap"""
+        while self._entries and self._nBytes > self.settings['maxBytes']:
+            key, (image, nBytes) = self._entries.popitem(last=False)
+            self._nBytes -= nBytes
+            self._stats['evictions'] += 1
+            if self._onRemove is not None:
+                self._onRemove(key, image)
+        
+class TileBankViewer(Tkinter.Frame):
+    """A scrollable view of all tiles of a tile group.
+    
+    Only the rows of tiles in the visible part of the canvas, plus a
+    margin of rows above and below, are drawn. Every row of tiles is a
+    single image, rendered from the raw data of the row when it first
+    becomes visible and kept in a TileImageCache. The canvas items of
+    rows scrolled out of view are reused for the rows scrolled into
+    view, so the number of items stays the same however large the 
+    tile group is"""
+    def __init__(self, master, tileGroup, palette, nTilesX=16, scale=3, nRowsVisible=16, 
+                 margin=2, **kwargs):
+        """Init
+        nTilesX        The number of tiles in a row
+        scale          The number of screen pixels per tile pixel
+        nRowsVisible   The initial height of the view in rows of tiles
+        margin         The number of rows drawn outside the view"""
+        Tkinter.Frame.__init__(self, master, **kwargs)
+        self.settings = {'nTilesX':nTilesX, 'scale':scale, 'margin':margin}
+        rowHeight = 8*scale
+        self.canvas = Tkinter.Canvas(self, bg="grey", width=8*nTilesX*scale, 
+                                     height=nRowsVisible*rowHeight, cursor="crosshair")
+        self._scrollbar = Tkinter.Scrollbar(self, orient="vertical", command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self._onScroll)
+        self._scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.canvas.bind("<Configure>", lambda event: self._scheduleUpdate())
+        
+        self._plotter = CanvasPlotter(self.canvas, renderMode="image")
+        self._plotter.setScale(scale, scale)
+        self._rowImages = TileImageCache()
+        self._rowItems = {}     # Row number: (canvas item showing the row, its image)
+        self._staleRows = set() # Drawn rows whose tiles or colors have changed
+        self._updatePending = False
+        self._tileGroup = None
+        self._bank = None       # The bank listened to
+        self._numTiles = 0
+        self._palette = None
+        self.setPalette(palette)
+        self.setTileGroup(tileGroup)
+        
+    def getPlotter(self):
+        """Return the CanvasPlotter of the canvas"""
+        return self._plotter
+    
+    def setTileGroup(self, tileGroup):
+        """Show another tile group"""
+        if self._bank is not None:
+            self._bank.removeListener(self._tilesChanged)
+        self._tileGroup = tileGroup
+        self._bank = tileGroup.getBank()
+        self._bank.addListener(self._tilesChanged)
+        self._redraw()
+        
+    def setPalette(self, palette):
+        """Show the tiles with another palette"""
+        if self._palette is not None:
+            self._palette.removeListener(self._paletteChanged)
+        self._palette = palette
+        palette.addListener(self._paletteChanged)
+        self._redraw()
+        
+    def getNumRows(self):
+        """Return the number of rows of tiles"""
+        nTilesX = self.settings['nTilesX']
+        return (self._tileGroup.getNumTiles()+nTilesX-1)//nTilesX
+        
+    def _redraw(self, rows=None):
+        """Draw the given rows (all drawn rows if None) again, after
+        their tiles or colors changed"""
+        if self._tileGroup is None:
+            return
+        self._staleRows.update(self._rowItems if rows is None else rows)
+        self._numTiles = self._tileGroup.getNumTiles()
+        rowHeight = 8*self.settings['scale']
+        self.canvas.configure(scrollregion=(0, 0, 8*self.settings['nTilesX']*self.settings['scale'],
+                                            self.getNumRows()*rowHeight))
+        self._scheduleUpdate()
+        
+    def _onScroll(self, first, last):
+        """Called by the canvas when the view has moved"""
+        self._scrollbar.set(first, last)
+        self._scheduleUpdate()
+        
+    def _scheduleUpdate(self):
+        """Update the drawn rows when Tkinter is idle, once for
+        a number of scroll events"""
+        if not self._updatePending:
+            self._updatePending = True
+            self.after_idle(self._update)
+            
+    def _update(self):
+        """Draw the rows in view which are not drawn or are stale,
+        reusing the items of rows out of view"""
+        self._updatePending = False
+        rowHeight = 8*self.settings['scale']
+        top = self.canvas.canvasy(0)
+        first, last = visibleRows(top, self.canvas.winfo_height(), rowHeight, 
+                                  self.getNumRows(), self.settings['margin'])
+        unused = [item for row, (item, image) in self._rowItems.items() if not first <= row < last]
+        self._rowItems = dict([(row, entry) for row, entry in self._rowItems.items() 
+                               if first <= row < last])
+        for row in range(first, last):
+            if row in self._rowItems and row not in self._staleRows:
+                continue
+            image = self._getRowImage(row)
+            if row in self._rowItems:
+                item = self._rowItems[row][0]
+                self.canvas.itemconfigure(item, image=image)
+            elif unused:
+                item = unused.pop()
+                self.canvas.coords(item, 0, row*rowHeight)
+                self.canvas.itemconfigure(item, image=image)
+            else:
+                item = self.canvas.create_image(0, row*rowHeight, image=image, anchor="nw")
+            # The item holds the image, which may be evicted from the cache
+            self._rowItems[row] = (item, image)
+        for item in unused:
+            self.canvas.delete(item)
+        self._staleRows.clear()
+            
+    def _getRowImage(self, row):
+        """Return the image of a row of tiles, rendering it if needed.
+        The images are cached by the data of the row, so an image never
+        goes stale and the images of unchanged rows are reused"""
+        nTilesX = self.settings['nTilesX']
+        rowData = bytes(self._tileGroup.getBank().getData(row*nTilesX, nTilesX))
+        scale = (self.settings['scale'], self.settings['scale'])
+        key = (rowData, tuple(self._palette.getColors()), scale)
+        image = self._rowImages.get(key)
+        if image is None:
+            image = self._plotter.createImage(decodeTiles(rowData), nTilesX, self._palette)
+            self._rowImages.put(key, image, 4*image.width()*image.height())
+        return image
+    
+    def _tilesChanged(self, bank, tileNr, oldData):
+        """Listener for the tile bank, drawing the changed rows again"""
+        nTilesX = self.settings['nTilesX']
+        if tileNr is not None:
+            self._redraw([tileNr//nTilesX])
+        elif not oldData:
+            # Tiles were appended. Of the drawn rows, only the last one can change
+            self._redraw([self._numTiles//nTilesX])
+        else:
+            self._redraw()
+        
+    def _paletteChanged(self, palette, oldColors):
+        """Listener for the palette"""
+        self._redraw()
+        
+def visibleRows(top, height, rowHeight, nRows, margin=0):
+    """Return (first, last) of the rows of height rowHeight that are
+    visible in a view from y = top with the given height, extended with
+    margin rows above and below. last is the row after the last row"""
+    first = max(0, int(top)//rowHeight - margin)
+    last = min(nRows, (int(top)+int(height)+rowHeight-1)//rowHeight + margin)
+    return first, max(first, last)
+        
+def tilesToPhotoImageData(pixels, nTilesX, colors, xScale=1, yScale=1):
+    """Return tiles in the data format used by Tkinter.PhotoImage.put:
+    "{color color ...} {color color ...} ...", one {} per pixel row.
+    
+    pixels    Pixel values with 64 values per tile (see decodeTiles)
+    nTilesX   Number of tiles in a row. A last row that is not filled up
+              is padded with color 0
+    colors    The four colors as strings that Tkinter understands
+    xScale, yScale  Every pixel is repeated this number of times"""
+    nTiles = len(pixels)//64
+    nTilesY = (nTiles+nTilesX-1)//nTilesX
+    pixels = bytes(bytearray(pixels) + bytearray((nTilesX*nTilesY-nTiles)*64))
+    
+    segments = {} # The rows of 8 pixels already converted to colors
+    rows = []
+    for tileRow in range(nTilesY):
+        for y in range(8):
+            row = []
+            for tileNr in range(tileRow*nTilesX, (tileRow+1)*nTilesX):
+                start = tileNr*64+y*8
+                pixelRow = pixels[start:start+8]
+                segment = segments.get(pixelRow)
+                if segment is None:
+                    segment = " ".join([colors[pixel] for pixel in bytearray(pixelRow)
+                                        for i in range(xScale)])
+                    segments[pixelRow] = segment
+                row.append(segment)
+            rows.extend(["{%s}" %(" ".join(row))]*yScale)
+    return " ".join(rows)
+        
 def bitstreamToByte(bitstream):
     """Convert a bitstream ([0, 0, 1, 0, ...]) 
     to a byte (0xAB)"""
@@ -135,6 +707,79 @@ def bitstreamToByte(bitstream):
             byte += 2**(7-i)
     return byte
 
+_decodeTable = None
+
+def _getDecodeTable():
+    """Return a table translating the two channel bytes of a tile row,
+    indexed as channelB*256+channelA, to the 8 pixel values of the
+    row as a string of 8 bytes. The table is built on first use"""
+    global _decodeTable
+    if _decodeTable is None:
+        # Spread the bits of a byte to one bit per byte of a 64 bit word
+        spread = []
+        for byte in range(256):
+            word = 0
+            for bit in range(8):
+                if byte & (0x80>>bit):
+                    word |= 1<<(8*(7-bit))
+            spread.append(word)
+        pack = struct.Struct(">Q").pack
+        _decodeTable = [pack(spread[byteA] + 2*spread[byteB]) 
+                        for byteB in range(256) for byteA in range(256)]
+    return _decodeTable
+
+def decodeTiles(data):
+    """Decode raw CHR data (16 bytes per tile) to pixel values 0,1,2,3
+    
+    The result is a bytearray with 64 bytes per tile, stored row by row.
+    The pixel at x,y of tile n is found at n*64+y*8+x"""
+    data = bytearray(data)
+    table = _getDecodeTable()
+    return bytearray(b"".join([table[(data[i+8]<<8) | data[i]] 
+                               for tileStart in range(0, len(data)//16*16, 16)
+                               for i in range(tileStart, tileStart+8)]))
+
+_encodeTable = None
+
+def _getEncodeTable():
+    """Return a dict translating the 8 pixel values of a tile row, as a
+    string of 8 bytes, to channelB*256+channelA. This is the inverse of
+    the decode table"""
+    global _encodeTable
+    if _encodeTable is None:
+        _encodeTable = dict((row, key) for key, row in enumerate(_getDecodeTable()))
+    return _encodeTable
+
+def encodeTiles(pixels):
+    """Encode pixel values 0,1,2,3 to raw CHR data (16 bytes per tile)
+    
+    This is the inverse of decodeTiles. The pixels are given as a 
+    bytearray, string or list with 64 values per tile, stored row by row.
+    An AttributeError is raised for pixel values other than 0,1,2,3"""
+    assert(len(pixels)%64 == 0)
+    try:
+        pixels = bytes(bytearray(pixels))
+    except (ValueError, TypeError):
+        raise AttributeError("Wrong pixel value!")
+    
+    # Rows with pixel values out of range are simply not found in the table
+    table = _getEncodeTable()
+    try:
+        rows = [table[pixels[i:i+8]] for i in range(0, len(pixels), 8)]
+    except KeyError:
+        raise AttributeError("Wrong pixel value!")
+    
+    channelA = bytearray([row & 0xFF for row in rows])
+    channelB = bytearray([row>>8 for row in rows])
+    data = bytearray(len(rows)*2)
+    for i in range(0, len(rows), 8):
+        data[i*2:i*2+8] = channelA[i:i+8]
+        data[i*2+8:i*2+16] = channelB[i:i+8]
+    return data
+
+# Translates pixel values 0,1,2,3 to the ascii characters "0123"
+_ASCII_PIXELS = b"0123" + bytes(bytearray(range(4, 256)))
+
 class Pixel:
     """A pixel with  specific color"""
     def __init__(self):
@@ -146,12 +791,33 @@ class Palette:
     def __init__(self):
         """Init"""
         self.colors=None
+        self._listeners = []
+        self._version = 0
+        
+    def addListener(self, callback):
+        """Register a function to be called as callback(palette, oldColors)
+        when the colors are changed"""
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+            
+    def removeListener(self, callback):
+        """Unregister a function registered by addListener"""
+        if callback in self._listeners:
+            self._listeners.remove(callback)
         
     def setColors(self, colors):
         """Set the four colors to use
         Arguments:
         colors    A list with four colors"""
+        oldColors = self.colors
         self.colors = colors
+        self._version += 1
+        for callback in self._listeners:
+            callback(self, oldColors)
+        
+    def getVersion(self):
+        """Return a number which is changed every time the colors are set"""
+        return self._version
         
     def getColors(self):
         """Return the colors list"""
@@ -161,7 +827,7 @@ class Palette:
         """Return the color specified by index argument"""
         return self.colors[index]
     
-class Tile:
+class Tile(object):
     """An 8x8 pixel tile
     
     A tile is stored as two 8 byte color channels. 
@@ -173,13 +839,32 @@ class Tile:
     
     
     Ref
-    [1]: https://sadistech.com/nesromtool/romdoc.html"""
-    def __init__(self):
+    [1]: https://sadistech.com/nesromtool/romdoc.html
+    
+    The 16 bytes are not stored in the tile itself. The tile is a view
+    at a byte offset into a TileBank. A tile created on its own gets a
+    bank of its own when its data is first set."""
+    __slots__ = ('_bank', '_offset', 'index', 'palette')
+    
+    def __init__(self, bank=None, offset=0):
         """Init"""
-        self.data = None
+        self._bank = bank
+        self._offset = offset
         self.index = None
         self.palette = None
         
+    @property
+    def data(self):
+        """The raw data as two channels of 8 bytes, or None
+        if no data has been set"""
+        if self._bank is None:
+            return None
+        return self.getRawData()
+    
+    def getBank(self):
+        """Return the TileBank holding the raw data"""
+        return self._bank
+        
     def setPalette(self, palette):
         """Set the palette to be used with this tile"""
         self.palette = palette
@@ -200,39 +885,31 @@ class Tile:
         """Set the data according to the input pixels"""
         assert(len(pixels) == 8)
         
-        bytestreamA=[]
-        bytestreamB=[]
+        flatPixels = []
         for row in pixels:
-            bitstreamA=[]
-            bitstreamB=[]
-            for col in row:
-                if col==0:
-                    bitstreamA.append(0)
-                    bitstreamB.append(0)
-                elif col==1:
-                    bitstreamA.append(1)
-                    bitstreamB.append(0)
-                elif col==2:
-                    bitstreamA.append(0)
-                    bitstreamB.append(1)
-                elif col==3:
-                    bitstreamA.append(1)
-                    bitstreamB.append(1)
-                else:
-                    raise AttributeError("Wrong pixel value!")
-            bytestreamA.append(bitstreamToByte(bitstreamA))
-            bytestreamB.append(bitstreamToByte(bitstreamB))
-        self.data = [bytestreamA, bytestreamB]
+            assert(len(row) == 8)
+            flatPixels.extend(row)
+        self.setRawData(encodeTiles(flatPixels))
 
         
     def setRawData(self, data):
         """Set the data directly to the tile as a 16 byte array"""
-        self.data = [data[:8],data[8:16]]
+        if self._bank is None:
+            self._bank = TileBank(1)
+            self._offset = 0
+        self._bank.setTileData(self._offset//16, data[:16])
         
     def getRawData(self):
         """Return 8x8 pixels of data
         in the correct raw data format"""
-        return self.data
+        if self._bank is None:
+            return None
+        data = self._bank.getTileData(self._offset//16)
+        return [list(data[:8]), list(data[8:16])]
+    
+    def getRawBytes(self):
+        """Return the 16 bytes of raw data as a string"""
+        return bytes(self._bank.getTileData(self._offset//16))
     
     def getAsciiMatrix(self):
         """Return an 8x8 ascii matrix of the tile,
@@ -241,34 +918,21 @@ class Tile:
         00010000
         00120000
         ..."""
-        asciiStr = ""
-        for i in range(8):
-            # Loop through 8 bytes
-            byteA=self.data[0][i]
-            byteB=self.data[1][i]
-            for bit in range(8):
-                val = ((byteA>>(7-bit))&0x01) + 2*((byteB>>(7-bit))&0x01)
-                asciiStr += "%d" %val
-            asciiStr += '\n'
-        return asciiStr
+        pixels = str(self.getPixels().translate(_ASCII_PIXELS))
+        return "".join([pixels[i:i+8]+'\n' for i in range(0, 64, 8)])
     
     def getIntMatrix(self):
         """Return an 8x8 matrix (a list of lists) with numbers 0,1,2,3
         corresponding to colors.
         Example:
         [[0,0,0,1,0,0,3,0],[0,0,1,1,0,0,1,0],...]"""
-        intMatrix = []
-        for i in range(8):
-            # Loop through 8 bytes
-            byteA=self.data[0][i]
-            byteB=self.data[1][i]
-            intListInner=[]
-            for bit in range(8):
-                val = ((byteA>>(7-bit))&0x01) + 2*((byteB>>(7-bit))&0x01)
-                intListInner.append(val)
-            intMatrix.append(intListInner)
-        return intMatrix
-
+        pixels = self.getPixels()
+        return [list(pixels[i:i+8]) for i in range(0, 64, 8)]
+    
+    def getPixels(self):
+        """Return the 64 pixel values of the tile, row by row, from
+        the decoded pixels cached in the bank"""
+        return self._bank.getTilePixels(self._offset//16)
 
     
 class Screen:
@@ -339,7 +1003,225 @@ class TestTile(unittest.TestCase):
                 self.assertEqual(data, rawData[i])
                 i+=1
                 
+class TestTileBank(unittest.TestCase):
+    def test_views(self):
+        """Tiles write through to the bank"""
+        bank = TileBank(2)
+        self.assertEqual(len(bank.getData()), 32)
+        tile = bank.getTile(1)
+        tile.setRawData(range(16))
+        self.assertEqual(bank.getData()[16:], bytearray(range(16)))
+        self.assertEqual(bank.getData(1, 1), bytearray(range(16)))
+        bank.getData()[0] = 0xFF     # A copy
+        self.assertEqual(bank.getTileData(0), bytearray(16))
+        self.assertEqual(bank.getTile(0).getRawData(), [[0]*8, [0]*8])
+        
+        self.assertEqual(bank.appendTile([0xFF]*16), 2)
+        self.assertEqual(bank.getTile(2).getIntMatrix()[7], [3]*8)
+        self.assertRaises(IndexError, bank.getTile, 3)
+        self.assertRaises(AttributeError, setattr, tile, 'foo', 1) # No __dict__ 
+
+class TestDecodeTiles(unittest.TestCase):
+    def test_decode(self):
+        """Compare with decoding one bit at a time"""
+        data = bytearray([(i*37+11)&0xFF for i in range(16*5)])
+        pixels = decodeTiles(data)
+        self.assertEqual(len(pixels), 5*64)
+        for i in range(5*8):
+            byteA = data[(i//8)*16+i%8]
+            byteB = data[(i//8)*16+i%8+8]
+            for bit in range(8):
+                val = ((byteA>>(7-bit))&0x01) + 2*((byteB>>(7-bit))&0x01)
+                self.assertEqual(pixels[i*8+bit], val)
+                
+    def test_buffer(self):
+        """A read-only buffer is copied on write"""
+        data = bytes(bytearray(range(40)))
+        bank = TileBank()
+        bank.setBuffer(data)
+        self.assertTrue(bank.isReadOnly())
+        self.assertEqual(bank.getNumTiles(), 2)
+        self.assertEqual(bank.getTile(1).getRawBytes(), data[16:32])
+        self.assertEqual(bank.decodeAll(), decodeTiles(data[:32]))
+        bank.setTileData(0, bytearray(16))
+        self.assertFalse(bank.isReadOnly())
+        self.assertEqual(bank.getData(), bytearray(16) + bytearray(data[16:32]))
+        self.assertEqual(data, bytes(bytearray(range(40))))
+        
+    def test_appendData(self):
+        bank = TileBank(1)
+        pixels = bank.decodeAll()
+        calls = []
+        bank.addListener(lambda bank, tileNr, oldData: calls.append((tileNr, oldData)))
+        data = bytearray(range(32))
+        bank.appendData(data)
+        self.assertEqual(bank.getNumTiles(), 3)
+        self.assertEqual(bank.getTileData(2), data[16:])
+        self.assertEqual(bank.decodeAll(), pixels[:64] + decodeTiles(data))
+        self.assertEqual(calls, [(None, bytearray())])
+        
+    def test_removeListener(self):
+        bank = TileBank(1)
+        calls = []
+        listener = lambda bank, tileNr, oldData: calls.append(tileNr)
+        bank.addListener(listener)
+        bank.setTileData(0, [1]*16)
+        bank.removeListener(listener)
+        bank.setTileData(0, [2]*16)
+        self.assertEqual(calls, [0])
+        
+    def test_cache(self):
+        """The decoded pixels follow modifications of the bank"""
+        tileGroup = TileGroup()
+        tileGroup.loadFromBytes(bytearray(32))
+        self.assertEqual(tileGroup.decodeAll(), bytearray(64*2))
+        tileGroup.getTile(1).setRawData([0]*8 + [0x80]*8)
+        self.assertEqual(tileGroup.decodeAll()[64:72], bytearray([2,0,0,0,0,0,0,0]))
+        self.assertEqual(tileGroup.getTile(1).getAsciiMatrix(), "20000000\n"*8)
+        tileGroup.getBank().appendTile()
+        self.assertEqual(len(tileGroup.decodeAll()), 64*3)
+
+class TestEncodeTiles(unittest.TestCase):
+    def test_encode(self):
+        """Compare with encoding through bitstreamToByte"""
+        pixels = [(i*7+i//5)%4 for i in range(64*3)]
+        expected = []
+        for tileStart in range(0, len(pixels), 64):
+            channelA = []
+            channelB = []
+            for rowStart in range(tileStart, tileStart+64, 8):
+                row = pixels[rowStart:rowStart+8]
+                channelA.append(bitstreamToByte([p&0x01 for p in row]))
+                channelB.append(bitstreamToByte([p>>1 for p in row]))
+            expected += channelA + channelB
+        self.assertEqual(encodeTiles(pixels), bytearray(expected))
+        self.assertEqual(decodeTiles(encodeTiles(pixels)), bytearray(pixels))
+        
+    def test_wrong_pixel_value(self):
+        self.assertRaises(AttributeError, encodeTiles, [0]*63+[4])
+        self.assertRaises(AttributeError, encodeTiles, [0]*63+[-1])
+        self.assertRaises(AttributeError, encodeTiles, [0]*63+[256])
+        
+    def test_loadFromPixels(self):
+        tileGroup = TileGroup()
+        tileGroup.loadFromPixels([3]*64 + [1]*64)
+        self.assertEqual(tileGroup.getNumTiles(), 2)
+        self.assertEqual(tileGroup.getTile(1).getRawData(), [[0xFF]*8, [0]*8])
+        self.assertEqual(tileGroup.decodeAll(), bytearray([3]*64 + [1]*64))
+
+class TestPhotoImageData(unittest.TestCase):
+    def test_scale(self):
+        colors = ['a', 'b', 'c', 'd']
+        pixels = [0,1,2,3,0,0,0,0]*8
+        data = tilesToPhotoImageData(pixels, 1, colors, xScale=2, yScale=1)
+        self.assertEqual(data, " ".join(["{a a b b c c d d a a a a a a a a}"]*8))
+        data = tilesToPhotoImageData(pixels, 2, colors, xScale=1, yScale=2)
+        self.assertEqual(data, " ".join(["{a b c d a a a a a a a a a a a a}"]*16))
+
+class TestVisibleRows(unittest.TestCase):
+    def test_visibleRows(self):
+        self.assertEqual(visibleRows(0, 100, 24, 4096), (0, 5))
+        self.assertEqual(visibleRows(0, 100, 24, 4096, margin=2), (0, 7))
+        self.assertEqual(visibleRows(2400, 96, 24, 4096, margin=1), (99, 105))
+        self.assertEqual(visibleRows(2400, 96, 24, 100, margin=1), (99, 100))
+        self.assertEqual(visibleRows(0, 100, 24, 0), (0, 0))
+        
+class TestTileImageCache(unittest.TestCase):
+    def test_lru(self):
+        removed = []
+        cache = TileImageCache(maxBytes=20, onRemove=lambda key, image: removed.append(image))
+        cache.put(("a", (0,1,2,3), (1,1)), "imageA", 10)
+        cache.put(("b", (0,1,2,3), (1,1)), "imageB", 10)
+        self.assertEqual(cache.get(("a", (0,1,2,3), (1,1))), "imageA")
+        cache.put(("c", (0,1,2,3), (1,1)), "imageC", 10) # Evicts b
+        self.assertEqual(cache.get(("b", (0,1,2,3), (1,1))), None)
+        stats = cache.getStats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 1, 1))
+        self.assertEqual((stats['entries'], stats['bytes']), (2, 20))
+        self.assertEqual(removed, ["imageB"])
+        
+    def test_invalidate(self):
+        cache = TileImageCache()
+        cache.put((b"\x00"*16, (0,1,2,3), (1,1)), "image1", 1)
+        cache.put((b"\x00"*16, (0,1,2,3), (2,2)), "image2", 1)
+        cache.put((b"\xFF"*16, (0,1,2,3), (1,1)), "image3", 1)
+        cache.put((b"\xFF"*16, (4,5,6,7), (1,1)), "image4", 1)
+        cache.invalidateScale((2,2))
+        self.assertEqual(cache.getStats()['entries'], 3)
+        self.assertEqual(cache.getStats()['invalidations'], 1)
+        self.assertEqual(cache.get((b"\x00"*16, (0,1,2,3), (2,2))), None)
+        self.assertEqual(cache.get((b"\xFF"*16, (4,5,6,7), (1,1))), "image4")
+
+class _FakeCanvas:
+    """The part of a Tkinter canvas used by CanvasPlotter to plot images"""
+    def __init__(self):
+        self.items = {}
+    def bind(self, sequence, function):
+        pass
+    def create_image(self, x, y, image, anchor):
+        self.items[len(self.items)+1] = image
+        return len(self.items)
+    def delete(self, item):
+        self.items[item] = None
+    def type(self, item):
+        return "image" if self.items.get(item) is not None else None
+    
+class TestCanvasPlotter(unittest.TestCase):
+    def test_releaseImages(self):
+        """Only the images of items still on the canvas are held"""
+        canvas = _FakeCanvas()
+        plotter = CanvasPlotter(canvas, renderMode="image")
+        for i in range(CanvasPlotter.SWEEP_SIZE-1):
+            plotter._plotImageItem("image%d" %(i), 0, 0, 8, 8)
+            canvas.delete(i+1)
+        plotter._plotImageItem("image0", 0, 0, 8, 8)
+        plotter._plotImageItem("shown", 0, 0, 8, 8)
+        self.assertEqual(sorted(plotter._images), ["image0", "shown"])
+        
+        plotter.getTileImageCache().put("key", "shown", 10)
+        canvas.delete(CanvasPlotter.SWEEP_SIZE+1)
+        plotter.getTileImageCache().setMaxBytes(0)
+        self.assertEqual(sorted(plotter._images), ["image0"])
+        
+class TestTileGroup(unittest.TestCase):
+    def test_loadFromBytes(self):
+        """Tiles are views into the bank of the tile group"""
+        rawData = bytearray(range(32)) + bytearray(5) # Two tiles and some trailing bytes
+        tileGroup = TileGroup()
+        tileGroup.loadFromBytes(rawData)
+        self.assertEqual(tileGroup.getNumTiles(), 2)
+        
+        tile = tileGroup.getTile(1)
+        self.assertEqual(tile.getIndex(), 1)
+        self.assertEqual(tile.getRawData(), [list(range(16,24)), list(range(24,32))])
+        self.assertTrue(tile is tileGroup.getTile(1))
+        self.assertEqual([t.getIndex() for t in tileGroup.tilesIterator()], [0,1])
+        
+        tile.setRawData([0xFF]*16)
+        self.assertEqual(tileGroup.getTile(0).getRawData()[0], list(range(8)))
+        self.assertEqual(tile.getIntMatrix()[0], [3]*8)
+        self.assertEqual(tileGroup.getBank().getData()[16:32], bytearray([0xFF]*16))
+        
+    def test_tileState(self):
+        """The group keeps the state of its tiles, and the tiles
+        write through to the bank"""
+        tileGroup = TileGroup()
+        tileGroup.loadFromBytes(bytearray(32))
+        palette = Palette()
+        tileGroup.getTile(1).setPalette(palette)
+        tileGroup.getTile(1).setIndex(5)
+        import gc
+        gc.collect()
+        self.assertTrue(tileGroup.getTile(1).getPalette() is palette)
+        self.assertEqual(tileGroup.getTile(1).getIndex(), 5)
+        
+        tileGroup.getTile(0).setRawData([0xFF]*16)
+        self.assertEqual(tileGroup.getBank().getTileData(0), bytearray([0xFF]*16))
+        tileGroup.loadFromBytes(bytearray(32))
+        self.assertEqual(tileGroup.getTile(1).getPalette(), None)
         
 if __name__=="__main__":
     print "Running main..."
-    run()
\ No newline at end of file
+    # Run the imported module, whose classes are the ones profiled
+    import plotter
+    plotter.run(*sys.argv[1:2])
\ No newline at end of file
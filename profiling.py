@@ -0,0 +1,293 @@
+"""Opt-in profiling of the hot paths
+
+Profiling is enabled by calling enable(), or by setting the environment
+variable NES_TOOLS_PROFILE when running build.py, benchmark.py or the
+viewers of plotter.py and nametable.py. The value of the variable is the
+prefix of the report files, or 1 for the default prefix
+"nes_tools_profile".
+
+Work done by a pool of processes is profiled by running it through
+profileCall in the workers, which returns the collected stats with the
+result. They are added to the stats of the profiled process by
+addProfile, see build.py.
+
+When enabled, the hot paths listed in HOT_PATHS are wrapped to count
+the calls and collect the wall time of every call in a histogram, and
+the whole run is profiled with cProfile. At exit, or when writeReport
+is called, two files are written:
+
+PREFIX.txt    The calls, times and histograms of the hot paths
+PREFIX.prof   The cProfile statistics, to be read with pstats
+
+Nothing is wrapped or profiled unless profiling is enabled, so there
+is no overhead at all when it is disabled."""
+import atexit
+import cProfile
+import functools
+import importlib
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+
+ENV_VARIABLE = "NES_TOOLS_PROFILE"
+DEFAULT_PREFIX = "nes_tools_profile"
+
+# The wrapped methods: (module, class, method)
+HOT_PATHS = [("plotter", "TileGroup", "loadFromFile"),
+             ("plotter", "Tile", "getIntMatrix"),
+             ("plotter", "CanvasPlotter", "plotTileInCanvas"),
+             ("nametable", "Nametable", "dumpToFile"),
+             ]
+
+_state = {'prefix':None,     # The report prefix, None when disabled
+          'profile':None,    # The cProfile.Profile
+          'originals':{},    # (class, method name): original function
+          'stats':{},        # Hot path name: HotPathStats
+          'workerProfiles':[],  # cProfile stats added by addProfile
+          'atexit':False,    # True when writeReport is registered
+          }
+
+class HotPathStats:
+    """Calls and wall times of a hot path. The histogram counts the calls
+    by time, bucket n holding the calls taking less than 2**n microseconds"""
+    def __init__(self):
+        """Init"""
+        self.calls = 0
+        self.seconds = 0.0
+        self.maxSeconds = 0.0
+        self.histogram = []
+
+    def add(self, seconds):
+        """Add a call taking the given time"""
+        self.calls += 1
+        self.seconds += seconds
+        self.maxSeconds = max(self.maxSeconds, seconds)
+        bucket = int(seconds*1e6).bit_length()
+        if bucket >= len(self.histogram):
+            self.histogram.extend([0]*(bucket+1-len(self.histogram)))
+        self.histogram[bucket] += 1
+        
+    def merge(self, other):
+        """Add the calls of another HotPathStats"""
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.maxSeconds = max(self.maxSeconds, other.maxSeconds)
+        if len(other.histogram) > len(self.histogram):
+            self.histogram.extend([0]*(len(other.histogram)-len(self.histogram)))
+        for bucket, count in enumerate(other.histogram):
+            self.histogram[bucket] += count
+
+    def getLines(self, name):
+        """Return the lines of the report of the hot path"""
+        lines = ["%s: %d calls, %.3f ms total, %.3f ms mean, %.3f ms max\n"
+                 %(name, self.calls, self.seconds*1000,
+                   self.seconds*1000/max(self.calls, 1), self.maxSeconds*1000)]
+        for bucket, count in enumerate(self.histogram):
+            if count:
+                lines.append("    < %8d us  %d\n" %(2**bucket, count))
+        return lines
+
+def isEnabled():
+    """Return True if profiling is enabled"""
+    return _state['prefix'] is not None
+
+def enable(prefix=DEFAULT_PREFIX, writeAtExit=True):
+    """Enable profiling, writing the report files with the given prefix
+    at exit unless writeAtExit is false"""
+    if isEnabled():
+        return
+    _state['prefix'] = prefix
+    for moduleName, className, methodName in HOT_PATHS:
+        cls = getattr(importlib.import_module(moduleName), className)
+        original = cls.__dict__[methodName]
+        name = "%s.%s" %(className, methodName)
+        _state['stats'].setdefault(name, HotPathStats())
+        _state['originals'][(cls, methodName)] = original
+        setattr(cls, methodName, _wrap(original, _state['stats'][name]))
+    _state['profile'] = cProfile.Profile()
+    _state['profile'].enable()
+    if writeAtExit and not _state['atexit']:
+        atexit.register(_writeReportAtExit)
+        _state['atexit'] = True
+
+def enableFromEnvironment():
+    """Enable profiling if the environment variable NES_TOOLS_PROFILE is set"""
+    prefix = os.environ.get(ENV_VARIABLE)
+    if prefix:
+        enable(DEFAULT_PREFIX if prefix == "1" else prefix)
+
+def disable():
+    """Disable profiling and restore the hot paths. The collected stats
+    are kept until reset is called"""
+    if not isEnabled():
+        return
+    for (cls, methodName), original in _state['originals'].items():
+        setattr(cls, methodName, original)
+    _state['originals'] = {}
+    _state['profile'].disable()
+    _state['prefix'] = None
+
+def reset():
+    """Forget the collected stats"""
+    _state['stats'] = {}
+    _state['workerProfiles'] = []
+    if isEnabled():
+        # The wrappers hold the stats objects, so wrap the hot paths again
+        prefix = _state['prefix']
+        disable()
+        enable(prefix)
+    else:
+        _state['profile'] = None
+
+def profileCall(function, *args):
+    """Call a function with profiling enabled, in a worker process of a
+    pool. Returns (result, profile), where profile holds the stats
+    collected during the call, to be added by addProfile in the
+    profiled process"""
+    if isEnabled():
+        disable()   # The state of a forked parent, whose stats are not ours
+    reset()
+    enable(writeAtExit=False)
+    try:
+        result = function(*args)
+    finally:
+        profile = _state['profile']
+        disable()
+    profile.create_stats()
+    return result, {'hotPaths':getStats(), 'profile':profile.stats}
+
+def addProfile(profile):
+    """Add the stats returned by profileCall in a worker process"""
+    for name, stats in profile['hotPaths'].items():
+        _state['stats'].setdefault(name, HotPathStats()).merge(stats)
+    _state['workerProfiles'].append(profile['profile'])
+
+def getStats():
+    """Return the stats of the hot paths: {name: HotPathStats}"""
+    return dict(_state['stats'])
+
+def writeReport(prefix=None):
+    """Write the report files, see the module documentation.
+    The prefix given to enable is used unless another one is given"""
+    prefix = prefix or _state['prefix'] or DEFAULT_PREFIX
+    with open(prefix + ".txt", "w") as f:
+        for name in sorted(_state['stats']):
+            f.writelines(_state['stats'][name].getLines(name))
+    if _state['profile'] is None and not _state['workerProfiles']:
+        return
+    profiles = [_ProfileStats(profile) for profile in _state['workerProfiles']]
+    if _state['profile'] is not None:
+        profiles.insert(0, _state['profile'])
+    pstats.Stats(*profiles).dump_stats(prefix + ".prof")
+
+class _ProfileStats:
+    """cProfile stats returned by a worker, in the form pstats loads"""
+    def __init__(self, stats):
+        """Init"""
+        self.stats = stats
+        
+    def create_stats(self):
+        """The stats are already created"""
+        pass
+
+def _writeReportAtExit():
+    """Write the report at exit, if profiling is still enabled"""
+    if isEnabled():
+        _state['profile'].disable()
+        writeReport()
+
+def _wrap(function, stats):
+    """Return a wrapper of the function adding the time of every call
+    to the stats"""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.add(time.time()-start)
+    return wrapper
+
+# *************** Unit tests ***********
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tempDir, "profile")
+
+    def tearDown(self):
+        disable()
+        reset()
+        shutil.rmtree(self.tempDir)
+
+    def test_histogram(self):
+        stats = HotPathStats()
+        for seconds in (0.0000005, 0.000003, 0.000003, 0.1):
+            stats.add(seconds)
+        self.assertEqual(stats.calls, 4)
+        self.assertEqual(stats.histogram[:3], [1, 0, 2])
+        self.assertEqual(sum(stats.histogram), 4)
+        self.assertEqual(stats.maxSeconds, 0.1)
+
+    def test_enable(self):
+        from plotter import TileGroup, Tile
+        original = Tile.__dict__['getIntMatrix']
+        enable(self.prefix)
+        self.assertTrue(isEnabled())
+        tileGroup = TileGroup()
+        tileGroup.loadFromBytes(bytearray(range(32)))
+        for tile in tileGroup.tilesIterator():
+            tile.getIntMatrix()
+        self.assertEqual(getStats()["Tile.getIntMatrix"].calls, 2)
+        self.assertEqual(getStats()["TileGroup.loadFromFile"].calls, 0)
+
+        disable()
+        self.assertTrue(Tile.__dict__['getIntMatrix'] is original)
+        tileGroup.getTile(0).getIntMatrix()
+        self.assertEqual(getStats()["Tile.getIntMatrix"].calls, 2)
+
+        writeReport(self.prefix)
+        with open(self.prefix + ".txt") as f:
+            self.assertTrue("Tile.getIntMatrix: 2 calls" in f.read())
+        pstats.Stats(self.prefix + ".prof")
+
+    def test_workers(self):
+        import multiprocessing
+        from plotter import TileBank
+        enable(self.prefix)
+        TileBank(1).getTile(0).getIntMatrix()
+        pool = multiprocessing.Pool(2)
+        try:
+            results = pool.map(_profiledJob, [2, 3])
+        finally:
+            pool.terminate()
+            pool.join()
+        for result, profile in results:
+            addProfile(profile)
+        self.assertEqual([result for result, profile in results], [2, 3])
+        self.assertEqual(getStats()["Tile.getIntMatrix"].calls, 6)
+        self.assertTrue(isEnabled())
+        
+        writeReport(self.prefix)
+        functions = [function for filename, line, function in pstats.Stats(self.prefix + ".prof").stats]
+        self.assertTrue("_getIntMatrices" in functions)
+        
+    def test_environment(self):
+        os.environ[ENV_VARIABLE] = self.prefix
+        try:
+            enableFromEnvironment()
+        finally:
+            del os.environ[ENV_VARIABLE]
+        self.assertEqual(_state['prefix'], self.prefix)
+
+def _profiledJob(n):
+    """Job of test_workers, run in a pool"""
+    return profileCall(_getIntMatrices, n)
+
+def _getIntMatrices(n):
+    from plotter import TileBank
+    for i in range(n):
+        TileBank(1).getTile(0).getIntMatrix()
+    return n
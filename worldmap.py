@@ -0,0 +1,283 @@
+"""World maps of many screens, loaded lazily
+
+A world map is a grid of screens, each a nametable. The map is stored
+in a file holding the screens row by row as 1024 byte nametables, as
+written by nametable.saveBinaryFile. The file is memory mapped and the
+screens are read in chunks of a few screens when they are first used.
+At most maxChunks chunks are kept in memory, the least recently used
+chunk being dropped first, so scrolling over a long map only keeps the
+screens around the viewport in memory.
+
+The NES only holds two nametables (four with extra memory on the
+cartridge). A MirroringView shows the map the way the PPU sees it with
+a given mirroring, i.e. which screens are in the nametables at a scroll
+position, and renders the view including the wrap around of the
+mirrored nametables."""
+from nametable import Nametable, NAMETABLE_BYTES, saveBinaryFile
+from compositor import Compositor
+import collections
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+
+SCREEN_WIDTH = Compositor.WIDTH
+SCREEN_HEIGHT = Compositor.HEIGHT
+MIRRORINGS = ("horizontal", "vertical", "four-screen", "single")
+
+class WorldMap:
+    """A map of width*height screens, loaded lazily from a file"""
+    def __init__(self, filename, width, height=1, tileGroup=None, chunkScreens=4,
+                 maxChunks=8, writable=False):
+        """Init
+        filename      The file with the screens, row by row
+        width         The number of screens in a row
+        height        The number of rows of screens
+        tileGroup     The tiles used by the screens, see Nametable.fromBytes
+        chunkScreens  The number of screens read at a time
+        maxChunks     The number of chunks kept in memory
+        writable      True to allow setScreen"""
+        self._width = width
+        self._height = height
+        self._tileGroup = tileGroup
+        self._chunkScreens = chunkScreens
+        self._maxChunks = maxChunks
+        self._chunks = collections.OrderedDict() # Chunk number: list of nametables
+        self._stats = {'loads':0, 'hits':0, 'evictions':0}
+        self._writable = writable
+        self._file = open(filename, "r+b" if writable else "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size < width*height*NAMETABLE_BYTES:
+            self._file.close()
+            raise AttributeError("%s holds %d screens, not %dx%d"
+                                 %(filename, size//NAMETABLE_BYTES, width, height))
+        self._data = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+    def close(self):
+        """Close the file"""
+        self._chunks.clear()
+        self._data.close()
+        self._file.close()
+
+    def getSize(self):
+        """Return (width, height) in screens"""
+        return self._width, self._height
+
+    def getScreen(self, x, y=0):
+        """Return the nametable of the screen at column x and row y"""
+        self._checkScreen(x, y)
+        screenNr = y*self._width + x
+        return self._getChunk(screenNr//self._chunkScreens)[screenNr%self._chunkScreens]
+
+    def setScreen(self, x, y, nametable):
+        """Write a nametable to the screen at column x and row y.
+        An IOError is raised if the map is not opened writable"""
+        if not self._writable:
+            raise IOError("world map opened read-only")
+        self._checkScreen(x, y)
+        screenNr = y*self._width + x
+        start = screenNr*NAMETABLE_BYTES
+        self._data[start:start+NAMETABLE_BYTES] = bytes(nametable.toBytes())
+        chunk = self._chunks.get(screenNr//self._chunkScreens)
+        if chunk is not None:
+            chunk[screenNr%self._chunkScreens].fromBytes(nametable.toBytes(), self._tileGroup)
+
+    def getResidentScreens(self):
+        """Return the number of screens in memory"""
+        return sum([len(chunk) for chunk in self._chunks.values()])
+
+    def getStats(self):
+        """Return a dict with the number of chunk loads, hits and evictions"""
+        return dict(self._stats)
+
+    def renderViewport(self, compositor, x, y, width=SCREEN_WIDTH, height=SCREEN_HEIGHT):
+        """Render the part of the map with its top left corner at pixel
+        (x, y) using a Compositor. Only the screens in the viewport are
+        loaded. Returns a framebuffer of width*height palette indexes"""
+        assert(0 <= x and x+width <= self._width*SCREEN_WIDTH)
+        assert(0 <= y and y+height <= self._height*SCREEN_HEIGHT)
+        return composeViewport(lambda screenX, screenY: compositor.render(self.getScreen(screenX, screenY)),
+                               x, y, width, height)
+
+    def _getChunk(self, chunkNr):
+        """Return the nametables of a chunk, loading it if needed"""
+        chunk = self._chunks.get(chunkNr)
+        if chunk is not None:
+            self._chunks[chunkNr] = self._chunks.pop(chunkNr)  # Most recently used last
+            self._stats['hits'] += 1
+            return chunk
+        first = chunkNr*self._chunkScreens
+        chunk = []
+        for screenNr in range(first, min(first+self._chunkScreens, self._width*self._height)):
+            nametable = Nametable()
+            start = screenNr*NAMETABLE_BYTES
+            nametable.fromBytes(self._data[start:start+NAMETABLE_BYTES], self._tileGroup)
+            chunk.append(nametable)
+        self._chunks[chunkNr] = chunk
+        self._stats['loads'] += 1
+        while len(self._chunks) > self._maxChunks:
+            self._chunks.popitem(last=False)
+            self._stats['evictions'] += 1
+        return chunk
+
+    def _checkScreen(self, x, y):
+        """Raise IndexError for a screen outside the map"""
+        if not (0 <= x < self._width and 0 <= y < self._height):
+            raise IndexError("Screen (%d, %d) is outside the map" %(x, y))
+
+def createWorldMap(filename, nametables, width, tileGroup=None, **kwargs):
+    """Save nametables, row by row, as a map file and open it as a WorldMap"""
+    nametables = list(nametables)
+    assert(len(nametables)%width == 0)
+    saveBinaryFile(filename, nametables)
+    return WorldMap(filename, width, len(nametables)//width, tileGroup, **kwargs)
+
+def composeViewport(getFramebuffer, x, y, width, height):
+    """Compose a viewport from rendered screens. getFramebuffer(screenX,
+    screenY) returns the framebuffer of a screen, and is called once for
+    every screen in the viewport at pixel (x, y)"""
+    framebuffers = {}
+    lines = []
+    for lineY in range(y, y+height):
+        screenY, row = divmod(lineY, SCREEN_HEIGHT)
+        parts = []
+        lineX = x
+        while lineX < x+width:
+            screenX, column = divmod(lineX, SCREEN_WIDTH)
+            framebuffer = framebuffers.get((screenX, screenY))
+            if framebuffer is None:
+                framebuffer = framebuffers[(screenX, screenY)] = getFramebuffer(screenX, screenY)
+            end = min(SCREEN_WIDTH, column + x+width-lineX)
+            parts.append(framebuffer[row*SCREEN_WIDTH+column:row*SCREEN_WIDTH+end])
+            lineX += end-column
+        lines.append(b"".join([bytes(part) for part in parts]))
+    return bytearray(b"".join(lines))
+
+class MirroringView:
+    """The map as seen by the PPU with a given mirroring:
+    "horizontal"   Two nametables above each other, for vertical scrolling.
+                   The columns of screens wrap around
+    "vertical"     Two nametables side by side, for horizontal scrolling.
+                   The rows of screens wrap around
+    "four-screen"  Four nametables, with extra memory on the cartridge
+    "single"       One nametable, shown in all four places
+
+    Screens outside the map are shown as empty nametables"""
+    def __init__(self, worldMap, mirroring):
+        """Init"""
+        if mirroring not in MIRRORINGS:
+            raise AttributeError("Unknown mirroring: %s" %(mirroring))
+        self._worldMap = worldMap
+        self._mirroring = mirroring
+        self._empty = Nametable()
+
+    def getNametables(self, scrollX, scrollY):
+        """Return the four nametables at $2000, $2400, $2800 and $2C00
+        with the screens around the scroll position (in pixels) loaded"""
+        nametables = []
+        for slotY in range(2):
+            for slotX in range(2):
+                nametables.append(self._getScreenForSlot(scrollX, scrollY, slotX, slotY))
+        return nametables
+
+    def render(self, compositor, scrollX, scrollY):
+        """Render the 256x240 pixels the PPU shows at the scroll position"""
+        nametables = self.getNametables(scrollX, scrollY)
+        return composeViewport(lambda screenX, screenY:
+                                   compositor.render(nametables[(screenY%2)*2 + screenX%2]),
+                               scrollX, scrollY, SCREEN_WIDTH, SCREEN_HEIGHT)
+
+    def _getScreenForSlot(self, scrollX, scrollY, slotX, slotY):
+        """Return the screen in a nametable slot (0-1, 0-1). The screens
+        nearest to the scroll position with the parity of the slot are used,
+        unless the mirroring makes the slots show the same screen"""
+        firstX = scrollX//SCREEN_WIDTH
+        firstY = scrollY//SCREEN_HEIGHT
+        screenX = firstX + (slotX-firstX)%2
+        screenY = firstY + (slotY-firstY)%2
+        if self._mirroring in ("vertical", "single"):
+            screenY = firstY
+        if self._mirroring in ("horizontal", "single"):
+            screenX = firstX
+        width, height = self._worldMap.getSize()
+        if 0 <= screenX < width and 0 <= screenY < height:
+            return self._worldMap.getScreen(screenX, screenY)
+        return self._empty
+
+# *************** Unit tests ***********
+class TestWorldMap(unittest.TestCase):
+    def setUp(self):
+        from plotter import TileGroup, Palette
+        self.tempDir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempDir, "level.map")
+        # Tile n is filled with pixel value n%4, screen n uses tile n%4
+        self.tileGroup = TileGroup()
+        self.tileGroup.loadFromPixels([value for value in range(4) for i in range(64)])
+        self.nametables = []
+        for screen in range(20):
+            nametable = Nametable()
+            nametable.fromBytes(bytearray([screen%4]*960 + [0]*64))
+            self.nametables.append(nametable)
+        palette = Palette()
+        palette.setColors([0x0F, 0x16, 0x27, 0x30])
+        self.compositor = Compositor(self.tileGroup, [palette]*4)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_lazy(self):
+        worldMap = createWorldMap(self.filename, self.nametables, 10, self.tileGroup,
+                                  chunkScreens=2, maxChunks=2)
+        self.assertEqual(worldMap.getSize(), (10, 2))
+        self.assertEqual(worldMap.getResidentScreens(), 0)
+        for y in range(2):
+            for x in range(10):
+                self.assertEqual(worldMap.getScreen(x, y).getTileIndex(0, 0), (y*10+x)%4)
+                self.assertTrue(worldMap.getResidentScreens() <= 4)
+        self.assertEqual(worldMap.getStats()['loads'], 10)
+        self.assertEqual(worldMap.getStats()['evictions'], 8)
+        self.assertRaises(IndexError, worldMap.getScreen, 10, 0)
+        worldMap.close()
+
+    def test_setScreen(self):
+        worldMap = createWorldMap(self.filename, self.nametables, 10, writable=True)
+        worldMap.getScreen(3)
+        worldMap.setScreen(3, 0, self.nametables[0])
+        self.assertEqual(worldMap.getScreen(3).getTileIndex(0, 0), 0)
+        worldMap.close()
+        worldMap = WorldMap(self.filename, 10, 2)
+        self.assertEqual(worldMap.getScreen(3).getTileIndex(5, 5), 0)
+        self.assertRaises(IOError, worldMap.setScreen, 3, 0, self.nametables[0])
+        worldMap.close()
+
+    def test_viewport(self):
+        worldMap = createWorldMap(self.filename, self.nametables, 10, self.tileGroup)
+        framebuffer = worldMap.renderViewport(self.compositor, 256+200, 100, 100, 200)
+        self.assertEqual(len(framebuffer), 100*200)
+        self.assertEqual(framebuffer[:56], bytearray([0x16]*56))   # Screen 1
+        self.assertEqual(framebuffer[56:100], bytearray([0x27]*44)) # Screen 2
+        self.assertEqual(framebuffer[139*100], 0x16)                # Screen 1
+        self.assertEqual(framebuffer[140*100], 0x30)                # Screen 11
+        self.assertEqual(framebuffer[140*100+99], 0x0F)             # Screen 12
+
+    def test_mirroring(self):
+        worldMap = createWorldMap(self.filename, self.nametables, 10, self.tileGroup)
+        view = MirroringView(worldMap, "vertical")
+        nametables = view.getNametables(3*256+10, 0)
+        self.assertEqual([nametable.getTileIndex(0, 0) for nametable in nametables],
+                         [0, 3, 0, 3])   # Screens 4 and 3 at $2000 and $2400
+        framebuffer = view.render(self.compositor, 3*256+10, 200)
+        self.assertEqual(framebuffer[0], 0x30)
+        self.assertEqual(framebuffer[39*256], 0x30)  # The row wraps to screen 3 again
+        self.assertEqual(framebuffer[40*256], 0x30)
+        self.assertEqual(framebuffer[250], 0x0F)     # Screen 4
+
+        view = MirroringView(worldMap, "single")
+        self.assertEqual([nametable.getTileIndex(0, 0) for nametable in
+                          view.getNametables(256, 240)], [3]*4)    # Screen 11
+        view = MirroringView(worldMap, "four-screen")
+        self.assertEqual([nametable.getTileIndex(0, 0) for nametable in
+                          view.getNametables(9*256, 0)], [0, 1, 0, 3])  # Screens 9 and 19
+        self.assertRaises(AttributeError, MirroringView, worldMap, "diagonal")